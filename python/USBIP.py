@@ -1,52 +1,134 @@
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import errno
+import heapq
+import http.server
+import itertools
+import logging
+import mmap
+import operator
+import os
+import signal
 import socket
 import struct
+import sys
+import threading
+import time
 from abc import ABC, abstractmethod
 
 
+logger = logging.getLogger('USBIP')
+
 USBIP_DIR_OUT = 0
 USBIP_DIR_IN = 1
 
+USBIP_CMD_SUBMIT = 0x1
+USBIP_CMD_UNLINK = 0x2
+USBIP_RET_SUBMIT = 0x3
+USBIP_RET_UNLINK = 0x4
+
+# RET_SUBMIT/RET_UNLINK status carries a negative errno
+URB_STATUS_NODEV = -errno.ENODEV & 0xffffffff
+URB_STATUS_UNLINKED = -errno.ECONNRESET & 0xffffffff
+URB_STATUS_STALL = -errno.EPIPE & 0xffffffff  # endpoint halted
+
+URB_PREFIX = struct.Struct('>II')  # command, seqnum leading every URB header
+
+IOV_MAX = 1024  # buffers per sendmsg() call, the Linux limit
+
+# Isochronous packet descriptors follow the URB data as big-endian
+# offset, length, actual_length, status words, 16 bytes per packet
+ISO_PACKET_WORDS = 4
+ISO_PACKET_SIZE = 16
+
 
 class BaseStructure(ABC):
+    '''
+    Fixed-layout structure described by _byte_order_ and _fields_.
+
+    Each subclass is compiled once into a struct.Struct with its field names
+    and defaults precomputed, so pack/unpack never rebuild the format string.
+    Structures on the per-URB path list their fields in __slots__ so they
+    carry no instance dict.
+    '''
+
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if isinstance(cls.__dict__.get('_fields_'), (list, tuple)):
+            cls._compile()
+
+    @classmethod
+    def _compile(cls):
+        pack_format = cls._byte_order_
+        names = []
+        nested = []
+        defaults = []
+        for index, field in enumerate(cls._fields_):
+            names.append(field[0])
+            if isinstance(field[1], BaseStructure):
+                pack_format += str(field[1].size()) + 's'
+                nested.append(index)
+            else:
+                pack_format += field[1]
+            if len(field) > 2:
+                defaults.append((field[0], field[2]))
+        cls._struct_ = struct.Struct(pack_format)
+        cls._field_names_ = tuple(names)
+        cls._nested_fields_ = tuple(nested)
+        cls._defaults_ = tuple(defaults)
+        getter = operator.attrgetter(*names)
+        cls._getter_ = getter if len(names) > 1 else (lambda obj: (getter(obj),))
+
     def __init__(self, **kwargs):
         self.init_from_dict(**kwargs)
-        for field in self._fields_:
-            if len(field) > 2:
-                if not hasattr(self, field[0]):
-                    setattr(self, field[0], field[2])
+        for name, default in self._defaults_:
+            if not hasattr(self, name):
+                setattr(self, name, default)
 
     def init_from_dict(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
     def size(self):
-        return struct.calcsize(self.format())
+        return self._struct_.size
 
     def format(self):
-        pack_format = self._byte_order_
-        for field in self._fields_:
-            if isinstance(field[1], BaseStructure):
-                pack_format += str(field[1].size()) + 's'
-            else:
-                pack_format += field[1]
-        return pack_format
+        return self._struct_.format
+
+    def values(self):
+        try:
+            values = self._getter_(self)
+        except AttributeError:
+            values = tuple(getattr(self, name, 0) for name in self._field_names_)
+        if self._nested_fields_:
+            values = list(values)
+            for index in self._nested_fields_:
+                nested = values[index]
+                values[index] = nested.pack() if isinstance(nested, BaseStructure) else nested
+        return values
 
     def pack(self):
-        values = []
-        for field in self._fields_:
-            if isinstance(field[1], BaseStructure):
-                values.append(getattr(self, field[0], 0).pack())
-            else:
-                values.append(getattr(self, field[0], 0))
-        return struct.pack(self.format(), *values)
+        return self._struct_.pack(*self.values())
+
+    def pack_into(self, buffer, offset=0):
+        self._struct_.pack_into(buffer, offset, *self.values())
+        return offset + self._struct_.size
 
     def unpack(self, buf):
-        values = struct.unpack(self.format(), buf)
-        keys_vals = {}
-        for i, val in enumerate(values):
-            keys_vals[self._fields_[i][0]] = val
+        self._assign(self._struct_.unpack(buf))
 
-        self.init_from_dict(**keys_vals)
+    def unpack_from(self, buffer, offset=0):
+        self._assign(self._struct_.unpack_from(buffer, offset))
+        return offset + self._struct_.size
+
+    def _assign(self, values):
+        for name, value in zip(self._field_names_, values):
+            setattr(self, name, value)
 
     @property
     @abstractmethod
@@ -80,7 +162,13 @@ class OP_REP_DevList(BaseStructure):
     _byte_order_ = '>'
     _fields_ = [
         ('base', USBIPHeader()),
-        ('nExportedDevice', 'I'),
+        ('nExportedDevice', 'I')
+    ]
+
+
+class USBIPDeviceInfo(BaseStructure):
+    _byte_order_ = '>'
+    _fields_ = [
         ('usbPath', '256s'),
         ('busID', '32s'),
         ('busnum', 'I'),
@@ -94,8 +182,7 @@ class OP_REP_DevList(BaseStructure):
         ('bDeviceProtocol', 'B'),
         ('bConfigurationValue', 'B'),
         ('bNumConfigurations', 'B'),
-        ('bNumInterfaces', 'B'),
-        ('interfaces', USBInterface())
+        ('bNumInterfaces', 'B')
     ]
 
 
@@ -132,9 +219,14 @@ class USBIP_RET_Submit(BaseStructure):
         ('actual_length', 'I'),
         ('start_frame', 'I', 0),
         ('number_of_packets', 'I', 0xffffffff),
-        ('error_count', 'I'),
+        ('error_count', 'I', 0),
         ('padding', 'Q', 0)
     ]
+    __slots__ = tuple(field[0] for field in _fields_) + ('data',)
+
+    def __init__(self, **kwargs):
+        self.data = b''
+        BaseStructure.__init__(self, **kwargs)
 
     def pack(self):
         packed_data = BaseStructure.pack(self)
@@ -142,6 +234,9 @@ class USBIP_RET_Submit(BaseStructure):
         return packed_data
 
 
+RET_SUBMIT_HEADER = USBIP_RET_Submit._struct_
+
+
 class USBIP_CMD_Submit(BaseStructure):
     _byte_order_ = '>'
     _fields_ = [
@@ -157,6 +252,35 @@ class USBIP_CMD_Submit(BaseStructure):
         ('interval', 'I'),
         ('setup', '8s')
     ]
+    __slots__ = tuple(field[0] for field in _fields_)
+
+
+class USBIP_CMD_Unlink(BaseStructure):
+    _byte_order_ = '>'
+    _fields_ = [
+        ('command', 'I'),
+        ('seqnum', 'I'),
+        ('devid', 'I'),
+        ('direction', 'I'),
+        ('ep', 'I'),
+        ('unlink_seqnum', 'I'),
+        ('padding', '24s')
+    ]
+    __slots__ = tuple(field[0] for field in _fields_)
+
+
+class USBIP_RET_Unlink(BaseStructure):
+    _byte_order_ = '>'
+    _fields_ = [
+        ('command', 'I', USBIP_RET_UNLINK),
+        ('seqnum', 'I'),
+        ('devid', 'I', 0),
+        ('direction', 'I', 0),
+        ('ep', 'I', 0),
+        ('status', 'I'),
+        ('padding', '24s', b'')
+    ]
+    __slots__ = tuple(field[0] for field in _fields_)
 
 
 class StandardDeviceRequest(BaseStructure):
@@ -168,6 +292,7 @@ class StandardDeviceRequest(BaseStructure):
         ('wIndex', 'H'),
         ('wLength', 'H')
     ]
+    __slots__ = tuple(field[0] for field in _fields_)
 
 
 class DeviceDescriptor(BaseStructure):
@@ -256,11 +381,155 @@ class EndpointDescriptor(BaseStructure):
     ]
 
 
+class DescriptorList(list):
+    # Several class-specific descriptors following one interface or endpoint
+
+    def pack(self):
+        return b''.join(descriptor.pack() for descriptor in self)
+
+
+def unpack_iso_packets(data):
+    '''
+    Decodes the iso packet descriptors of a URB into one flat array('I') of
+    offset, length, actual_length, status per packet, so a field of all
+    packets is the slice packets[field::ISO_PACKET_WORDS].
+    '''
+    packets = array.array('I')
+    packets.frombytes(data)
+    if sys.byteorder == 'little':
+        packets.byteswap()
+    return packets
+
+
+def pack_iso_packets(packets):
+    # Inverse of unpack_iso_packets
+    if sys.byteorder == 'little':
+        packets = array.array('I', packets)
+        packets.byteswap()
+    return packets.tobytes()
+
+
+class DescriptorSet:
+    '''
+    The packed form of one descriptor tree, shared as a flyweight by every
+    device built from the same configurations, device descriptor and strings
+    objects.
+
+    Devices modelling one product already share those objects as class
+    attributes; get() extends this to what is derived from them: the raw
+    configuration, the endpoint attributes and the GET_DESCRIPTOR blobs.
+    Adding another such device then packs nothing.  The descriptor objects
+    are treated as immutable; after changing one, invalidate() it.
+    '''
+
+    registry = {}  # ids of the tree's objects -> DescriptorSet, which keeps the objects alive
+
+    def __init__(self, configurations, device_descriptor, strings):
+        self.configurations = list(configurations)
+        self.device_descriptor = device_descriptor
+        self.strings = strings
+        self.blobs = {}
+        self.generation = 0  # bumped by invalidate(), so devices drop their own blobs too
+        self.pack()
+
+    @classmethod
+    def get(cls, usb_dev):
+        key = (tuple(map(id, usb_dev.configurations)), id(usb_dev.device_descriptor), id(usb_dev.strings),
+               usb_dev.language_ids)
+        descriptors = cls.registry.get(key)
+        if descriptors is None:
+            descriptors = cls.registry[key] = cls(usb_dev.configurations, usb_dev.device_descriptor, usb_dev.strings)
+        return descriptors
+
+    def pack(self):
+        endpoint_attributes = {}
+        all_configurations = bytearray()
+        for configuration in self.configurations:
+            all_configurations.extend(configuration.pack())
+            for interface in configuration.interfaces:
+                for interface_alternative in interface:
+                    all_configurations.extend(interface_alternative.pack())
+                    if hasattr(interface_alternative, 'class_descriptor'):
+                        all_configurations.extend(interface_alternative.class_descriptor.pack())
+                    for endpoint in interface_alternative.endpoints:
+                        endpoint_attributes[endpoint.bEndpointAddress] = endpoint.bmAttributes
+                        all_configurations.extend(endpoint.pack())
+                        if hasattr(endpoint, 'class_descriptor'):
+                            all_configurations.extend(endpoint.class_descriptor.pack())
+        # Immutable, so GET_DESCRIPTOR can send memoryview slices of it
+        self.all_configurations = bytes(all_configurations)
+        self.endpoint_attributes = endpoint_attributes
+
+    def cached(self, key, build):
+        blob = self.blobs.get(key)
+        if blob is None:
+            blob = self.blobs[key] = bytes(build())
+        return blob
+
+    def invalidate(self):
+        self.blobs.clear()
+        self.generation += 1
+        self.pack()
+
+
 class USBRequest():
+    '''
+    One submitted URB as handed to the device.
+
+    The engines take requests from a free list with from_submit() and put one
+    back with recycle() once its handler has returned, if the handler
+    answered it on its own thread; a parked URB, answered later from another
+    thread, is left to the garbage collector.  A device must therefore not
+    keep a request, or the control request parsed from it, after answering it.
+    '''
+
+    __slots__ = ('seqnum', 'devid', 'direction', 'ep', 'flags', 'numberOfPackets', 'interval', 'setup',
+                 'transfer_buffer_length', 'transfer_buffer', 'start_frame',
+                 'iso_packets',  # array('I') from unpack_iso_packets on isochronous endpoints
+                 'control',  # StandardDeviceRequest reused by handle_usb_control
+                 'answered_on')  # thread that sent the RET_SUBMIT
+
+    free = []
+    free_max = 256
+
     def __init__(self, **kwargs):
+        self.start_frame = 0
+        self.iso_packets = self.control = self.answered_on = None
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    @classmethod
+    def from_submit(cls, cmd, transfer_buffer=None, iso_packets=None):
+        try:
+            usb_req = cls.free.pop()
+        except IndexError:
+            usb_req = cls()
+        usb_req.seqnum = cmd.seqnum
+        usb_req.devid = cmd.devid
+        usb_req.direction = cmd.direction
+        usb_req.ep = cmd.ep
+        usb_req.flags = cmd.transfer_flags
+        usb_req.numberOfPackets = cmd.number_of_packets
+        usb_req.interval = cmd.interval
+        usb_req.setup = cmd.setup
+        usb_req.transfer_buffer_length = cmd.transfer_buffer_length
+        usb_req.transfer_buffer = transfer_buffer
+        usb_req.start_frame = cmd.start_frame
+        usb_req.iso_packets = iso_packets
+        usb_req.answered_on = None
+        return usb_req
+
+    def answered_inline(self):
+        # True on the handler's thread if the handler sent the RET_SUBMIT itself
+        return self.answered_on is threading.current_thread()
+
+    def recycle(self):
+        # Back to the free list; the caller must hold the last reference
+        self.transfer_buffer = self.iso_packets = self.setup = None
+        free = self.free
+        if len(free) < self.free_max:
+            free.append(self)
+
 
 class USBDevice(ABC):
     '''
@@ -275,69 +544,206 @@ class USBDevice(ABC):
     @abstractmethod
     def device_descriptor(self): pass
 
+    speed = 2  # full speed
+
+    # String descriptors by index, e.g. {1: 'Manufacturer'}; index 0 is the language list
+    strings = {}
+    language_ids = (0x0409,)  # English (United States)
+
+    # Bus position, assigned by USBContainer.add_usb_device
+    container = None
+    busnum = None
+    devnum = None
+    busid = None
+    devid = None
+
+    # Opt-in for blocking handlers: run handle_data and control handlers on a
+    # pool of this many threads instead of the connection's own thread
+    handler_threads = 0
+    handler_queue = 64  # URBs queued or running on the pool before the connection stops reading
+    executor = None
+
+    materialized = False  # set by materialize()
+    materialize_lock = threading.Lock()
+    descriptor_cache = None  # this device's own blobs, e.g. its import reply
+    descriptor_generation = None  # of self.descriptors when descriptor_cache was started
+
     def __init__(self):
-        self.generate_raw_configuration()
+        self.descriptors = DescriptorSet.get(self)
 
-    def generate_raw_configuration(self):
-        all_configurations = bytearray()
-        for configuration in self.configurations:
-            all_configurations.extend(configuration.pack())
-            for interface in configuration.interfaces:
-                for interface_alternative in interface:
-                    all_configurations.extend(interface_alternative.pack())
-                    if hasattr(interface_alternative, 'class_descriptor'):
-                        all_configurations.extend(interface_alternative.class_descriptor.pack())
-                    for endpoint in interface_alternative.endpoints:
-                        all_configurations.extend(endpoint.pack())
-                        if hasattr(endpoint, 'class_descriptor'):
-                            all_configurations.extend(endpoint.class_descriptor.pack())
-        self.all_configurations = all_configurations
+    @property
+    def usb_path(self):
+        return f'/sys/devices/pci0000:00/0000:00:01.2/usb{self.busnum}/{self.busid}'
 
-    def send_usb_ret(self, usb_req, usb_res, usb_len, status=0):
-        print(f'Sending {bytes_to_string(usb_res)}')
-        self.connection.sendall(USBIP_RET_Submit(command=0x3,
-                                                 seqnum=usb_req.seqnum,
-                                                 status=status,
-                                                 actual_length=usb_len,
-                                                 data=usb_res).pack())
+    @property
+    def all_configurations(self):
+        return self.descriptors.all_configurations
+
+    @property
+    def endpoint_attributes(self):
+        return self.descriptors.endpoint_attributes
+
+    def create_state(self):
+        # Per-device runtime state, such as report queues, buffers and threads.
+        # Runs once, on the device's first import, so devices that are added
+        # but never imported cost little more than their bus position.
+        pass
+
+    def materialize(self):
+        # Called by the container on every import, and safe to call from any thread; only the first does anything
+        if self.materialized:
+            return
+        with self.materialize_lock:
+            if self.materialized:
+                return
+            self.create_state()
+            if self.container is not None:
+                self.schedule_endpoints(self.container.scheduler)
+            self.materialized = True
+
+    def handler_executor(self):
+        # The device's handler pool, created on first use and kept across connections
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.handler_threads,
+                                                                  thread_name_prefix=f'usbip-{self.busid}')
+        return self.executor
+
+    def cached_descriptor(self, key, build):
+        # Immutable blobs built once per device, until invalidate_descriptors()
+        generation = self.descriptors.generation
+        if self.descriptor_cache is None or self.descriptor_generation != generation:
+            self.descriptor_cache = {}
+            self.descriptor_generation = generation
+        blob = self.descriptor_cache.get(key)
+        if blob is None:
+            blob = self.descriptor_cache[key] = bytes(build())
+        return blob
+
+    def shared_descriptor(self, key, build):
+        # Like cached_descriptor(), for blobs that depend only on the descriptor tree
+        return self.descriptors.cached(key, build)
+
+    def invalidate_descriptors(self):
+        # Call after changing any descriptor of this device.  Devices sharing
+        # the changed descriptor objects see the change as well, their own
+        # cached blobs included; a device list reply is rebuilt only for this
+        # device's container, so call it for a sibling in another container.
+        self.descriptor_cache = None
+        descriptors = DescriptorSet.get(self)
+        if descriptors is self.descriptors:
+            descriptors.invalidate()
+        self.descriptors = descriptors
+        if self.container is not None:
+            self.container.invalidate_device_list()
+
+    def string_descriptor(self, index):
+        if index == 0:
+            data = b''.join(language_id.to_bytes(2, byteorder='little') for language_id in self.language_ids)
+        else:
+            data = self.strings[index].encode('utf-16-le')
+        return bytes((len(data) + 2, 0x03)) + data
+
+    def transfer_type(self, ep, direction):
+        # bmAttributes transfer type of an endpoint: 0 control, 1 iso, 2 bulk, 3 interrupt
+        if ep == 0:
+            return 0
+        address = ep | (0x80 if direction == USBIP_DIR_IN else 0)
+        return self.descriptors.endpoint_attributes.get(address, 3) & 0x3
+
+    def send_usb_ret(self, usb_req, usb_res, usb_len, status=0, iso_packets=None, error_count=0):
+        # usb_res is one buffer, or a list of buffers sent back to back without joining them
+        scattered = isinstance(usb_res, list)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('RET_SUBMIT seqnum=%x status=%x actual_length=%d data=%s', usb_req.seqnum, status,
+                         usb_len, HexDump(b''.join(usb_res) if scattered else usb_res))
+        if self.container is not None:
+            if self.container.capture is not None:
+                self.container.capture.complete(self, usb_req, status, usb_len,
+                                                b''.join(usb_res) if scattered else usb_res)
+            if self.container.metrics is not None:
+                self.container.metrics.observe_ret(self, usb_len)
+        usb_req.answered_on = threading.current_thread()
+        # The RET_SUBMIT header is packed straight from the request, without a USBIP_RET_Submit
+        if iso_packets is None:
+            header = RET_SUBMIT_HEADER.pack(USBIP_RET_SUBMIT, usb_req.seqnum, 0, 0, 0, status, usb_len,
+                                            0, 0xffffffff, 0, 0)
+            if scattered:
+                send_buffers(self.connection, [header, *usb_res])
+            else:
+                send_buffers(self.connection, [header, usb_res] if usb_res else [header])
+        else:
+            header = RET_SUBMIT_HEADER.pack(USBIP_RET_SUBMIT, usb_req.seqnum, 0, 0, 0, status, usb_len,
+                                            usb_req.start_frame, len(iso_packets) // ISO_PACKET_WORDS,
+                                            error_count, 0)
+            if scattered:
+                buffers = [header, *usb_res]
+            else:
+                buffers = [header, usb_res] if usb_res else [header]
+            buffers.append(pack_iso_packets(iso_packets))
+            send_buffers(self.connection, buffers)
+
+    def send_iso_ret(self, usb_req, usb_res, actual_lengths, statuses=None):
+        '''
+        Completes an isochronous URB.  actual_lengths and the optional statuses
+        hold one value per packet of usb_req.iso_packets, as array('I') or any
+        sequence of ints.  For IN, usb_res is the data of all packets back to
+        back, without the gaps a packet shorter than its length leaves.
+        '''
+        packets = usb_req.iso_packets
+        if not isinstance(actual_lengths, array.array):
+            actual_lengths = array.array('I', actual_lengths)
+        packets[2::ISO_PACKET_WORDS] = actual_lengths
+        error_count = 0
+        if statuses is None:
+            packets[3::ISO_PACKET_WORDS] = array.array('I', bytes(4 * len(actual_lengths)))
+        else:
+            statuses = array.array('I', [status & 0xffffffff for status in statuses])
+            packets[3::ISO_PACKET_WORDS] = statuses
+            error_count = len(statuses) - statuses.count(0)
+        self.send_usb_ret(usb_req, usb_res, sum(actual_lengths), 0, packets, error_count)
 
     def handle_get_descriptor(self, control_req, usb_req):
         handled = False
         descriptor_type, descriptor_index = control_req.wValue.to_bytes(length=2, byteorder='big')
-        print(f"handle_get_descriptor {descriptor_type:n} {descriptor_index:n}")
+        logger.debug('GET_DESCRIPTOR type=%d index=%d', descriptor_type, descriptor_index)
         if descriptor_type == 0x01:  # Device Descriptor
             handled = True
-            ret = self.device_descriptor.pack()
+            ret = memoryview(self.shared_descriptor(0x01, self.device_descriptor.pack))[:control_req.wLength]
             self.send_usb_ret(usb_req, ret, len(ret))
         elif descriptor_type == 0x02:  # Configuration Descriptor
             handled = True
-            ret = self.all_configurations[:control_req.wLength]
+            ret = memoryview(self.descriptors.all_configurations)[:control_req.wLength]
+            self.send_usb_ret(usb_req, ret, len(ret))
+        elif descriptor_type == 0x03 and (descriptor_index in self.strings or (descriptor_index == 0 and self.strings)):
+            handled = True
+            ret = memoryview(self.shared_descriptor((0x03, descriptor_index),
+                                                    lambda: self.string_descriptor(descriptor_index)))[:control_req.wLength]
             self.send_usb_ret(usb_req, ret, len(ret))
 
         return handled
 
     def handle_set_configuration(self, control_req, usb_req):
         # Only supports 1 configuration
-        print(f"handle_set_configuration {control_req.wValue:n}")
+        logger.debug('SET_CONFIGURATION value=%d', control_req.wValue)
         self.send_usb_ret(usb_req, b'', 0)
         return True
 
     def handle_usb_control(self, usb_req):
-        control_req = StandardDeviceRequest()
+        control_req = usb_req.control
+        if control_req is None:
+            control_req = usb_req.control = StandardDeviceRequest()
         control_req.unpack(usb_req.setup)
         handled = False
-        print(f"  UC Request Type {control_req.bmRequestType}")
-        print(f"  UC Request {control_req.bRequest}")
-        print(f"  UC Value  {control_req.wValue}")
-        print(f"  UC Index  {control_req.wIndex}")
-        print(f"  UC Length {control_req.wLength}")
+        logger.debug('control bmRequestType=%x bRequest=%x wValue=%x wIndex=%x wLength=%d',
+                     control_req.bmRequestType, control_req.bRequest, control_req.wValue,
+                     control_req.wIndex, control_req.wLength)
         if control_req.bmRequestType == 0x80:  # Data flows IN, from Device to Host
             if control_req.bRequest == 0x00:  # GET_STATUS
                 attributes = self.configurations[0].bmAttributes
                 is_self_powered = attributes & (1 << 6)
                 is_remote_wakeup = attributes & (1 << 5)
                 ret = 0x0000 | (is_remote_wakeup << 1) | (is_self_powered)
-                self.send_usb_ret(usb_req, ret, 2)
+                self.send_usb_ret(usb_req, ret.to_bytes(2, byteorder='little'), 2)
                 handled = True
 
             elif control_req.bRequest == 0x06:  # GET_DESCRIPTOR
@@ -350,6 +756,26 @@ class USBDevice(ABC):
         if not handled:
             self.handle_device_specific_control(control_req, usb_req)
 
+    def handle_unlink(self, seqnum):
+        # Called when the host cancels a URB; devices that park URBs should
+        # forget it here and return True if they were still holding it.
+        return False
+
+    def pending_urbs(self):
+        # URBs the device holds unanswered, reported as the pending depth by
+        # the blocking engine; devices that park URBs should count them here.
+        return 0
+
+    def detach(self):
+        # Called when the importing client's session ends; devices that park
+        # URBs should drop them here, as their seqnums mean nothing to the next client.
+        pass
+
+    def schedule_endpoints(self, scheduler):
+        # Called when the device is added to a container; devices with paced
+        # interrupt endpoints register them with the container's scheduler here.
+        pass
+
     def handle_usb_request(self, usb_req):
         if usb_req.ep == 0:  # Endpoint 0 is always the control endpoint
             self.handle_usb_control(usb_req)
@@ -365,115 +791,1630 @@ class USBDevice(ABC):
         pass
 
 
+def send_buffers(conn, buffers):
+    '''
+    Write a list of buffers with one scatter-gather sendmsg() where the
+    connection supports it, so payloads are never joined into a new bytes.
+    '''
+    sendmsg = getattr(conn, 'sendmsg', None)
+    if sendmsg is None:  # e.g. Windows sockets
+        for buffer in buffers:
+            conn.sendall(buffer)
+        return
+    index = 0
+    count = len(buffers)
+    while index < count:
+        sent = sendmsg(buffers if not index and count <= IOV_MAX else buffers[index:index + IOV_MAX])
+        while index < count and sent >= len(buffers[index]):
+            sent -= len(buffers[index])
+            index += 1
+        if sent:
+            buffers = [memoryview(buffers[index])[sent:]] + buffers[index + 1:]
+            index = 0
+            count = len(buffers)
+
+
+def after_send(conn, callback):
+    '''
+    Calls callback once everything sent on conn so far has been written, for
+    senders of views into memory they will reuse.  Connections that queue
+    buffers offer after_send(); a socket has written them when sendmsg returns.
+    '''
+    register = getattr(conn, 'after_send', None)
+    if register is None:
+        callback()
+    else:
+        register(callback)
+
+
+def set_tcp_policy(sock, nodelay):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+
+
+def set_tcp_cork(sock, corked):
+    # Linux only; elsewhere batching relies on the single sendmsg/writelines call
+    if hasattr(socket, 'TCP_CORK'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(corked))
+
+
+class WriteQueue:
+    '''
+    Per-connection queue of outgoing buffers, written together by flush().
+
+    Offers sendall()/sendmsg() so it can stand in for the socket as
+    USBDevice.connection.  Queued buffers are kept by reference until the
+    flush, so callers must not modify them afterwards.  Sends from threads
+    other than the one serving the connection, such as report producers
+    completing parked URBs, are written at once since that thread may be
+    blocked in recv.
+    '''
+
+    def __init__(self, sock, cork=False, metrics=None):
+        self.sock = sock
+        self.cork = cork
+        self.metrics = metrics
+        self.buffers = []
+        self.callbacks = []  # after_send() callbacks waiting for the next flush
+        self.lock = threading.Lock()
+        self.owner = threading.get_ident()
+
+    def sendall(self, data):
+        self.sendmsg([bytes(data)])
+
+    def sendmsg(self, buffers):
+        callbacks = None
+        with self.lock:
+            self.buffers.extend(buffers)
+            if threading.get_ident() != self.owner:
+                callbacks = self._flush()
+        if callbacks:
+            self.run_callbacks(callbacks)
+        size = 0
+        for buffer in buffers:
+            size += len(buffer)
+        return size
+
+    def after_send(self, callback):
+        with self.lock:
+            if self.buffers:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def flush(self):
+        with self.lock:
+            callbacks = self._flush()
+        if callbacks:
+            self.run_callbacks(callbacks)
+
+    @staticmethod
+    def run_callbacks(callbacks):
+        # Outside the lock, as callbacks take the locks of the devices that registered them
+        for callback in callbacks:
+            callback()
+
+    def _flush(self):
+        # Writes the queued buffers; returns the callbacks now due
+        if not self.buffers:
+            return None
+        buffers, self.buffers = self.buffers, []
+        callbacks = self.callbacks
+        if callbacks:
+            self.callbacks = []
+        started = time.perf_counter()
+        if self.cork:
+            set_tcp_cork(self.sock, True)
+        try:
+            send_buffers(self.sock, buffers)
+        finally:
+            if self.cork:
+                set_tcp_cork(self.sock, False)
+        if self.metrics is not None:
+            self.metrics.observe_send(time.perf_counter() - started)
+        return callbacks
+
+
+class ReportQueue:
+    '''
+    Pairs reports pushed by producers with parked interrupt IN URBs.
+
+    A device calls submit() from handle_data, returns cancel() from
+    handle_unlink and calls detach() from its own detach().
+    When no report is ready the URB is parked rather than answered or
+    dropped, and the next push() completes it from the producer's thread.
+    Once schedule() is called, pairs are instead made by an
+    InterruptScheduler once per bInterval.
+    Reports pushed while no URB is parked wait in order; with maxlen set the
+    oldest are dropped once that many are waiting.
+    '''
+
+    def __init__(self, usb_dev, maxlen=None):
+        self.usb_dev = usb_dev
+        self.lock = threading.Lock()
+        self.reports = collections.deque(maxlen=maxlen)
+        self.urbs = collections.deque()
+        self.paced = False
+
+    def schedule(self, scheduler, endpoint):
+        # From now on at most one report per bInterval, sent by the scheduler
+        self.paced = True
+        return scheduler.register(endpoint_interval(endpoint, self.usb_dev.speed), self.service)
+
+    def push(self, report):
+        with self.lock:
+            if self.paced or not self.urbs:
+                self.reports.append(report)
+                return
+            usb_req = self.urbs.popleft()
+            self.usb_dev.send_usb_ret(usb_req, report, len(report))
+
+    def submit(self, usb_req):
+        with self.lock:
+            if self.paced or not self.reports:
+                self.urbs.append(usb_req)
+                return
+            report = self.reports.popleft()
+            self.usb_dev.send_usb_ret(usb_req, report, len(report))
+
+    def service(self):
+        with self.lock:
+            if not (self.reports and self.urbs):
+                return
+            usb_req = self.urbs.popleft()
+            report = self.reports.popleft()
+            self.usb_dev.send_usb_ret(usb_req, report, len(report))
+
+    def __len__(self):
+        # Parked URBs
+        return len(self.urbs)
+
+    def cancel(self, seqnum):
+        with self.lock:
+            for usb_req in self.urbs:
+                if usb_req.seqnum == seqnum:
+                    self.urbs.remove(usb_req)
+                    return True
+        return False
+
+    def detach(self):
+        # Drops the parked URBs of a session that ended; waiting reports are kept for the next one
+        with self.lock:
+            self.urbs.clear()
+
+
+class RingBuffer:
+    '''
+    Fixed-size byte FIFO over one bytearray allocated up front.
+
+    write() copies data in and read() copies it out as bytes, at most two
+    slice copies each around the wrap.  writable() and readable() expose
+    the same regions as memoryviews, so file descriptors can be read into
+    or written from the buffer directly, followed by commit() or consume().
+    lend() reads without copying: it returns the views and keeps their bytes
+    from being overwritten until the matching release(), for sending them on
+    a connection that writes later.  A ring is either lent from or consumed
+    from, not both.  Not locked: the owner serialises its producer and consumer.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.head = 0  # bytes ever written
+        self.tail = 0  # bytes ever read
+        self.released = 0  # bytes ever made free again, tail less what is lent
+        self.loans = collections.deque()  # byte counts lent, oldest first
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def free(self):
+        return self.size - (self.head - self.released)
+
+    def regions(self, start, count):
+        start %= self.size
+        if start + count <= self.size:
+            return [self.view[start:start + count]] if count else []
+        return [self.view[start:], self.view[:start + count - self.size]]
+
+    def writable(self):
+        return self.regions(self.head, self.free())
+
+    def readable(self, limit=None):
+        count = len(self) if limit is None else min(limit, len(self))
+        return self.regions(self.tail, count)
+
+    def commit(self, count):
+        self.head += count
+
+    def consume(self, count):
+        self.tail += count
+        self.released = self.tail
+
+    def lend(self, limit):
+        # Views of up to limit bytes and their total; the bytes stay reserved until release()
+        count = min(limit, len(self))
+        regions = self.regions(self.tail, count)
+        self.tail += count
+        self.loans.append(count)
+        return regions, count
+
+    def release(self):
+        # Frees the oldest lent bytes
+        if self.loans:
+            self.released += self.loans.popleft()
+
+    def release_all(self):
+        self.loans.clear()
+        self.released = self.tail
+
+    def write(self, data):
+        # Copies as much of data as fits; returns the byte count
+        data = memoryview(data).cast('B')
+        count = 0
+        for region in self.writable():
+            chunk = min(len(region), len(data) - count)
+            region[:chunk] = data[count:count + chunk]
+            count += chunk
+        self.head += count
+        return count
+
+    def read(self, limit):
+        regions = self.readable(limit)
+        data = b''.join(regions) if len(regions) > 1 else bytes(regions[0]) if regions else b''
+        self.consume(len(data))
+        return data
+
+
+def endpoint_interval(endpoint, speed):
+    # Seconds between services of an interrupt endpoint
+    if speed >= 3:  # high speed and faster count 2**(bInterval-1) microframes of 125 us
+        return (1 << (min(max(endpoint.bInterval, 1), 16) - 1)) * 0.000125
+    return max(endpoint.bInterval, 1) * 0.001
+
+
+class InterruptScheduler:
+    '''
+    Services the interrupt endpoints of all devices at their bInterval.
+
+    Endpoints are kept in one heap ordered by next deadline, so a tick costs
+    O(log n) per due endpoint however many are registered.  Callbacks run on
+    the scheduler thread and must not block.  An endpoint serviced a whole
+    period or more late counts its skipped periods in missed_deadlines.
+    '''
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.serviced = 0
+        self.missed_deadlines = 0
+        self.max_lateness = 0.0
+
+    def register(self, interval, callback):
+        entry = [time.monotonic() + interval, next(self.counter), interval, callback]
+        with self.wakeup:
+            heapq.heappush(self.heap, entry)
+            self.wakeup.notify()
+        return entry
+
+    def unregister(self, entry):
+        entry[3] = None  # dropped when it next comes due
+
+    def start(self):
+        with self.wakeup:
+            if self.thread is None:
+                self.running = True
+                self.thread = threading.Thread(target=self.run, name='InterruptScheduler', daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        with self.wakeup:
+            self.running = False
+            self.wakeup.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def next_due(self):
+        with self.wakeup:
+            while self.running:
+                if not self.heap:
+                    self.wakeup.wait()
+                    continue
+                delay = self.heap[0][0] - time.monotonic()
+                if delay <= 0:
+                    break
+                self.wakeup.wait(delay)
+            now = time.monotonic()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                entry = heapq.heappop(self.heap)
+                if entry[3] is not None:
+                    due.append(entry)
+            return now, due
+
+    def run(self):
+        while self.running:
+            now, due = self.next_due()
+            for entry in due:
+                deadline, _, interval, callback = entry
+                lateness = now - deadline
+                if lateness > self.max_lateness:
+                    self.max_lateness = lateness
+                if lateness >= interval:
+                    self.missed_deadlines += int(lateness // interval)
+                    entry[0] = now + interval
+                else:
+                    entry[0] = deadline + interval
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('interrupt endpoint callback failed')
+            self.serviced += len(due)
+            with self.wakeup:
+                for entry in due:
+                    if entry[3] is not None:
+                        heapq.heappush(self.heap, entry)
+
+    def stats(self):
+        return dict(endpoints=len(self.heap),
+                    serviced=self.serviced,
+                    missed_deadlines=self.missed_deadlines,
+                    max_lateness=self.max_lateness)
+
+
+class PcapCapture:
+    '''
+    Capture tap writing CMD_SUBMIT/RET_SUBMIT traffic to pcap files.
+
+    Records use the Linux usbmon link type (LINKTYPE_USB_LINUX_MMAPPED), which
+    Wireshark dissects like a capture taken on a Linux host.  The hot path
+    only appends a tuple to a bounded ring; a background thread formats and
+    writes the records.  When the ring is full the oldest records are dropped
+    and counted in dropped.  A file that would grow past max_bytes is closed
+    and rotated to path.1.pcap ... path.<backup_count>.pcap.
+    '''
+
+    LINKTYPE_USB_LINUX_MMAPPED = 220
+    SNAPLEN = 0x40000
+    GLOBAL_HEADER = struct.Struct('<IHHiIII')
+    RECORD_HEADER = struct.Struct('<IIII')
+    USBMON_HEADER = struct.Struct('<QBBBBHccqiiII8siiII')
+    XFER_TYPES = {0: 2, 1: 0, 2: 3, 3: 1}  # bmAttributes type to usbmon ctrl/iso/bulk/intr
+    STATUS_IN_PROGRESS = -errno.EINPROGRESS
+
+    def __init__(self, path, max_bytes=64 << 20, backup_count=4, ring_size=65536, flush_interval=0.05):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.ring = collections.deque(maxlen=ring_size)
+        self.dropped = 0
+        self.file = None
+        self.size = 0
+        self.open()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='PcapCapture', daemon=True)
+        self.thread.start()
+
+    def record(self, entry):
+        if len(self.ring) == self.ring.maxlen:
+            self.dropped += 1
+        self.ring.append(entry)
+
+    def submit(self, usb_dev, usb_req):
+        data = usb_req.transfer_buffer
+        self.record((time.time(), b'S', usb_dev, usb_req.seqnum, usb_req.ep, usb_req.direction,
+                     usb_req.setup if usb_req.ep == 0 else None, self.STATUS_IN_PROGRESS,
+                     usb_req.transfer_buffer_length, bytes(data) if data else b'', usb_req.interval))
+
+    def complete(self, usb_dev, usb_req, status, actual_length, data):
+        if status & 0x80000000:
+            status -= 1 << 32
+        self.record((time.time(), b'C', usb_dev, usb_req.seqnum, usb_req.ep, usb_req.direction,
+                     None, status, actual_length, bytes(data[:actual_length]) if data else b'',
+                     usb_req.interval))
+
+    def format(self, entry):
+        timestamp, kind, usb_dev, seqnum, ep, direction, setup, status, length, data, interval = entry
+        seconds = int(timestamp)
+        microseconds = int((timestamp - seconds) * 1000000)
+        if setup is not None:
+            flag_setup = b'\0'
+        else:
+            flag_setup, setup = b'-', bytes(8)
+        flag_data = b'\0' if data else (b'<' if direction == USBIP_DIR_IN else b'>')
+        header = self.USBMON_HEADER.pack(
+            (usb_dev.devid << 32) | seqnum, kind[0], self.XFER_TYPES[usb_dev.transfer_type(ep, direction)],
+            ep | (0x80 if direction == USBIP_DIR_IN else 0), usb_dev.devnum, usb_dev.busnum,
+            flag_setup, flag_data, seconds, microseconds, status, length, len(data), setup,
+            interval, 0, 0, 0)
+        captured = len(header) + len(data)
+        return self.RECORD_HEADER.pack(seconds, microseconds, captured, captured) + header + data
+
+    def open(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(self.GLOBAL_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, self.SNAPLEN, self.LINKTYPE_USB_LINUX_MMAPPED))
+        self.size = self.GLOBAL_HEADER.size
+
+    def rotated_name(self, index):
+        stem, dot, suffix = self.path.rpartition('.')
+        return f'{stem}.{index}.{suffix}' if dot else f'{self.path}.{index}'
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(self.rotated_name(index)):
+                os.replace(self.rotated_name(index), self.rotated_name(index + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.rotated_name(1))
+        self.open()
+
+    def drain(self):
+        ring = self.ring
+        while ring:
+            record = self.format(ring.popleft())
+            if self.size + len(record) > self.max_bytes and self.size > self.GLOBAL_HEADER.size:
+                self.rotate()
+            self.file.write(record)
+            self.size += len(record)
+        self.file.flush()
+
+    def run(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('pcap capture failed')
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.drain()
+        self.file.close()
+
+
+UsbmonRecord = collections.namedtuple('UsbmonRecord', ['timestamp', 'kind', 'devid', 'seqnum', 'xfer_type', 'ep',
+                                                     'direction', 'devnum', 'busnum', 'setup', 'status',
+                                                     'length', 'interval', 'data'])
+
+
+def read_capture(path):
+    '''
+    Yields the records of a pcap file written by PcapCapture as UsbmonRecord,
+    with kind b'S' for CMD_SUBMIT and b'C' for RET_SUBMIT.
+    '''
+    with open(path, 'rb') as capture:
+        magic, _, _, _, _, _, linktype = PcapCapture.GLOBAL_HEADER.unpack(capture.read(PcapCapture.GLOBAL_HEADER.size))
+        if magic != 0xa1b2c3d4 or linktype != PcapCapture.LINKTYPE_USB_LINUX_MMAPPED:
+            raise ValueError(f'{path} is not a usbmon pcap file')
+        while 1:
+            header = capture.read(PcapCapture.RECORD_HEADER.size)
+            if len(header) < PcapCapture.RECORD_HEADER.size:
+                return
+            seconds, microseconds, captured, _ = PcapCapture.RECORD_HEADER.unpack(header)
+            body = capture.read(captured)
+            (urb_id, kind, xfer_type, epnum, devnum, busnum, flag_setup, _, _, _, status, length,
+             data_length, setup, interval, _, _, _) = PcapCapture.USBMON_HEADER.unpack_from(body)
+            data_start = PcapCapture.USBMON_HEADER.size
+            yield UsbmonRecord(seconds + microseconds / 1000000, bytes([kind]), urb_id >> 32, urb_id & 0xffffffff,
+                               xfer_type, epnum & 0x7f, USBIP_DIR_IN if epnum & 0x80 else USBIP_DIR_OUT,
+                               devnum, busnum, setup if flag_setup == b'\0' else None,
+                               status & 0xffffffff, length, interval, body[data_start:data_start + data_length])
+
+
+class BlockCache:
+    '''
+    LRU block cache with sequential read-ahead and write-back, for disk
+    images of storage devices.
+
+    Wraps any image offering block_size, block_count, read_only,
+    read(lba, count), write(offset, data) and flush(), and offers the same
+    interface.  The image is cached in chunks of chunk_blocks blocks, at most
+    capacity bytes of them.  A read that continues the previous one is a
+    sequential stream; its misses also load the next read_ahead chunks in
+    the same image read, so capacity must hold at least read_ahead + 1
+    chunks.  Writes only dirty cached chunks; dirty chunks are
+    written back, contiguous ones together, when evicted, at flush() (e.g.
+    on SYNCHRONIZE CACHE) and every flush_interval seconds if set.
+    A read within one chunk returns a memoryview of it, valid until the
+    next write to those blocks.
+    '''
+
+    def __init__(self, image, capacity=32 << 20, chunk_blocks=8, read_ahead=32, flush_interval=None):
+        self.image = image
+        self.block_size = image.block_size
+        self.block_count = image.block_count
+        self.read_only = image.read_only
+        self.chunk_blocks = chunk_blocks
+        self.chunk_size = chunk_blocks * image.block_size
+        self.chunk_count = -(-image.block_count // chunk_blocks)
+        self.capacity = max(1, capacity // self.chunk_size)
+        if self.capacity < read_ahead + 1:
+            # A read-ahead load would evict the chunk it was loaded for
+            raise ValueError(f'a capacity of {self.capacity} chunks cannot hold a read-ahead of {read_ahead} chunks '
+                             f'and the chunk being read')
+        self.read_ahead = read_ahead
+        self.chunks = collections.OrderedDict()  # chunk index -> bytearray, least recently used first
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.next_lba = None  # where a sequential read would continue
+        self.hits = self.misses = self.prefetched = self.written_back = 0
+        self.running = flush_interval is not None
+        if self.running:
+            self.wakeup = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(flush_interval,), name='BlockCache', daemon=True)
+            self.thread.start()
+
+    def load(self, first, count):
+        # Read chunks first..first+count-1 from the image with one read, skipping cached ones at the end
+        while count and first + count - 1 in self.chunks:
+            count -= 1
+        lba = first * self.chunk_blocks
+        data = memoryview(self.image.read(lba, min(count * self.chunk_blocks, self.block_count - lba)))
+        # Only chunks missing before the read: a cached one evicted by these inserts may have been
+        # written back since, newer than data
+        missing = [index for index in range(first, first + count) if index not in self.chunks]
+        for index in missing:
+            self.insert(index, bytearray(data[(index - first) * self.chunk_size:(index - first + 1) * self.chunk_size]))
+
+    def insert(self, index, chunk):
+        while len(self.chunks) >= self.capacity:
+            evicted, evicted_chunk = self.chunks.popitem(last=False)
+            if evicted in self.dirty:
+                self.dirty.discard(evicted)
+                self.write_back([(evicted, evicted_chunk)])
+        self.chunks[index] = chunk
+
+    def chunk(self, index, sequential=False):
+        chunk = self.chunks.get(index)
+        if chunk is not None:
+            self.hits += 1
+            self.chunks.move_to_end(index)
+            return chunk
+        self.misses += 1
+        count = 1
+        if sequential:
+            count = min(1 + self.read_ahead, self.chunk_count - index)
+            self.prefetched += count - 1
+        self.load(index, count)
+        return self.chunks[index]
+
+    def read(self, lba, count):
+        if not count:
+            return b''
+        first, offset = divmod(lba, self.chunk_blocks)
+        start = offset * self.block_size
+        with self.lock:
+            sequential = lba == self.next_lba
+            self.next_lba = lba + count
+            if offset + count <= self.chunk_blocks:
+                return memoryview(self.chunk(first, sequential))[start:start + count * self.block_size]
+            data = bytearray()
+            for index in range(first, (lba + count - 1) // self.chunk_blocks + 1):
+                data += self.chunk(index, sequential)
+            return memoryview(data)[start:start + count * self.block_size]
+
+    def write(self, offset, data):
+        data = memoryview(data)
+        with self.lock:
+            while data:
+                index, start = divmod(offset, self.chunk_size)
+                length = min(len(data), self.chunk_size - start)
+                chunk = self.chunks.get(index)
+                if chunk is None:
+                    if length == self.chunk_size:  # whole chunk, nothing to read first
+                        chunk = bytearray(data[:length])
+                        self.insert(index, chunk)
+                    else:
+                        chunk = self.chunk(index)
+                else:
+                    self.chunks.move_to_end(index)
+                chunk[start:start + length] = data[:length]
+                self.dirty.add(index)
+                offset += length
+                data = data[length:]
+
+    def write_back(self, chunks):
+        # chunks sorted by index; each contiguous run is one image write
+        run = []
+        for index, chunk in chunks + [(None, None)]:
+            if run and (index is None or index != run[-1][0] + 1):
+                self.image.write(run[0][0] * self.chunk_size, b''.join(data for _, data in run))
+                self.written_back += len(run)
+                run = []
+            if index is not None:
+                run.append((index, chunk))
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = sorted(self.dirty), set()
+            self.write_back([(index, self.chunks[index]) for index in dirty])
+            self.image.flush()
+
+    def run(self, flush_interval):
+        while not self.wakeup.wait(flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('block cache write-back failed')
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=self.hits / lookups if lookups else 0.0,
+                    prefetched=self.prefetched,
+                    written_back=self.written_back,
+                    dirty=len(self.dirty))
+
+    def close(self):
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+            self.thread.join()
+        self.flush()
+        self.image.close()
+
+
+class Histogram:
+    '''
+    Latency histogram over fixed buckets, in seconds.
+
+    Counts are kept per bucket and only made cumulative when rendered, so an
+    observation is one bisect and two additions.
+    '''
+
+    BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    def render(self, name, labels=''):
+        lines = []
+        total = 0
+        for bound, count in zip(self.BUCKETS + ('+Inf',), list(self.counts)):
+            total += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {total}')
+        labels = '{' + labels.rstrip(',') + '}' if labels else ''
+        lines.append(f'{name}_sum{labels} {self.sum!r}')
+        lines.append(f'{name}_count{labels} {total}')
+        return lines
+
+
+class Metrics:
+    '''
+    Runtime counters and histograms of a USBContainer.
+
+    Both engines update it as URBs are handled: URBs by busid, endpoint and
+    direction, transfer bytes, handler latency, send latency and connection
+    count.  Pending URB depth, interrupt scheduler deadlines and capture drops
+    are sampled from the container when render() produces the Prometheus
+    text exposition.  Updates are plain additions without a lock to keep them
+    off the hot path; a RET_SUBMIT sent from a producer thread racing the
+    serving thread may rarely lose a byte count, which is accepted.
+    '''
+
+    def __init__(self):
+        self.handler_latency = {}  # (busid, ep, direction) -> Histogram
+        self.send_latency = Histogram()
+        self.bytes_in = {}  # OUT transfer bytes received, by busid
+        self.bytes_out = {}  # IN transfer bytes sent, by busid
+        self.connections = 0
+
+    def observe_urb(self, usb_dev, usb_req, seconds):
+        key = (usb_dev.busid, usb_req.ep, usb_req.direction)
+        histogram = self.handler_latency.get(key)
+        if histogram is None:
+            histogram = self.handler_latency[key] = Histogram()
+        histogram.observe(seconds)
+        if usb_req.transfer_buffer is not None:
+            self.bytes_in[usb_dev.busid] = self.bytes_in.get(usb_dev.busid, 0) + len(usb_req.transfer_buffer)
+
+    def observe_ret(self, usb_dev, length):
+        if length:
+            self.bytes_out[usb_dev.busid] = self.bytes_out.get(usb_dev.busid, 0) + length
+
+    def observe_send(self, seconds):
+        self.send_latency.observe(seconds)
+
+    def connected(self, delta):
+        self.connections += delta
+
+    @staticmethod
+    def labels(key):
+        busid, ep, direction = key
+        return f'busid="{busid}",ep="{ep}",direction="{"in" if direction == USBIP_DIR_IN else "out"}"'
+
+    def render(self, container):
+        # Dictionaries are copied first as the engines may add keys meanwhile
+        handler_latency = sorted(self.handler_latency.copy().items())
+        lines = ['# TYPE usbip_urbs_total counter']
+        lines += [f'usbip_urbs_total{{{self.labels(key)}}} {sum(histogram.counts)}'
+                  for key, histogram in handler_latency]
+        lines.append('# TYPE usbip_handler_seconds histogram')
+        for key, histogram in handler_latency:
+            lines += histogram.render('usbip_handler_seconds', self.labels(key) + ',')
+        lines.append('# TYPE usbip_send_seconds histogram')
+        lines += self.send_latency.render('usbip_send_seconds')
+        lines.append('# TYPE usbip_received_bytes_total counter')
+        lines += [f'usbip_received_bytes_total{{busid="{busid}"}} {count}'
+                  for busid, count in sorted(self.bytes_in.copy().items())]
+        lines.append('# TYPE usbip_sent_bytes_total counter')
+        lines += [f'usbip_sent_bytes_total{{busid="{busid}"}} {count}'
+                  for busid, count in sorted(self.bytes_out.copy().items())]
+        lines.append('# TYPE usbip_connections gauge')
+        lines.append(f'usbip_connections {self.connections}')
+        lines.append('# TYPE usbip_pending_urbs gauge')
+        lines += [f'usbip_pending_urbs{{busid="{busid}"}} {pending()}'
+                  for busid, pending in sorted(container.sessions.copy().items())]
+        stats = container.scheduler.stats()
+        lines.append('# TYPE usbip_interrupt_endpoints gauge')
+        lines.append(f'usbip_interrupt_endpoints {stats["endpoints"]}')
+        lines.append('# TYPE usbip_interrupt_missed_deadlines_total counter')
+        lines.append(f'usbip_interrupt_missed_deadlines_total {stats["missed_deadlines"]}')
+        capture = container.capture
+        if capture is not None:
+            lines.append('# TYPE usbip_capture_dropped_total counter')
+            lines.append(f'usbip_capture_dropped_total {capture.dropped}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    # Serves GET /metrics for the container set on the server by serve_metrics()
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.container.metrics.render(self.server.container).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('metrics: ' + format, *args)
+
+
 def bytes_to_string(bytes):
     if bytes:
         return ''.join(["\\x{0:02x}".format(val) for val in bytes])
     return None
 
 
+class HexDump:
+    '''
+    Log argument that formats a buffer with bytes_to_string only when the
+    record is actually emitted.
+    '''
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return str(bytes_to_string(self.data))
+
+
+def log_cmd_submit(cmd, transfer_buffer):
+    logger.debug('CMD_SUBMIT seqnum=%x devid=%x direction=%x ep=%x flags=%x length=%d '
+                 'start_frame=%x number_of_packets=%x interval=%x setup=%s data=%s',
+                 cmd.seqnum, cmd.devid, cmd.direction, cmd.ep, cmd.transfer_flags,
+                 cmd.transfer_buffer_length, cmd.start_frame, cmd.number_of_packets,
+                 cmd.interval, HexDump(cmd.setup), HexDump(transfer_buffer))
+
+
+class SocketReader:
+    '''
+    Exact-length reader over a stream socket.
+
+    Data is received with recv_into into one preallocated bytearray, so a header
+    and its OUT payload usually arrive in a single syscall.  read(n) returns a
+    memoryview of exactly n bytes, valid until the next call to read().
+    on_refill is called before the buffer is compacted or recv may block.
+    '''
+
+    def __init__(self, sock, size=65536, on_refill=None):
+        self.sock = sock
+        self.on_refill = on_refill
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def _reserve(self, n):
+        available = self.end - self.start
+        if n > len(self.buffer):
+            # Views handed out earlier keep the old buffer alive, so grow by replacement.
+            self.buffer = bytearray(max(n, 2 * len(self.buffer)))
+            view = memoryview(self.buffer)
+            view[:available] = self.view[self.start:self.end]
+            self.view = view
+        elif available:
+            self.view[:available] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = available
+
+    def read(self, n):
+        if self.end - self.start < n:
+            if self.on_refill is not None:
+                self.on_refill()
+            if self.start + n > len(self.buffer):
+                self._reserve(n)
+            while self.end - self.start < n:
+                count = self.sock.recv_into(self.view[self.end:])
+                if not count:
+                    return None
+                self.end += count
+        data = self.view[self.start:self.start + n]
+        self.start += n
+        if self.start == self.end:
+            self.start = self.end = 0
+        return data
+
+
+class HandlerDispatcher:
+    '''
+    Runs the handlers of one attached device on its handler_executor() for the
+    blocking engine, so a handler that sleeps or waits on I/O does not stop
+    the connection from receiving and sending.
+
+    URBs are queued per endpoint and each queue is drained by one pool task
+    at a time, so an endpoint's handlers, and the responses they send, keep
+    submission order while other endpoints go on.  At most handler_queue
+    URBs are queued or running; submit() then calls on_block and waits for
+    one to finish.
+    '''
+
+    def __init__(self, usb_dev, on_block=None, metrics=None):
+        self.usb_dev = usb_dev
+        self.executor = usb_dev.handler_executor()
+        self.on_block = on_block
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(usb_dev.handler_queue)
+        self.queues = {}  # endpoint key -> URBs waiting for their handler
+        self.draining = set()  # endpoint keys with a pool task
+        self.count = 0  # URBs queued or running
+
+    def __len__(self):
+        return self.count
+
+    def submit(self, usb_req):
+        if usb_req.transfer_buffer is not None:
+            usb_req.transfer_buffer = bytes(usb_req.transfer_buffer)  # the reader's view ends at its next read
+        if not self.slots.acquire(blocking=False):
+            if self.on_block is not None:
+                self.on_block()
+            self.slots.acquire()
+        key = URBPipeline.endpoint_key(usb_req)
+        with self.lock:
+            self.count += 1
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = collections.deque()
+            queue.append(usb_req)
+            if key in self.draining:
+                return
+            self.draining.add(key)
+        self.executor.submit(self.drain, key, queue)
+
+    def drain(self, key, queue):
+        while 1:
+            with self.lock:
+                if not queue:
+                    self.draining.discard(key)
+                    return
+                usb_req = queue.popleft()
+            started = time.perf_counter()
+            try:
+                self.usb_dev.handle_usb_request(usb_req)
+            except Exception:
+                logger.exception('handler failed for seqnum=%x', usb_req.seqnum)
+            with self.lock:
+                self.count -= 1
+                if self.metrics is not None:
+                    self.metrics.observe_urb(self.usb_dev, usb_req, time.perf_counter() - started)
+            if usb_req.answered_inline():
+                usb_req.recycle()
+            self.slots.release()
+
+    def cancel(self, seqnum):
+        # True if the URB was still waiting for its handler
+        with self.lock:
+            for queue in self.queues.values():
+                for usb_req in queue:
+                    if usb_req.seqnum == seqnum:
+                        queue.remove(usb_req)
+                        self.count -= 1
+                        self.slots.release()
+                        usb_req.recycle()
+                        return True
+        return False
+
+    def close(self):
+        # Drops the URBs still waiting; handlers already running finish on their own
+        with self.lock:
+            for queue in self.queues.values():
+                self.count -= len(queue)
+                queue.clear()
+
+
 class USBContainer:
-    usb_devices = []
+    '''
+    Exports USB devices over USB/IP.
 
-    def add_usb_device(self, usb_device):
-        self.usb_devices.append(usb_device)
+    Responses to one connection are queued and written together.  tcp_nodelay
+    disables Nagle so each batch leaves at once, the lowest latency for HID.
+    tcp_cork (Linux) holds a batch until it is fully written so it leaves in
+    full segments, the highest throughput for bulk devices.
+
+    Runtime metrics are kept in self.metrics and can be scraped in Prometheus
+    text format once serve_metrics() is called.
+    '''
 
-    def handle_attach(self):
-        usb_dev = self.usb_devices[0]
+    DEVICES_PER_BUS = 126  # devnum 2..127, devnum 1 is the root hub
+
+    def __init__(self, tcp_nodelay=True, tcp_cork=False):
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_cork = tcp_cork
+        self.usb_devices = []
+        self.devices_by_busid = {}
+        self.devices_by_devid = {}
+        self.device_list_reply = None
+        self.scheduler = InterruptScheduler()
+        self.capture = None
+        self.metrics = Metrics()  # None turns metrics off
+        self.sessions = {}  # busid -> callable returning its pending URB depth
+
+    def add_usb_device(self, usb_device, busnum=None, devnum=None):
+        index = len(self.usb_devices)
+        if busnum is None:
+            busnum = 1 + index // self.DEVICES_PER_BUS
+        if devnum is None:
+            devnum = 2 + index % self.DEVICES_PER_BUS
+        busid = f'{busnum}-{devnum - 1}'
+        devid = (busnum << 16) | devnum
+        if busid in self.devices_by_busid or devid in self.devices_by_devid:
+            raise ValueError(f'bus position {busid} is already in use')
+        usb_device.busnum = busnum
+        usb_device.devnum = devnum
+        usb_device.busid = busid
+        usb_device.devid = devid
+        usb_device.container = self
+        self.usb_devices.append(usb_device)
+        self.devices_by_busid[busid] = usb_device
+        self.devices_by_devid[devid] = usb_device
+        self.invalidate_device_list()
+        if usb_device.materialized:  # otherwise on its first import
+            usb_device.schedule_endpoints(self.scheduler)
+
+    def invalidate_device_list(self):
+        self.device_list_reply = None
+
+    def enable_capture(self, path, **kwargs):
+        # Record all traffic to pcap files, see PcapCapture for the options
+        self.capture = PcapCapture(path, **kwargs)
+        return self.capture
+
+    def disable_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+
+    def serve_metrics(self, port=9240, ip='127.0.0.1'):
+        # Serve self.metrics as Prometheus text on http://ip:port/metrics from a daemon thread
+        server = http.server.ThreadingHTTPServer((ip, port), MetricsHandler)
+        server.daemon_threads = True
+        server.container = self
+        threading.Thread(target=server.serve_forever, name='usbip-metrics', daemon=True).start()
+        return server
+
+    def find_device(self, busid):
+        busid = bytes(busid).split(b'\0', 1)[0].decode('ascii', 'replace')
+        return self.devices_by_busid.get(busid)
+
+    def device_info(self, usb_dev):
         device_descriptor = usb_dev.device_descriptor
-        return OP_REP_Import(base=USBIPHeader(command=3, status=0),
-                             usbPath='/sys/devices/pci0000:00/0000:00:01.2/usb1/1-1'.encode('ascii'),
-                             busID='1-1'.encode('ascii'),
-                             busnum=1,
-                             devnum=2,
-                             speed=2,
-                             idVendor=device_descriptor.idVendor,
-                             idProduct=device_descriptor.idProduct,
-                             bcdDevice=device_descriptor.bcdDevice,
-                             bDeviceClass=device_descriptor.bDeviceClass,
-                             bDeviceSubClass=device_descriptor.bDeviceSubClass,
-                             bDeviceProtocol=device_descriptor.bDeviceProtocol,
-                             bConfigurationValue=usb_dev.configurations[0].bConfigurationValue,
-                             bNumConfigurations=device_descriptor.bNumConfigurations,
-                             bNumInterfaces=usb_dev.configurations[0].bNumInterfaces)
+        configuration = usb_dev.configurations[0]
+        return dict(usbPath=usb_dev.usb_path.encode('ascii'),
+                    busID=usb_dev.busid.encode('ascii'),
+                    busnum=usb_dev.busnum,
+                    devnum=usb_dev.devnum,
+                    speed=usb_dev.speed,
+                    idVendor=device_descriptor.idVendor,
+                    idProduct=device_descriptor.idProduct,
+                    bcdDevice=device_descriptor.bcdDevice,
+                    bDeviceClass=device_descriptor.bDeviceClass,
+                    bDeviceSubClass=device_descriptor.bDeviceSubClass,
+                    bDeviceProtocol=device_descriptor.bDeviceProtocol,
+                    bConfigurationValue=configuration.bConfigurationValue,
+                    bNumConfigurations=device_descriptor.bNumConfigurations,
+                    bNumInterfaces=configuration.bNumInterfaces)
+
+    def handle_attach(self, usb_dev):
+        return usb_dev.cached_descriptor('import', lambda: OP_REP_Import(base=USBIPHeader(command=3, status=0),
+                                                                          **self.device_info(usb_dev)).pack())
+
+    def handle_attach_error(self):
+        return USBIPHeader(command=3, status=1).pack()
+
+    def device_list_entry(self, usb_dev):
+        entry = bytearray(USBIPDeviceInfo(**self.device_info(usb_dev)).pack())
+        for interface in usb_dev.configurations[0].interfaces:
+            entry += USBInterface(bInterfaceClass=interface[0].bInterfaceClass,
+                                  bInterfaceSubClass=interface[0].bInterfaceSubClass,
+                                  bInterfaceProtocol=interface[0].bInterfaceProtocol).pack()
+        return entry
 
     def handle_device_list(self):
-        usb_dev = self.usb_devices[0]
-        device_descriptor = usb_dev.device_descriptor
-        return OP_REP_DevList(base=USBIPHeader(command=5, status=0),
-                              nExportedDevice=1,
-                              usbPath='/sys/devices/pci0000:00/0000:00:01.2/usb1/1-1'.encode('ascii'),
-                              busID='1-1'.encode('ascii'),
-                              busnum=1,
-                              devnum=2,
-                              speed=2,
-                              idVendor=device_descriptor.idVendor,
-                              idProduct=device_descriptor.idProduct,
-                              bcdDevice=device_descriptor.bcdDevice,
-                              bDeviceClass=device_descriptor.bDeviceClass,
-                              bDeviceSubClass=device_descriptor.bDeviceSubClass,
-                              bDeviceProtocol=device_descriptor.bDeviceProtocol,
-                              bConfigurationValue=usb_dev.configurations[0].bConfigurationValue,
-                              bNumConfigurations=device_descriptor.bNumConfigurations,
-                              bNumInterfaces=usb_dev.configurations[0].bNumInterfaces,
-                              interfaces=USBInterface(bInterfaceClass=usb_dev.configurations[0].interfaces[0][0].bInterfaceClass,
-                                                      bInterfaceSubClass=usb_dev.configurations[0].interfaces[0][0].bInterfaceSubClass,
-                                                      bInterfaceProtocol=usb_dev.configurations[0].interfaces[0][0].bInterfaceProtocol))
+        reply = self.device_list_reply
+        if reply is None:
+            reply = bytearray(OP_REP_DevList(base=USBIPHeader(command=5, status=0),
+                                             nExportedDevice=len(self.usb_devices)).pack())
+            for usb_dev in self.usb_devices:
+                reply += self.device_list_entry(usb_dev)
+            reply = self.device_list_reply = bytes(reply)
+        return reply
+
+    def handle_unlink(self, conn, unlink, status=0):
+        logger.debug('CMD_UNLINK seqnum=%x unlink_seqnum=%x status=%x', unlink.seqnum, unlink.unlink_seqnum, status)
+        conn.sendall(USBIP_RET_Unlink(seqnum=unlink.seqnum,
+                                      devid=unlink.devid,
+                                      status=status).pack())
+
+    @staticmethod
+    def is_iso_submit(usb_dev, cmd):
+        # Like the Linux stub, only isochronous endpoints read packet descriptors;
+        # other URBs may carry 0 or 0xffffffff in number_of_packets.
+        return (cmd.number_of_packets not in (0, 0xffffffff)
+                and usb_dev.transfer_type(cmd.ep, cmd.direction) == 1)
+
+    def handle_unknown_device(self, conn, cmd):
+        logger.warning('CMD_SUBMIT for unknown device seqnum=%x devid=%x', cmd.seqnum, cmd.devid)
+        conn.sendall(USBIP_RET_Submit(command=USBIP_RET_SUBMIT,
+                                      seqnum=cmd.seqnum,
+                                      devid=cmd.devid,
+                                      status=URB_STATUS_NODEV,
+                                      actual_length=0,
+                                      data=b'').pack())
 
     def run(self, ip='0.0.0.0', port=3240):
+        self.scheduler.start()
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((ip, port))
         s.listen()
-        attached = False
-        req = USBIPHeader()
         while 1:
             conn, addr = s.accept()
-            print('Connection address:', addr)
+            logger.info('connection from %s:%d', *addr[:2])
+            try:
+                self.handle_connection(conn)
+            except OSError as error:
+                logger.info('connection error: %s', error)
+            logger.info('connection closed')
+            conn.close()
+
+    def handle_connection(self, conn):
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.connected(1)
+        try:
+            self.serve_connection(conn, metrics)
+        finally:
+            self.sessions.clear()  # connections are served one at a time
+            if metrics is not None:
+                metrics.connected(-1)
+
+    def serve_connection(self, conn, metrics):
+        attached = None
+        req = USBIPHeader()
+        set_tcp_policy(conn, self.tcp_nodelay)
+        writes = WriteQueue(conn, self.tcp_cork, metrics)
+        reader = SocketReader(conn, on_refill=writes.flush)
+        cmd = USBIP_CMD_Submit()
+        cmd_size = cmd.size()
+        unlink = USBIP_CMD_Unlink()
+        dispatcher = None  # HandlerDispatcher of an attached device with handler_threads
+        try:
             while 1:
                 if not attached:
-                    data = conn.recv(8)
-                    if not data:
+                    data = reader.read(req.size())
+                    if data is None:
                         break
                     req.unpack(data)
-                    print('Header Packet')
-                    print('command:', hex(req.command))
+                    logger.debug('op command=%x', req.command)
                     if req.command == 0x8005:  # OP_REQ_DEVLIST
-                        print('list of devices')
-                        conn.sendall(self.handle_device_list().pack())
+                        logger.info('device list requested')
+                        writes.sendall(self.handle_device_list())
                     elif req.command == 0x8003:  # OP_REQ_IMPORT
-                        print('attach device')
-                        conn.recv(32)  # receive bus id
-                        conn.sendall(self.handle_attach().pack())
-                        attached = True
+                        busid = reader.read(32)
+                        if busid is None:
+                            break
+                        attached = self.find_device(busid)
+                        if attached is None:
+                            logger.warning('import of unknown busid=%r', bytes(busid).split(b'\0', 1)[0])
+                            writes.sendall(self.handle_attach_error())
+                            break
+                        logger.info('attach busid=%s', attached.busid)
+                        attached.materialize()
+                        attached.connection = writes
+                        if attached.handler_threads:
+                            dispatcher = HandlerDispatcher(attached, writes.flush, metrics)
+                            self.sessions[attached.busid] = lambda: len(dispatcher) + attached.pending_urbs()
+                        else:
+                            self.sessions[attached.busid] = attached.pending_urbs
+                        writes.sendall(self.handle_attach(attached))
                 else:
-                    print('----------------')
-                    print('handles requests')
-                    cmd = USBIP_CMD_Submit()
-                    cmd_header_data = conn.recv(cmd.size())
+                    cmd_header_data = reader.read(cmd_size)
+                    if cmd_header_data is None:
+                        break
+                    command = URB_PREFIX.unpack_from(cmd_header_data)[0]
+                    if command == USBIP_CMD_UNLINK:
+                        # Only URBs the device parked or its handler pool has yet to run can still be pending here
+                        unlink.unpack(cmd_header_data)
+                        unlinked = ((dispatcher is not None and dispatcher.cancel(unlink.unlink_seqnum))
+                                    or attached.handle_unlink(unlink.unlink_seqnum))
+                        self.handle_unlink(writes, unlink, URB_STATUS_UNLINKED if unlinked else 0)
+                        continue
+                    if command != USBIP_CMD_SUBMIT:
+                        logger.warning('unknown usbip command=%x, closing connection', command)
+                        break
                     cmd.unpack(cmd_header_data)
-                    transfer_buffer = conn.recv(cmd.transfer_buffer_length) if cmd.direction == USBIP_DIR_OUT else None
-                    print(f"usbip cmd {cmd.command:x}")
-                    print(f"usbip seqnum {cmd.seqnum:x}")
-                    print(f"usbip devid {cmd.devid:x}")
-                    print(f"usbip direction {cmd.direction:x}")
-                    print(f"usbip ep {cmd.ep:x}")
-                    print(f"usbip flags {cmd.transfer_flags:x}")
-                    print(f"usbip transfer buffer length {cmd.transfer_buffer_length:x}")
-                    print(f"usbip start {cmd.start_frame:x}")
-                    print(f"usbip number of packets {cmd.number_of_packets:x}")
-                    print(f"usbip interval {cmd.interval:x}")
-                    print(f"usbip setup {bytes_to_string(cmd.setup)}")
-                    print(f"usbip transfer buffer {bytes_to_string(transfer_buffer)}")
-                    usb_req = USBRequest(seqnum=cmd.seqnum,
-                                         devid=cmd.devid,
-                                         direction=cmd.direction,
-                                         ep=cmd.ep,
-                                         flags=cmd.transfer_flags,
-                                         numberOfPackets=cmd.number_of_packets,
-                                         interval=cmd.interval,
-                                         setup=cmd.setup,
-                                         transfer_buffer=transfer_buffer)
-                    self.usb_devices[0].connection = conn
-                    self.usb_devices[0].handle_usb_request(usb_req)
-            print('Close connection\n')
-            conn.close()
+                    transfer_buffer = iso_packets = None
+                    # OUT data and iso packet descriptors in one read, as a view is only valid until the next
+                    data_length = cmd.transfer_buffer_length if cmd.direction == USBIP_DIR_OUT else 0
+                    iso_length = cmd.number_of_packets * ISO_PACKET_SIZE if self.is_iso_submit(attached, cmd) else 0
+                    if data_length or iso_length:
+                        data = reader.read(data_length + iso_length)
+                        if data is None:
+                            break
+                        if data_length:
+                            transfer_buffer = data[:data_length]
+                        if iso_length:
+                            iso_packets = unpack_iso_packets(data[data_length:])
+                    if logger.isEnabledFor(logging.DEBUG):
+                        log_cmd_submit(cmd, transfer_buffer)
+                    usb_dev = self.devices_by_devid.get(cmd.devid)
+                    if usb_dev is not attached:
+                        self.handle_unknown_device(writes, cmd)
+                        continue
+                    usb_req = USBRequest.from_submit(cmd, transfer_buffer, iso_packets)
+                    if self.capture is not None:
+                        self.capture.submit(usb_dev, usb_req)
+                    if dispatcher is not None:
+                        dispatcher.submit(usb_req)
+                        continue
+                    if metrics is None:
+                        usb_dev.handle_usb_request(usb_req)
+                    else:
+                        started = time.perf_counter()
+                        usb_dev.handle_usb_request(usb_req)
+                        metrics.observe_urb(usb_dev, usb_req, time.perf_counter() - started)
+                    if usb_req.answered_inline():
+                        usb_req.recycle()
+        finally:
+            if dispatcher is not None:
+                dispatcher.close()
+            if attached is not None:
+                attached.detach()
+        writes.flush()
+
+
+class AsyncConnection:
+    '''
+    Socket-like sink given to USBDevice.connection by AsyncUSBContainer.
+
+    Handlers run on executor threads and call sendall() or sendmsg() as they
+    would on a socket; the buffers are queued for the session's writer task.  A RET_SUBMIT
+    passing through retires its seqnum from the session's URBPipeline.
+    '''
+
+    def __init__(self, loop, pipeline=None):
+        self.loop = loop
+        self.pipeline = pipeline
+        self.queue = asyncio.Queue()
+
+    def sendall(self, data):
+        self.loop.call_soon_threadsafe(self.push, [bytes(data)])
+
+    def sendmsg(self, buffers):
+        # Buffers are queued by reference and must not change until written
+        self.loop.call_soon_threadsafe(self.push, list(buffers))
+        return sum(len(buffer) for buffer in buffers)
+
+    def after_send(self, callback):
+        # Queued behind the buffers sent so far; the writer task calls it once they are written
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, callback)
+
+    def push(self, buffers):
+        if self.pipeline is not None and len(buffers[0]) >= URB_PREFIX.size:
+            command, seqnum = URB_PREFIX.unpack_from(buffers[0])
+            if command == USBIP_RET_SUBMIT and not self.pipeline.complete(seqnum):
+                return  # unlinked while its handler was running
+        self.queue.put_nowait(buffers)
+
+
+class URBPipeline:
+    '''
+    Pending-URB table of one attached session.
+
+    Submitted URBs are kept by seqnum until their RET_SUBMIT is sent or they are
+    unlinked, and are queued per endpoint.  Each endpoint queue is drained by its own task, so
+    a slow interrupt handler does not hold up endpoint 0 or other endpoints,
+    and responses leave in completion order.  Handlers of different endpoints
+    of one device may therefore run concurrently on executor threads.
+    '''
+
+    def __init__(self, usb_dev, loop):
+        self.usb_dev = usb_dev
+        self.loop = loop
+        self.pending = {}
+        self.queued = set()  # seqnums whose handler has not started
+        self.unlinked = set()
+        self.queues = {}
+        self.workers = []
+        # A device's handler_threads pool and handler_queue bound, or the loop's default executor
+        self.executor = usb_dev.handler_executor() if usb_dev.handler_threads else None
+        self.slots = asyncio.Semaphore(usb_dev.handler_queue) if usb_dev.handler_threads else None
+
+    @staticmethod
+    def endpoint_key(usb_req):
+        # Endpoint 0 is one bidirectional control pipe, others are per direction
+        return (usb_req.ep, usb_req.direction if usb_req.ep else USBIP_DIR_OUT)
+
+    def submit(self, usb_req):
+        self.pending[usb_req.seqnum] = usb_req
+        self.queued.add(usb_req.seqnum)
+        key = self.endpoint_key(usb_req)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = asyncio.Queue()
+            self.workers.append(self.loop.create_task(self.drain(queue)))
+        queue.put_nowait(usb_req)
+
+    def complete(self, seqnum):
+        if seqnum in self.unlinked:
+            self.unlinked.discard(seqnum)
+            return False
+        self.pending.pop(seqnum, None)
+        return True
+
+    def unlink(self, seqnum):
+        usb_req = self.pending.pop(seqnum, None)
+        if usb_req is None:
+            return False  # already answered
+        if seqnum in self.queued:
+            usb_req.transfer_buffer = None  # drain() skips it; a running handler may still be using it
+        elif not self.usb_dev.handle_unlink(seqnum):
+            # Its handler is running, or the device holds it without knowing: drop the RET_SUBMIT when it
+            # comes.  A device that forgot a parked URB never answers it, so its seqnum is not kept.
+            self.unlinked.add(seqnum)
+        return True
+
+    async def drain(self, queue):
+        while 1:
+            usb_req = await queue.get()
+            self.queued.discard(usb_req.seqnum)
+            if usb_req.seqnum not in self.pending:  # unlinked before it ran
+                if self.slots is not None:
+                    self.slots.release()
+                usb_req.recycle()
+                continue
+            started = time.perf_counter()
+            try:
+                inline = await self.loop.run_in_executor(self.executor, self.run_handler, usb_req)
+            finally:
+                if self.slots is not None:
+                    self.slots.release()
+            self.unlinked.discard(usb_req.seqnum)
+            metrics = self.usb_dev.container.metrics
+            if metrics is not None:
+                metrics.observe_urb(self.usb_dev, usb_req, time.perf_counter() - started)
+            if inline:
+                usb_req.recycle()
+
+    def run_handler(self, usb_req):
+        # On the executor; whether the handler answered the URB itself
+        self.usb_dev.handle_usb_request(usb_req)
+        return usb_req.answered_inline()
+
+    def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.pending.clear()
+        self.queued.clear()
+        self.unlinked.clear()
+
+
+class AsyncUSBContainer(USBContainer):
+    '''
+    asyncio server serving many USB/IP clients concurrently.
+
+    Each client may import one device by busid, provided no other client holds
+    it.  Its session then gets a reader task that parses CMD_SUBMIT into the
+    session's URBPipeline, which runs the device handlers on the default
+    executor, and a writer task that sends whatever the handlers queued.
+    '''
+
+    reuse_port = False  # SO_REUSEPORT, for several processes listening on one port
+
+    def __init__(self, tcp_nodelay=True, tcp_cork=False):
+        USBContainer.__init__(self, tcp_nodelay, tcp_cork)
+        self.attached_devices = set()
+
+    def claim_device(self, busid):
+        usb_dev = self.find_device(busid)
+        if usb_dev is None or usb_dev.busid in self.attached_devices:
+            return None
+        self.attached_devices.add(usb_dev.busid)
+        return usb_dev
+
+    def release_device(self, usb_dev):
+        self.attached_devices.discard(usb_dev.busid)
+
+    def hand_off(self, busid, writer):
+        # Passes an import to another server process; True if it took the connection
+        return False
+
+    async def handle_client(self, reader, writer, busid=None):
+        # busid is given for a connection handed off after its OP_REQ_IMPORT was read
+        logger.info('connection from %s:%d', *writer.get_extra_info('peername')[:2])
+        set_tcp_policy(writer.get_extra_info('socket'), self.tcp_nodelay)
+        usb_dev = None
+        if self.metrics is not None:
+            self.metrics.connected(1)
+        try:
+            req = USBIPHeader()
+            while busid is None:
+                req.unpack(await reader.readexactly(req.size()))
+                if req.command == 0x8005:  # OP_REQ_DEVLIST
+                    writer.write(self.handle_device_list())
+                    await writer.drain()
+                elif req.command == 0x8003:  # OP_REQ_IMPORT
+                    busid = await reader.readexactly(32)
+            if self.hand_off(busid, writer):
+                return
+            usb_dev = self.claim_device(busid)
+            writer.write(self.handle_attach_error() if usb_dev is None else self.handle_attach(usb_dev))
+            await writer.drain()
+            if usb_dev is not None:
+                logger.info('attach busid=%s', usb_dev.busid)
+                usb_dev.materialize()
+                await self.run_session(usb_dev, reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if usb_dev is not None:
+                self.release_device(usb_dev)
+            if self.metrics is not None:
+                self.metrics.connected(-1)
+            logger.info('connection closed')
+            writer.close()
+
+    async def run_session(self, usb_dev, reader, writer):
+        pipeline = URBPipeline(usb_dev, asyncio.get_running_loop())
+        connection = AsyncConnection(pipeline.loop, pipeline)
+        usb_dev.connection = connection
+        writer_task = asyncio.create_task(self.write_responses(connection, writer))
+        self.sessions[usb_dev.busid] = lambda: len(pipeline.pending)
+        try:
+            await self.read_requests(usb_dev, reader, pipeline, connection)
+        finally:
+            self.sessions.pop(usb_dev.busid, None)
+            pipeline.close()
+            usb_dev.detach()
+            writer_task.cancel()
+
+    async def read_requests(self, usb_dev, reader, pipeline, connection):
+        cmd = USBIP_CMD_Submit()
+        cmd_size = cmd.size()
+        unlink = USBIP_CMD_Unlink()
+        while 1:
+            data = await reader.readexactly(cmd_size)
+            command = URB_PREFIX.unpack_from(data)[0]
+            if command == USBIP_CMD_UNLINK:
+                unlink.unpack(data)
+                status = URB_STATUS_UNLINKED if pipeline.unlink(unlink.unlink_seqnum) else 0
+                self.handle_unlink(connection, unlink, status)
+                continue
+            if command != USBIP_CMD_SUBMIT:
+                logger.warning('unknown usbip command=%x, closing connection', command)
+                break
+            cmd.unpack(data)
+            transfer_buffer = None
+            if cmd.direction == USBIP_DIR_OUT and cmd.transfer_buffer_length:
+                transfer_buffer = await reader.readexactly(cmd.transfer_buffer_length)
+            iso_packets = None
+            if self.is_iso_submit(usb_dev, cmd):
+                iso_packets = unpack_iso_packets(await reader.readexactly(cmd.number_of_packets * ISO_PACKET_SIZE))
+            if logger.isEnabledFor(logging.DEBUG):
+                log_cmd_submit(cmd, transfer_buffer)
+            if self.devices_by_devid.get(cmd.devid) is not usb_dev:
+                self.handle_unknown_device(connection, cmd)
+                continue
+            usb_req = USBRequest.from_submit(cmd, transfer_buffer, iso_packets)
+            if self.capture is not None:
+                self.capture.submit(usb_dev, usb_req)
+            if pipeline.slots is not None:
+                await pipeline.slots.acquire()
+            pipeline.submit(usb_req)
+
+    async def write_responses(self, connection, writer):
+        # Everything completed since the last wakeup goes out in one write
+        sock = writer.get_extra_info('socket')
+        queue = connection.queue
+        while 1:
+            buffers = await queue.get()
+            callbacks = None  # after_send() callbacks, items of their own in the queue
+            if callable(buffers):
+                callbacks, buffers = [buffers], []
+            while not queue.empty():
+                item = queue.get_nowait()
+                if callable(item):
+                    callbacks = callbacks or []
+                    callbacks.append(item)
+                else:
+                    buffers += item
+            started = time.perf_counter()
+            if self.tcp_cork:
+                set_tcp_cork(sock, True)
+            writer.writelines(buffers)
+            if self.tcp_cork:
+                set_tcp_cork(sock, False)
+            await writer.drain()
+            if callbacks:
+                await self.drain_all(writer)
+            if self.metrics is not None:
+                self.metrics.observe_send(time.perf_counter() - started)
+            if callbacks:
+                for callback in callbacks:
+                    callback()
+
+    @staticmethod
+    async def drain_all(writer):
+        # drain() only waits for the buffer to fall below the low-water mark, and
+        # writelines() may keep the views themselves, not copies: wait until it is empty
+        transport = writer.transport
+        if transport.get_write_buffer_size():
+            limits = transport.get_write_buffer_limits()
+            transport.set_write_buffer_limits(0)
+            try:
+                await writer.drain()
+            finally:
+                transport.set_write_buffer_limits(limits[1], limits[0])
+
+    async def serve(self, ip='0.0.0.0', port=3240):
+        self.scheduler.start()
+        server = await asyncio.start_server(self.handle_client, ip, port, reuse_port=self.reuse_port)
+        async with server:
+            await server.serve_forever()
+
+    def run(self, ip='0.0.0.0', port=3240):
+        asyncio.run(self.serve(ip, port))
+
+
+class ShardedUSBContainer(AsyncUSBContainer):
+    '''
+    Supervisor forking worker processes that all listen on the port through
+    SO_REUSEPORT, so sessions spread over as many GILs as there are workers.
+    Linux only.
+
+    Devices are added to the supervisor as usual and dealt to the workers in
+    turn, worker index % workers owning the index-th device.  Before forking
+    the device list reply is written once into a shared memory catalog, so
+    whichever worker the kernel gives a connection answers OP_REQ_DEVLIST
+    with every device.  An OP_REQ_IMPORT for a device another worker owns is
+    handed off: the socket goes to the owner over a Unix socket with
+    SCM_RIGHTS and the owner replies and serves the session.
+
+    Devices are forked along with the supervisor, so they must not start
+    threads before run(); threads belong in create_state(), which runs in
+    the owning worker on the first import.  Each worker starts the interrupt
+    scheduler for its own shard.  Metrics are kept per worker.
+    '''
+
+    reuse_port = True
+
+    def __init__(self, workers=None, tcp_nodelay=True, tcp_cork=False):
+        AsyncUSBContainer.__init__(self, tcp_nodelay, tcp_cork)
+        self.workers = workers or os.cpu_count()
+        self.shard = None  # worker index in a worker process
+        self.owners = {}  # busid -> worker index
+        self.catalog = None
+        self.handoffs = []  # per worker, the Unix socket pair imports are handed off through
+
+    def handle_device_list(self):
+        if self.catalog is None:
+            return AsyncUSBContainer.handle_device_list(self)
+        return memoryview(self.catalog)
+
+    def hand_off(self, busid, writer):
+        owner = self.owners.get(bytes(busid).split(b'\0', 1)[0].decode('ascii', 'replace'))
+        if owner is None or owner == self.shard:
+            return False
+        # The owner gets its own descriptor for the socket; closing ours afterwards leaves the connection up
+        socket.send_fds(self.handoffs[owner][1], [bytes(busid)], [writer.get_extra_info('socket').fileno()])
+        logger.debug('import handed off to worker %d', owner)
+        return True
+
+    def receive_hand_off(self):
+        busid, fds, _, _ = socket.recv_fds(self.handoffs[self.shard][0], 32, 1)
+        sock = socket.socket(fileno=fds[0])
+        asyncio.get_running_loop().create_task(self.accept_hand_off(sock, busid))
+
+    async def accept_hand_off(self, sock, busid):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.handle_client(reader, writer, busid)
+
+    async def serve(self, ip='0.0.0.0', port=3240):
+        asyncio.get_running_loop().add_reader(self.handoffs[self.shard][0].fileno(), self.receive_hand_off)
+        await AsyncUSBContainer.serve(self, ip, port)
+
+    def run(self, ip='0.0.0.0', port=3240):
+        reply = AsyncUSBContainer.handle_device_list(self)
+        self.catalog = mmap.mmap(-1, len(reply))  # anonymous and shared, inherited by every worker
+        self.catalog.write(reply)
+        self.owners = {usb_dev.busid: index % self.workers for index, usb_dev in enumerate(self.usb_devices)}
+        self.handoffs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(self.workers)]
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        workers = {}
+        for shard in range(self.workers):
+            workers[self.spawn(shard, ip, port)] = shard, time.monotonic()
+        logger.info('%d workers serving %d devices on %s:%d', self.workers, len(self.usb_devices), ip, port)
+        try:
+            while 1:
+                pid, status = os.wait()
+                shard, started = workers.pop(pid)
+                logger.warning('worker %d exited with status %d', shard, os.waitstatus_to_exitcode(status))
+                if time.monotonic() - started < 1.0:
+                    raise RuntimeError(f'worker {shard} failed on startup')
+                workers[self.spawn(shard, ip, port)] = shard, time.monotonic()
+        finally:
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def spawn(self, shard, ip, port):
+        pid = os.fork()
+        if pid:
+            return pid
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.run_worker(shard, ip, port)
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        except BaseException:
+            logger.exception('worker %d failed', shard)
+        finally:
+            os._exit(status)
+
+    def run_worker(self, shard, ip, port):
+        self.shard = shard
+        owned = [usb_dev for usb_dev in self.usb_devices if self.owners[usb_dev.busid] == shard]
+        self.devices_by_busid = {usb_dev.busid: usb_dev for usb_dev in owned}
+        self.devices_by_devid = {usb_dev.devid: usb_dev for usb_dev in owned}
+        self.scheduler = InterruptScheduler()
+        for usb_dev in owned:
+            if usb_dev.materialized:
+                usb_dev.schedule_endpoints(self.scheduler)
+        for index, (receiver, _) in enumerate(self.handoffs):
+            if index != shard:
+                receiver.close()
+        AsyncUSBContainer.run(self, ip, port)
@@ -0,0 +1,122 @@
+import os
+import socket
+import threading
+import time
+import tracemalloc
+import USBIP
+from USBIP import USBContainer, USBIPHeader, USBIP_CMD_Submit, USBIP_DIR_IN
+from bench_common import BenchDevice, interrupt_in
+
+# Python allocations per URB on the USBContainer.run() path, for GET_DESCRIPTOR
+# control URBs and interrupt IN URBs.  A client preloads URBS requests into
+# a loopback connection and serve_connection() answers them in-process.  tracemalloc
+# is restarted after each RET_SUBMIT is queued and a snapshot taken at the
+# next one, so it holds the blocks allocated in USBIP.py for that URB and
+# still live while it is answered: the request, the parsed control request,
+# the RET_SUBMIT header and so on.  Blocks freed before that point, such as
+# struct.unpack tuples, are not counted.  URB/s is the same run with
+# tracemalloc off.
+
+URBS = 2000
+WARMUP = 200
+TOP_SITES = 4
+DEVID = (1 << 16) | 2  # busid 1-1, the first device added
+
+IMPORT_REQUEST = USBIPHeader(command=0x8003, status=0).pack() + b'1-1'.ljust(32, b'\0')
+GET_DEVICE_DESCRIPTOR = bytes((0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 18, 0x00))
+ENGINE_FILTER = [tracemalloc.Filter(True, USBIP.__file__)]
+
+
+def control_in(seqnum, devid):
+    return USBIP_CMD_Submit(command=0x1, seqnum=seqnum, devid=devid, direction=USBIP_DIR_IN, ep=0,
+                            transfer_flags=0, transfer_buffer_length=18, start_frame=0,
+                            number_of_packets=0, interval=0, setup=GET_DEVICE_DESCRIPTOR).pack()
+
+
+class Probe:
+    # Stands in for the WriteQueue as the device's connection
+    def __init__(self, writes, samples):
+        self.writes = writes
+        self.samples = samples
+
+    def sendall(self, data):
+        self.sendmsg([bytes(data)])
+
+    def sendmsg(self, buffers):
+        size = self.writes.sendmsg(buffers)
+        if self.samples is not None:
+            if tracemalloc.is_tracing():
+                self.samples.append(tracemalloc.take_snapshot().filter_traces(ENGINE_FILTER))
+                tracemalloc.stop()
+            tracemalloc.start()
+        return size
+
+
+class ProbeDevice(BenchDevice):
+    samples = None
+
+    @property
+    def connection(self):
+        return self.probe
+
+    @connection.setter
+    def connection(self, writes):
+        self.probe = Probe(writes, self.samples)
+
+
+def serve(make_urb, samples=None):
+    usb_dev = ProbeDevice()
+    usb_dev.samples = samples
+    container = USBContainer()
+    container.add_usb_device(usb_dev)
+    listener = socket.create_server(('127.0.0.1', 0))
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    # The requests are all sent up front; a thread discards the replies so the server never blocks
+    requests = IMPORT_REQUEST + b''.join(make_urb(seqnum, DEVID) for seqnum in range(1, URBS + 1))
+    sender = threading.Thread(target=client.sendall, args=(requests,))
+    receiver = threading.Thread(target=discard, args=(client,))
+    sender.start()
+    receiver.start()
+    sender.join()
+    client.shutdown(socket.SHUT_WR)
+    started = time.perf_counter()
+    container.serve_connection(server, None)
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+    server.close()
+    receiver.join()
+    client.close()
+    return URBS / elapsed
+
+
+def discard(sock):
+    buffer = bytearray(1 << 16)
+    while sock.recv_into(buffer):
+        pass
+
+
+def main():
+    print(f"{URBS} URBs per run, snapshots after the first {WARMUP}")
+    print(f"{'URB':>10}{'blocks/URB':>12}{'bytes/URB':>11}{'URB/s':>10}  top allocation sites")
+    for name, make_urb in (('control', control_in), ('interrupt', interrupt_in)):
+        rate = max(serve(make_urb) for _ in range(3))
+        samples = []
+        serve(make_urb, samples)
+        samples = samples[WARMUP:]
+        blocks = sum(len(snapshot.traces) for snapshot in samples) / len(samples)
+        size = sum(sum(trace.size for trace in snapshot.traces) for snapshot in samples) / len(samples)
+        sites = {}
+        for snapshot in samples:
+            for stat in snapshot.statistics('lineno'):
+                frame = stat.traceback[0]
+                site = f'{os.path.basename(frame.filename)}:{frame.lineno}'
+                sites[site] = sites.get(site, 0) + stat.count
+        top = sorted(sites.items(), key=lambda item: -item[1])[:TOP_SITES]
+        described = ', '.join(f'{site} {count / len(samples):.2f}' for site, count in top)
+        print(f"{name:>10}{blocks:>12.2f}{size:>11.0f}{rate:>10,.0f}  {described}")
+
+
+if __name__ == '__main__':
+    main()
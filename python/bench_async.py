@@ -0,0 +1,40 @@
+import asyncio
+import multiprocessing
+from USBIP import AsyncUSBContainer
+from bench_common import BenchDevice, wait_for_port, free_port
+from loadgen import run_load
+
+# Aggregate URB/s of AsyncUSBContainer with 1, 10 and 100 concurrent sessions.
+# The server runs in its own process; each loadgen connection imports one
+# device and keeps WINDOW interrupt IN URBs in flight for DURATION seconds.
+
+DURATION = 3.0
+WINDOW = 8
+SESSIONS = (1, 10, 100)
+
+
+def serve(port, devices):
+    container = AsyncUSBContainer()
+    for _ in range(devices):
+        container.add_usb_device(BenchDevice())
+    container.run(ip='127.0.0.1', port=port)
+
+
+def main():
+    print(f"{'sessions':>8}{'URB/s':>14}{'p50 ms':>10}{'p99 ms':>10}")
+    for sessions in SESSIONS:
+        port = free_port()
+        server = multiprocessing.Process(target=serve, args=(port, sessions), daemon=True)
+        server.start()
+        try:
+            wait_for_port(port)
+            rate, percentiles, _ = asyncio.run(run_load(port=port, connections=sessions,
+                                                        duration=DURATION, window=WINDOW))
+            print(f"{sessions:>8}{rate:>14,.0f}{percentiles['p50'] * 1000:>10.2f}{percentiles['p99'] * 1000:>10.2f}")
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
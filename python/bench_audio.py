@@ -0,0 +1,116 @@
+import math
+import multiprocessing
+import os
+import struct
+import tempfile
+import time
+import wave
+from USBIP import USBContainer, AsyncUSBContainer, USBIP_CMD_Submit, USBIP_DIR_IN, USBIP_DIR_OUT, ISO_PACKET_SIZE
+from bench_common import import_device, recv_exact, wait_for_port, free_port, RET_SIZE
+from replay import load_device_class
+
+# Timing of the usb-audio.py streams as a host sees it.  The client keeps
+# WINDOW iso URBs of PACKETS 1 ms packets in flight on the microphone (IN) or
+# the speaker (OUT) and timestamps every RET_SUBMIT.  Rate is the measured
+# byte rate, drift the deviation of the completion period, fitted over all
+# completions, from the nominal PACKETS ms in ppm, and jitter how far each
+# completion lands from the ideal schedule first + n * PACKETS ms, at
+# p50/p99/max.
+
+DURATION = 5.0
+WINDOW = 4
+PACKETS = 8
+RATE = 48000
+CHANNELS = 2
+PACKET_SIZE = RATE // 1000 * CHANNELS * 2
+ENGINES = (('run()', USBContainer), ('async', AsyncUSBContainer))
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usb-audio.py')
+
+
+def write_tone(path, seconds=1.0):
+    samples = b''.join(struct.pack('<h', int(8000 * math.sin(2 * math.pi * 440 * n / RATE))) * CHANNELS
+                       for n in range(int(RATE * seconds)))
+    with wave.open(path, 'wb') as tone:
+        tone.setnchannels(CHANNELS)
+        tone.setsampwidth(2)
+        tone.setframerate(RATE)
+        tone.writeframes(samples)
+
+
+def serve(port, engine, microphone, speaker):
+    audio_class = load_device_class(MODULE, 'USBAudio')
+    wav_source = load_device_class(MODULE, 'WavSource')
+    container = engine()
+    container.add_usb_device(audio_class(wav_source(microphone), speaker))
+    container.run(ip='127.0.0.1', port=port)
+
+
+def iso_submit(seqnum, devid, direction):
+    ep = 2 if direction == USBIP_DIR_IN else 1
+    length = PACKETS * PACKET_SIZE
+    header = USBIP_CMD_Submit(command=0x1, seqnum=seqnum, devid=devid, direction=direction, ep=ep,
+                              transfer_flags=0x2, transfer_buffer_length=length, start_frame=0,
+                              number_of_packets=PACKETS, interval=1, setup=bytes(8)).pack()
+    data = bytes(length) if direction == USBIP_DIR_OUT else b''
+    descriptors = b''.join(struct.pack('>IIII', index * PACKET_SIZE, PACKET_SIZE, 0, 0) for index in range(PACKETS))
+    return header + data + descriptors
+
+
+def stream(port, direction, duration):
+    sock, devid = import_device(port)
+    seqnum = 0
+    for _ in range(WINDOW):
+        seqnum += 1
+        sock.sendall(iso_submit(seqnum, devid, direction))
+    arrivals = []
+    received = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        header = recv_exact(sock, RET_SIZE)
+        arrivals.append(time.monotonic())
+        actual_length, _, number_of_packets = struct.unpack_from('>III', header, 24)
+        if direction == USBIP_DIR_IN:
+            recv_exact(sock, actual_length)
+        recv_exact(sock, number_of_packets * ISO_PACKET_SIZE)
+        received += actual_length
+        seqnum += 1
+        sock.sendall(iso_submit(seqnum, devid, direction))
+    sock.close()
+    # The first WINDOW completions include the stream start, measure from the last of them
+    arrivals = arrivals[WINDOW - 1:]
+    first = arrivals[0]
+    rate = (len(arrivals) - 1) * PACKETS * PACKET_SIZE / (arrivals[-1] - first)
+    # Least squares slope of completion time over completion index
+    count = len(arrivals)
+    mean_index = (count - 1) / 2
+    mean_time = sum(arrivals) / count
+    period = (sum((index - mean_index) * (arrival - mean_time) for index, arrival in enumerate(arrivals))
+              / sum((index - mean_index) ** 2 for index in range(count)))
+    drift = (PACKETS / 1000 - period) / period * 1e6  # positive when faster than nominal
+    jitter = sorted(abs(arrival - first - index * PACKETS / 1000) for index, arrival in enumerate(arrivals))
+    return rate, drift, [jitter[int(q * (len(jitter) - 1))] * 1000 for q in (0.5, 0.99, 1.0)]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        microphone = os.path.join(directory, 'tone.wav')
+        speaker = os.path.join(directory, 'speaker.wav')
+        write_tone(microphone)
+        print(f"{'engine':>8}{'stream':>12}{'KB/s':>10}{'drift ppm':>12}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+        for name, engine in ENGINES:
+            for label, direction in (('microphone', USBIP_DIR_IN), ('speaker', USBIP_DIR_OUT)):
+                port = free_port()
+                server = multiprocessing.Process(target=serve, args=(port, engine, microphone, speaker), daemon=True)
+                server.start()
+                try:
+                    wait_for_port(port)
+                    rate, drift, (p50, p99, worst) = stream(port, direction, DURATION)
+                    print(f"{name:>8}{label:>12}{rate / 1000:>10,.1f}{drift:>12,.0f}{p50:>9.2f}{p99:>9.2f}{worst:>9.2f}")
+                finally:
+                    server.terminate()
+                    server.join()
+
+
+if __name__ == '__main__':
+    main()
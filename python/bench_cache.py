@@ -0,0 +1,181 @@
+import os
+import random
+import tempfile
+import time
+from USBIP import BlockCache
+from replay import load_device_class
+
+# Throughput and hit rate of BlockCache over the pread/pwrite FileImage of
+# mass-storage.py, against the FileImage alone.  Workloads are 4 KB SCSI
+# sized requests: a sequential read stream, uniform random reads, random
+# reads where 90% fall in a 10% hot region, and uniform random writes.  Write
+# runs end with one flush() so write-back is included.
+#
+# Each runs twice: on the image file as is, where every uncached request is a
+# pread/pwrite served from the OS page cache, and with BACKEND_LATENCY added
+# to every image request, like storage behind a network or a slow card.  In
+# the first case a Python-level cache costs more than the system call it
+# saves; the second shows what it is for.
+#
+# Before measuring, verify() checks the cache against a plain bytearray
+# under mixed sequential and random reads and writes, with the cache only as
+# large as one read-ahead load so loads keep evicting dirty chunks.
+
+DURATION = 2.0
+BACKEND_LATENCY = 0.0002
+IMAGE_SIZE = 64 << 20
+CACHE_SIZE = 16 << 20
+REQUEST_BLOCKS = 8  # 4 KB
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mass-storage.py')
+
+
+class SlowImage:
+    # Adds a fixed latency to each request of a wrapped image
+
+    def __init__(self, image, latency):
+        self.image = image
+        self.latency = latency
+        self.block_size = image.block_size
+        self.block_count = image.block_count
+        self.read_only = image.read_only
+
+    def read(self, lba, count):
+        time.sleep(self.latency)
+        return self.image.read(lba, count)
+
+    def write(self, offset, data):
+        time.sleep(self.latency)
+        self.image.write(offset, data)
+
+    def flush(self):
+        self.image.flush()
+
+    def close(self):
+        self.image.close()
+
+
+def sequential(block_count, rng):
+    lba = 0
+    while 1:
+        if lba + REQUEST_BLOCKS > block_count:
+            lba = 0
+        yield lba
+        lba += REQUEST_BLOCKS
+
+
+def uniform(block_count, rng):
+    while 1:
+        yield rng.randrange(block_count // REQUEST_BLOCKS) * REQUEST_BLOCKS
+
+
+def hot(block_count, rng):
+    hot_requests = block_count // REQUEST_BLOCKS // 10
+    while 1:
+        if rng.random() < 0.9:
+            yield rng.randrange(hot_requests) * REQUEST_BLOCKS
+        else:
+            yield rng.randrange(block_count // REQUEST_BLOCKS) * REQUEST_BLOCKS
+
+
+WORKLOADS = (('seq-read', sequential, False),
+             ('rand-read', uniform, False),
+             ('hot-read', hot, False),
+             ('rand-write', uniform, True))
+
+
+def measure(image, pattern, write):
+    lbas = pattern(image.block_count, random.Random(1))
+    payload = os.urandom(REQUEST_BLOCKS * image.block_size)
+    done = 0
+    start = time.perf_counter()
+    deadline = start + DURATION
+    while time.perf_counter() < deadline:
+        for _ in range(256):
+            lba = next(lbas)
+            if write:
+                image.write(lba * image.block_size, payload)
+            else:
+                image.read(lba, REQUEST_BLOCKS)
+        done += 256
+    image.flush()
+    elapsed = time.perf_counter() - start
+    return done / elapsed, done * len(payload) / elapsed / 1e6
+
+
+class MemoryImage:
+    # Image in a bytearray, the reference verify() compares the cache with
+
+    block_size = 512
+    read_only = False
+
+    def __init__(self, block_count):
+        self.block_count = block_count
+        self.data = bytearray(block_count * self.block_size)
+
+    def read(self, lba, count):
+        return bytes(self.data[lba * self.block_size:(lba + count) * self.block_size])
+
+    def write(self, offset, data):
+        self.data[offset:offset + len(data)] = data
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def verify(operations=20000, chunk_blocks=8, read_ahead=8):
+    # Every read through the cache, and the image after each flush, must match the reference
+    rng = random.Random(2)
+    image = MemoryImage(64 * chunk_blocks)
+    reference = bytearray(len(image.data))
+    cache = BlockCache(image, capacity=(read_ahead + 1) * chunk_blocks * image.block_size,
+                       chunk_blocks=chunk_blocks, read_ahead=read_ahead)
+    lba = 0
+    for operation in range(operations):
+        if rng.random() < 0.5:
+            lba = rng.randrange(image.block_count)  # otherwise continue the previous request
+        count = min(rng.randint(1, 2 * chunk_blocks), image.block_count - lba)
+        offset, size = lba * image.block_size, count * image.block_size
+        if rng.random() < 0.3:
+            data = rng.randbytes(size)
+            cache.write(offset, data)
+            reference[offset:offset + size] = data
+        elif bytes(cache.read(lba, count)) != reference[offset:offset + size]:
+            raise AssertionError(f'stale read of {count} blocks at {lba} after {operation} operations')
+        lba = (lba + count) % image.block_count
+        if operation % 1000 == 999:
+            cache.flush()
+            if image.data != reference:
+                raise AssertionError(f'image differs from the writes after {operation} operations')
+    cache.close()
+    print(f"verified {operations} operations against a {cache.capacity} chunk cache")
+
+
+def main():
+    verify()
+    file_image = load_device_class(MODULE, 'FileImage')
+    with tempfile.NamedTemporaryFile(suffix='.img') as path:
+        path.write(os.urandom(IMAGE_SIZE))
+        path.flush()
+        for latency in (0, BACKEND_LATENCY):
+            print(f"backend latency {latency * 1e6:.0f} us")
+            print(f"{'workload':>10}{'layer':>10}{'ops/s':>12}{'MB/s':>10}{'hit rate':>10}")
+            for name, pattern, write in WORKLOADS:
+                image = SlowImage(file_image(path.name), latency) if latency else file_image(path.name)
+                ops, rate = measure(image, pattern, write)
+                image.close()
+                print(f"{name:>10}{'uncached':>10}{ops:>12,.0f}{rate:>10,.1f}{'-':>10}")
+                image = SlowImage(file_image(path.name), latency) if latency else file_image(path.name)
+                cache = BlockCache(image, capacity=CACHE_SIZE)
+                ops, rate = measure(cache, pattern, write)
+                stats = cache.stats()
+                cache.close()
+                hit_rate = f"{stats['hit_rate']:.1%}" if stats['hits'] + stats['misses'] else '-'
+                print(f"{name:>10}{'cached':>10}{ops:>12,.0f}{rate:>10,.1f}{hit_rate:>10}")
+
+
+if __name__ == '__main__':
+    main()
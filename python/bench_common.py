@@ -0,0 +1,127 @@
+import socket
+import struct
+import time
+from USBIP import (USBDevice, DeviceDescriptor, DeviceConfiguration, InterfaceDescriptor,
+                   EndpointDescriptor, USBIPHeader, USBIP_CMD_Submit, USBIP_RET_Submit,
+                   OP_REP_Import, USBIP_DIR_IN)
+
+# Shared fixtures for the bench_*.py scripts: a device that answers every
+# interrupt IN immediately and a few raw USB/IP client helpers.
+
+
+bench_endpoint = EndpointDescriptor(bEndpointAddress=0x81,
+                                    bmAttributes=0x3,
+                                    wMaxPacketSize=0x0008,
+                                    bInterval=0x01)
+
+bench_interface = InterfaceDescriptor(bAlternateSetting=0,
+                                      bNumEndpoints=1,
+                                      bInterfaceClass=0xff,
+                                      bInterfaceSubClass=0,
+                                      bInterfaceProtocol=0,
+                                      iInterface=0)
+bench_interface.endpoints = [bench_endpoint]
+
+bench_configuration = DeviceConfiguration(wTotalLength=0x0019,
+                                          bNumInterfaces=0x1,
+                                          bConfigurationValue=1,
+                                          iConfiguration=0x0,
+                                          bmAttributes=0x80,
+                                          bMaxPower=50)
+bench_configuration.interfaces = [[bench_interface]]
+
+bench_device_descriptor = DeviceDescriptor(bDeviceClass=0x0,
+                                           bDeviceSubClass=0x0,
+                                           bDeviceProtocol=0x0,
+                                           bMaxPacketSize0=0x8,
+                                           idVendor=0x2706,
+                                           idProduct=0x0001,
+                                           bcdDevice=0x0,
+                                           bNumConfigurations=1)
+
+REPORT = bytes(8)
+
+
+class BenchDevice(USBDevice):
+    configurations = [bench_configuration]
+    device_descriptor = bench_device_descriptor
+
+    def handle_data(self, usb_req):
+        self.send_usb_ret(usb_req, REPORT, len(REPORT))
+
+    def handle_device_specific_control(self, control_req, usb_req):
+        self.send_usb_ret(usb_req, b'', 0)
+
+
+IMPORT_REQUEST = USBIPHeader(command=0x8003, status=0).pack()
+IMPORT_REPLY_SIZE = OP_REP_Import().size()
+RET_SIZE = USBIP_RET_Submit().size()
+
+
+def interrupt_in(seqnum, devid=0, ep=1, length=8):
+    return USBIP_CMD_Submit(command=0x1, seqnum=seqnum, devid=devid, direction=USBIP_DIR_IN, ep=ep,
+                            transfer_flags=0, transfer_buffer_length=length, start_frame=0,
+                            number_of_packets=0, interval=1, setup=bytes(8)).pack()
+
+
+def ret_length(header):
+    # actual_length of a RET_SUBMIT header
+    return struct.unpack_from('>I', header, 24)[0]
+
+
+def recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('server closed the connection')
+        data += chunk
+    return data
+
+
+def import_device(port, index=0, ip='127.0.0.1'):
+    # Import the index-th device of a container; returns the socket and devid
+    busnum, devnum = 1, index + 2  # matches USBContainer.add_usb_device numbering
+    sock = socket.create_connection((ip, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(IMPORT_REQUEST + f'{busnum}-{devnum - 1}'.encode('ascii').ljust(32, b'\0'))
+    recv_exact(sock, IMPORT_REPLY_SIZE)
+    return sock, (busnum << 16) | devnum
+
+
+def interrupt_flood(port, duration, window=8, index=0):
+    # URB/s of one blocking client keeping window interrupt IN URBs in flight
+    sock, devid = import_device(port, index)
+    seqnum = 0
+    for _ in range(window):
+        seqnum += 1
+        sock.sendall(interrupt_in(seqnum, devid))
+    done = 0
+    start = time.monotonic()
+    deadline = start + duration
+    while time.monotonic() < deadline:
+        header = recv_exact(sock, RET_SIZE)
+        recv_exact(sock, ret_length(header))
+        done += 1
+        seqnum += 1
+        sock.sendall(interrupt_in(seqnum, devid))
+    elapsed = time.monotonic() - start
+    sock.close()
+    return done / elapsed
+
+
+def wait_for_port(port, ip='127.0.0.1', timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((ip, port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'server did not listen on {ip}:{port}')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
@@ -0,0 +1,70 @@
+import copy
+import gc
+import os
+import time
+import tracemalloc
+from USBIP import USBContainer
+from replay import load_device_class
+
+# Memory per device and startup time for DEVICES hid-mouse.py devices in one
+# USBContainer.  'listed' devices are only added, as for a fleet nobody has
+# imported yet; 'imported' devices have also been materialized, as on their
+# first OP_REQ_IMPORT.  'own trees' deep-copies the descriptor tree for each
+# device, as a script building its descriptors in __init__ would, so nothing
+# is shared.  Startup is timed with tracemalloc off; memory is what
+# tracemalloc still sees allocated afterwards.  The first OP_REQ_DEVLIST
+# reply is built with the fleet, since every client asks for it.
+
+DEVICES = 10000
+
+HID_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hid-mouse.py')
+USBHID = load_device_class(HID_MODULE, 'USBHID')
+
+
+class OwnTreeHID(USBHID):
+
+    def __init__(self):
+        self.configurations = copy.deepcopy(USBHID.configurations)
+        self.device_descriptor = copy.deepcopy(USBHID.device_descriptor)
+        USBHID.__init__(self)
+
+
+def build(device_class, imported):
+    container = USBContainer()
+    for _ in range(DEVICES):
+        container.add_usb_device(device_class())
+    container.handle_device_list()
+    if imported:
+        for usb_dev in container.usb_devices:
+            usb_dev.materialize()
+    return container
+
+
+def measure(device_class, imported):
+    gc.collect()
+    start = time.perf_counter()
+    container = build(device_class, imported)
+    elapsed = time.perf_counter() - start
+    del container
+    gc.collect()
+    tracemalloc.start()
+    container = build(device_class, imported)
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del container
+    return elapsed, memory / DEVICES
+
+
+def main():
+    print(f"{DEVICES} devices")
+    print(f"{'descriptors':>12}{'state':>10}{'startup ms':>12}{'B/device':>10}")
+    for name, device_class in (('shared', USBHID), ('own trees', OwnTreeHID)):
+        for imported in (False, True):
+            elapsed, per_device = measure(device_class, imported)
+            state = 'imported' if imported else 'listed'
+            print(f"{name:>12}{state:>10}{elapsed * 1000:>12,.0f}{per_device:>10,.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import timeit
+from USBIP import BaseStructure, unpack_iso_packets, pack_iso_packets, ISO_PACKET_SIZE
+
+# Cost of decoding and encoding the iso packet descriptors of one URB:
+# one BaseStructure per packet versus the flat array('I') used by the
+# server.  8 packets is one high-speed microframe's worth per millisecond.
+
+PACKET_COUNTS = (8, 64, 256)
+
+
+class IsoPacketDescriptor(BaseStructure):
+    _byte_order_ = '>'
+    _fields_ = [
+        ('offset', 'I'),
+        ('length', 'I'),
+        ('actual_length', 'I'),
+        ('status', 'i'),
+    ]
+
+
+def per_packet_decode(data, count):
+    packets = []
+    for index in range(count):
+        packet = IsoPacketDescriptor()
+        packet.unpack_from(data, index * ISO_PACKET_SIZE)
+        packets.append(packet)
+    return packets
+
+
+def per_packet_encode(packets):
+    return b''.join(packet.pack() for packet in packets)
+
+
+def ops_per_sec(func, number):
+    return number / min(timeit.repeat(func, number=number, repeat=3))
+
+
+def main(number=5000):
+    print(f"{'packets':>8}{'op':>8}{'per packet':>14}{'array':>14}{'speedup':>10}")
+    for count in PACKET_COUNTS:
+        data = b''.join(IsoPacketDescriptor(offset=index * 192, length=192, actual_length=0, status=0).pack()
+                        for index in range(count))
+        objects = per_packet_decode(data, count)
+        packets = unpack_iso_packets(data)
+        cases = [
+            ('decode', lambda: per_packet_decode(data, count), lambda: unpack_iso_packets(data)),
+            ('encode', lambda: per_packet_encode(objects), lambda: pack_iso_packets(packets)),
+        ]
+        for name, before, after in cases:
+            old = ops_per_sec(before, number)
+            new = ops_per_sec(after, number)
+            print(f"{count:>8}{name:>8}{old:>14,.0f}{new:>14,.0f}{new / old:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import logging
+import multiprocessing
+import os
+from USBIP import USBContainer
+from bench_common import BenchDevice, interrupt_flood, wait_for_port, free_port
+
+# URB throughput of the blocking USBContainer.run() engine with logging off,
+# at INFO and at DEBUG.  Records are formatted and written to os.devnull, so
+# the figures show the cost of the logging calls, not of a terminal.
+
+DURATION = 3.0
+LEVELS = (('off', logging.CRITICAL + 1), ('info', logging.INFO), ('debug', logging.DEBUG))
+
+
+def serve(port, level):
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logging.basicConfig(level=level, handlers=[handler])
+    container = USBContainer()
+    container.add_usb_device(BenchDevice())
+    container.run(ip='127.0.0.1', port=port)
+
+
+def main():
+    print(f"{'logging':>8}{'URB/s':>14}")
+    for name, level in LEVELS:
+        port = free_port()
+        server = multiprocessing.Process(target=serve, args=(port, level), daemon=True)
+        server.start()
+        try:
+            wait_for_port(port)
+            rate = interrupt_flood(port, DURATION)
+            print(f"{name:>8}{rate:>14,.0f}")
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
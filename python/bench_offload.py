@@ -0,0 +1,98 @@
+import multiprocessing
+import struct
+import time
+from USBIP import USBContainer, AsyncUSBContainer, USBIP_CMD_Submit, USBIP_DIR_IN
+from bench_common import BenchDevice, REPORT, import_device, interrupt_in, recv_exact, ret_length, wait_for_port, free_port, RET_SIZE
+
+# Control request latency on a device whose interrupt IN handler blocks for
+# HANDLER_SLEEP, with handlers run inline and on a handler_threads pool, for
+# both engines.  The client keeps WINDOW slow URBs in flight on endpoint 1 and
+# sends GET_DESCRIPTOR requests on endpoint 0 one at a time; inline on the
+# blocking engine each waits behind the slow handlers.  The slow endpoint's
+# RET_SUBMITs are checked to arrive in submission order.
+
+DURATION = 3.0
+WINDOW = 4
+HANDLER_SLEEP = 0.01
+POOL_THREADS = 4
+ENGINES = (('run()', USBContainer), ('async', AsyncUSBContainer))
+
+GET_DEVICE_DESCRIPTOR = bytes((0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 18, 0x00))
+
+
+class SlowDevice(BenchDevice):
+
+    def handle_data(self, usb_req):
+        time.sleep(HANDLER_SLEEP)  # a blocking read, subprocess call, ...
+        self.send_usb_ret(usb_req, REPORT, len(REPORT))
+
+
+def serve(port, engine, threads):
+    usb_dev = SlowDevice()
+    usb_dev.handler_threads = threads
+    container = engine()
+    container.add_usb_device(usb_dev)
+    container.run(ip='127.0.0.1', port=port)
+
+
+def control_in(seqnum, devid):
+    return USBIP_CMD_Submit(command=0x1, seqnum=seqnum, devid=devid, direction=USBIP_DIR_IN, ep=0,
+                            transfer_flags=0, transfer_buffer_length=18, start_frame=0,
+                            number_of_packets=0, interval=0, setup=GET_DEVICE_DESCRIPTOR).pack()
+
+
+def measure(port):
+    sock, devid = import_device(port)
+    seqnum = 0
+    for _ in range(WINDOW):
+        seqnum += 1
+        sock.sendall(interrupt_in(seqnum, devid))
+    latencies = []
+    slow_done = 0
+    last_slow = 0
+    in_order = True
+    deadline = time.monotonic() + DURATION
+    start = time.monotonic()
+    while time.monotonic() < deadline:
+        seqnum += 1
+        control = seqnum
+        sent = time.perf_counter()
+        sock.sendall(control_in(control, devid))
+        while 1:
+            header = recv_exact(sock, RET_SIZE)
+            recv_exact(sock, ret_length(header))
+            done = struct.unpack_from('>I', header, 4)[0]
+            if done == control:
+                latencies.append(time.perf_counter() - sent)
+                break
+            in_order = in_order and done > last_slow
+            last_slow = done
+            slow_done += 1
+            seqnum += 1
+            sock.sendall(interrupt_in(seqnum, devid))
+    elapsed = time.monotonic() - start
+    sock.close()
+    latencies.sort()
+    return (slow_done / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[len(latencies) * 99 // 100] * 1000, in_order)
+
+
+def main():
+    print(f"{'engine':>8}{'handlers':>10}{'slow URB/s':>12}{'ctl p50 ms':>12}{'ctl p99 ms':>12}{'in order':>10}")
+    for name, engine in ENGINES:
+        for threads in (0, POOL_THREADS):
+            port = free_port()
+            server = multiprocessing.Process(target=serve, args=(port, engine, threads), daemon=True)
+            server.start()
+            try:
+                wait_for_port(port)
+                rate, p50, p99, in_order = measure(port)
+                handlers = f'{threads} thr' if threads else 'inline'
+                print(f"{name:>8}{handlers:>10}{rate:>12,.0f}{p50:>12.2f}{p99:>12.2f}{'yes' if in_order else 'NO':>10}")
+            finally:
+                server.terminate()
+                server.join()
+
+
+if __name__ == '__main__':
+    main()
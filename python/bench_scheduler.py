@@ -0,0 +1,34 @@
+import random
+import time
+from USBIP import InterruptScheduler, EndpointDescriptor, endpoint_interval
+
+# InterruptScheduler with thousands of interrupt endpoints: services/s,
+# missed deadlines and worst lateness with no-op callbacks, bInterval 1-16 ms.
+
+DURATION = 3.0
+ENDPOINTS = (100, 1000, 5000, 10000)
+
+
+def run(count):
+    scheduler = InterruptScheduler()
+    random.seed(count)
+    for _ in range(count):
+        endpoint = EndpointDescriptor(bEndpointAddress=0x81, bmAttributes=0x3,
+                                      wMaxPacketSize=8, bInterval=random.randint(1, 16))
+        scheduler.register(endpoint_interval(endpoint, speed=2), lambda: None)
+    scheduler.start()
+    time.sleep(DURATION)
+    scheduler.stop()
+    return scheduler.stats()
+
+
+def main():
+    print(f"{'endpoints':>10}{'services/s':>14}{'missed':>10}{'max late ms':>14}")
+    for count in ENDPOINTS:
+        stats = run(count)
+        print(f"{count:>10}{stats['serviced'] / DURATION:>14,.0f}"
+              f"{stats['missed_deadlines']:>10}{stats['max_lateness'] * 1000:>14.2f}")
+
+
+if __name__ == '__main__':
+    main()
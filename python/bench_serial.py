@@ -0,0 +1,160 @@
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from USBIP import USBContainer, AsyncUSBContainer, USBIP_CMD_Submit, USBIP_DIR_IN, USBIP_DIR_OUT
+from bench_common import import_device, recv_exact, ret_length, wait_for_port, free_port, RET_SIZE
+from replay import load_device_class
+
+# Throughput and byte latency of the cdc-acm.py serial port, next to the
+# hid-mouse.py interrupt path, for both engines.  On the device side a thread
+# in the server process works the pty like a local program: for IN it writes
+# as fast as the port takes data, for OUT it reads and discards.  The client
+# keeps WINDOW bulk URBs of each transfer size in flight; 512 bytes is what
+# the Linux cdc-acm driver submits.  The HID rows feed reports as fast as
+# the mouse sends them, one per bInterval.
+#
+# For latency the device side writes a 4 byte CLOCK_MONOTONIC microsecond
+# stamp every PERIOD, into the pty or as a mouse report, and the client,
+# sharing the clock, measures how late each arrives.
+
+DURATION = 2.0
+LATENCY_DURATION = 4.0
+PERIOD = 0.02
+WINDOW = 8
+TRANSFER_SIZES = (512, 4 << 10, 16 << 10)
+ENGINES = (('run()', USBContainer), ('async', AsyncUSBContainer))
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERIAL_MODULE = os.path.join(HERE, 'cdc-acm.py')
+HID_MODULE = os.path.join(HERE, 'hid-mouse.py')
+
+
+def stamp():
+    return (time.monotonic_ns() // 1000 & 0xffffffff).to_bytes(4, 'little')
+
+
+def feed_serial(path, mode):
+    port = os.open(path, os.O_RDWR | os.O_NOCTTY)
+    chunk = bytes(64 << 10)
+    while 1:
+        if mode == 'in':
+            os.write(port, chunk)
+        elif mode == 'out':
+            os.read(port, 64 << 10)
+        else:
+            os.write(port, stamp())
+            time.sleep(PERIOD)
+
+
+def feed_hid(usb_dev, mode):
+    while 1:
+        if mode == 'in':
+            if len(usb_dev.reports.reports) < 64:
+                usb_dev.move(0, 0)
+            else:
+                time.sleep(0.001)
+        else:
+            report = stamp()  # move() packs buttons, dx, dy, wheel
+            usb_dev.move(report[1], report[2], report[0], report[3])
+            time.sleep(PERIOD)
+
+
+def serve(port, engine, path, mode):
+    if path == 'serial':
+        usb_dev = load_device_class(SERIAL_MODULE, 'USBSerial')()
+        feeder = threading.Thread(target=feed_serial, args=(usb_dev.open_pty(), mode), daemon=True)
+    else:
+        usb_dev = load_device_class(HID_MODULE, 'USBHID')()
+        feeder = threading.Thread(target=feed_hid, args=(usb_dev, mode), daemon=True)
+    container = engine()
+    container.add_usb_device(usb_dev)
+    usb_dev.materialize()  # the feeder works on the device's state before the client imports it
+    feeder.start()
+    container.run(ip='127.0.0.1', port=port)
+
+
+def submit(seqnum, devid, direction, ep, length, data=b''):
+    return USBIP_CMD_Submit(command=0x1, seqnum=seqnum, devid=devid, direction=direction, ep=ep,
+                            transfer_flags=0, transfer_buffer_length=length, start_frame=0,
+                            number_of_packets=0, interval=0, setup=bytes(8)).pack() + data
+
+
+def throughput(port, direction, transfer_size):
+    # MB/s moved by WINDOW bulk or interrupt URBs kept in flight on endpoint 1 IN or 2 OUT
+    sock, devid = import_device(port)
+    ep = 1 if direction == USBIP_DIR_IN else 2
+    payload = bytes(transfer_size) if direction == USBIP_DIR_OUT else b''
+    seqnum = done = 0
+    for _ in range(WINDOW):
+        seqnum += 1
+        sock.sendall(submit(seqnum, devid, direction, ep, transfer_size, payload))
+    start = time.monotonic()
+    deadline = start + DURATION
+    while time.monotonic() < deadline:
+        length = ret_length(recv_exact(sock, RET_SIZE))
+        if direction == USBIP_DIR_IN:
+            recv_exact(sock, length)
+        done += length
+        seqnum += 1
+        sock.sendall(submit(seqnum, devid, direction, ep, transfer_size, payload))
+    elapsed = time.monotonic() - start
+    sock.close()
+    return done / elapsed / 1e6
+
+
+def latency(port, transfer_size):
+    # p50, p99 and max microseconds from the device side's stamp to its arrival
+    sock, devid = import_device(port)
+    seqnum = 0
+    for _ in range(WINDOW):
+        seqnum += 1
+        sock.sendall(submit(seqnum, devid, USBIP_DIR_IN, 1, transfer_size))
+    samples = []
+    pending = b''
+    deadline = time.monotonic() + LATENCY_DURATION
+    while time.monotonic() < deadline:
+        pending += recv_exact(sock, ret_length(recv_exact(sock, RET_SIZE)))
+        now = time.monotonic_ns() // 1000
+        while len(pending) >= 4:
+            samples.append((now - struct.unpack_from('<I', pending)[0]) & 0xffffffff)
+            pending = pending[4:]
+        seqnum += 1
+        sock.sendall(submit(seqnum, devid, USBIP_DIR_IN, 1, transfer_size))
+    sock.close()
+    samples.sort()
+    return samples[len(samples) // 2], samples[len(samples) * 99 // 100], samples[-1]
+
+
+def run(engine, path, mode, measure, *args):
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(port, engine, path, mode), daemon=True)
+    server.start()
+    try:
+        wait_for_port(port)
+        return measure(port, *args)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    print(f"{'engine':>8}{'path':>8}{'dir':>5}{'transfer':>10}{'MB/s':>12}")
+    for name, engine in ENGINES:
+        for mode, direction in (('in', USBIP_DIR_IN), ('out', USBIP_DIR_OUT)):
+            for transfer_size in TRANSFER_SIZES:
+                rate = run(engine, 'serial', mode, throughput, direction, transfer_size)
+                print(f"{name:>8}{'serial':>8}{mode:>5}{transfer_size:>10}{rate:>12,.3f}")
+        rate = run(engine, 'hid', 'in', throughput, USBIP_DIR_IN, 8)
+        print(f"{name:>8}{'hid':>8}{'in':>5}{8:>10}{rate:>12,.4f}")
+    print()
+    print(f"{'engine':>8}{'path':>8}{'p50 us':>10}{'p99 us':>10}{'max us':>10}")
+    for name, engine in ENGINES:
+        for path, transfer_size in (('serial', 512), ('hid', 8)):
+            p50, p99, worst = run(engine, path, 'latency', latency, transfer_size)
+            print(f"{name:>8}{path:>8}{p50:>10,}{p99:>10,}{worst:>10,}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+import multiprocessing
+import os
+from USBIP import AsyncUSBContainer, ShardedUSBContainer
+from bench_common import BenchDevice, wait_for_port, free_port
+from loadgen import run_load
+
+# Aggregate URB/s of ShardedUSBContainer with 1, 2 and 4 workers, against one
+# AsyncUSBContainer process.  CLIENTS loadgen processes each run CONNECTIONS
+# sessions on devices of their own, WINDOW interrupt IN URBs in flight per
+# session, so the client side is not the single GIL being measured.  Imports
+# landing on a worker that does not own the device are handed off, as with
+# any real client.  Scaling needs as many free cores as workers plus clients.
+
+DURATION = 3.0
+WINDOW = 8
+CLIENTS = 4
+CONNECTIONS = 8
+WORKERS = (1, 2, 4)
+
+
+def serve(port, workers):
+    container = AsyncUSBContainer() if workers is None else ShardedUSBContainer(workers)
+    for _ in range(CLIENTS * CONNECTIONS):
+        container.add_usb_device(BenchDevice())
+    container.run(ip='127.0.0.1', port=port)
+
+
+def client(port, first):
+    rate, _, errors = asyncio.run(run_load(port=port, connections=CONNECTIONS, duration=DURATION,
+                                           window=WINDOW, first=first))
+    return rate, errors
+
+
+def main():
+    print(f"{os.cpu_count()} CPUs, {CLIENTS} client processes x {CONNECTIONS} sessions")
+    print(f"{'server':>12}{'URB/s':>14}{'errors':>8}")
+    for workers in (None,) + WORKERS:
+        port = free_port()
+        server = multiprocessing.Process(target=serve, args=(port, workers), daemon=True)
+        server.start()
+        try:
+            wait_for_port(port)
+            with multiprocessing.Pool(CLIENTS) as pool:
+                results = pool.starmap(client, [(port, index * CONNECTIONS) for index in range(CLIENTS)])
+            name = 'async' if workers is None else f'{workers} workers'
+            print(f"{name:>12}{sum(rate for rate, _ in results):>14,.0f}{sum(errors for _, errors in results):>8}")
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
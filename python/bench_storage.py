@@ -0,0 +1,98 @@
+import multiprocessing
+import os
+import tempfile
+import time
+from USBIP import USBContainer, AsyncUSBContainer, USBIP_CMD_Submit, USBIP_DIR_IN, USBIP_DIR_OUT
+from bench_common import import_device, ret_length, recv_exact, wait_for_port, free_port, RET_SIZE
+from replay import load_device_class
+
+# Sequential READ(10) throughput of the mass-storage.py device in MB/s, for
+# both engines and a few transfer sizes.  The client issues one SCSI command
+# at a time like a host's usb-storage driver, submitting the CBW, data IN and
+# CSW URBs together.  The image is written once, so it is in the page cache.
+
+DURATION = 3.0
+IMAGE_SIZE = 64 << 20
+TRANSFER_SIZES = (16 << 10, 64 << 10, 256 << 10, 1 << 20)
+ENGINES = (('run()', USBContainer), ('async', AsyncUSBContainer))
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mass-storage.py')
+
+
+def serve(port, engine, path):
+    storage_class = load_device_class(MODULE, 'USBMassStorage')
+    disk_image = load_device_class(MODULE, 'DiskImage')
+    container = engine()
+    container.add_usb_device(storage_class(disk_image(path)))
+    container.run(ip='127.0.0.1', port=port)
+
+
+def submit(seqnum, devid, direction, ep, length, data=b''):
+    return USBIP_CMD_Submit(command=0x1, seqnum=seqnum, devid=devid, direction=direction, ep=ep,
+                            transfer_flags=0, transfer_buffer_length=length, start_frame=0,
+                            number_of_packets=0, interval=0, setup=bytes(8)).pack() + data
+
+
+def read_10(tag, lba, blocks):
+    cb = bytes((0x28, 0)) + lba.to_bytes(4, 'big') + bytes(1) + blocks.to_bytes(2, 'big')
+    return (b'USBC' + tag.to_bytes(4, 'little') + (blocks * 512).to_bytes(4, 'little')
+            + bytes((0x80, 0, len(cb))) + cb.ljust(16, b'\0'))
+
+
+def recv_into_exact(sock, view):
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError('server closed the connection')
+        received += count
+
+
+def sequential_read(port, transfer_size, duration):
+    sock, devid = import_device(port)
+    blocks = transfer_size // 512
+    payload = memoryview(bytearray(transfer_size))
+    seqnum = lba = done = 0
+    start = time.monotonic()
+    deadline = start + duration
+    while time.monotonic() < deadline:
+        if lba + blocks > IMAGE_SIZE // 512:
+            lba = 0
+        sock.sendall(submit(seqnum + 1, devid, USBIP_DIR_OUT, 2, 31, read_10(seqnum, lba, blocks))
+                     + submit(seqnum + 2, devid, USBIP_DIR_IN, 1, transfer_size)
+                     + submit(seqnum + 3, devid, USBIP_DIR_IN, 1, 13))
+        seqnum += 3
+        for _ in range(3):  # RETs of the CBW, which carries no data, the data IN and the CSW
+            length = ret_length(recv_exact(sock, RET_SIZE))
+            if length == transfer_size:
+                recv_into_exact(sock, payload)
+            elif length == 13:
+                recv_exact(sock, length)
+        lba += blocks
+        done += transfer_size
+    elapsed = time.monotonic() - start
+    sock.close()
+    return done / elapsed / 1e6
+
+
+def main():
+    with tempfile.NamedTemporaryFile(suffix='.img') as image:
+        image.write(os.urandom(IMAGE_SIZE))
+        image.flush()
+        print(f"{'engine':>8}{'transfer':>10}{'MB/s':>10}")
+        for name, engine in ENGINES:
+            for transfer_size in TRANSFER_SIZES:
+                port = free_port()
+                server = multiprocessing.Process(target=serve, args=(port, engine, image.name), daemon=True)
+                server.start()
+                try:
+                    wait_for_port(port)
+                    rate = sequential_read(port, transfer_size, DURATION)
+                    print(f"{name:>8}{transfer_size >> 10:>8}KB{rate:>10,.1f}")
+                finally:
+                    server.terminate()
+                    server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import struct
+import timeit
+import USBIP
+from USBIP import BaseStructure
+
+# Microbenchmark for BaseStructure codecs: ops/sec of the original per-call
+# format building versus the precompiled struct.Struct for every structure.
+
+
+def legacy_format(obj):
+    pack_format = obj._byte_order_
+    for field in obj._fields_:
+        if isinstance(field[1], BaseStructure):
+            pack_format += str(field[1].size()) + 's'
+        else:
+            pack_format += field[1]
+    return pack_format
+
+
+def legacy_size(obj):
+    return struct.calcsize(legacy_format(obj))
+
+
+def legacy_pack(obj):
+    values = []
+    for field in obj._fields_:
+        if isinstance(field[1], BaseStructure):
+            values.append(getattr(obj, field[0], 0).pack())
+        else:
+            values.append(getattr(obj, field[0], 0))
+    return struct.pack(legacy_format(obj), *values)
+
+
+def legacy_unpack(obj, buf):
+    values = struct.unpack(legacy_format(obj), buf)
+    keys_vals = {}
+    for i, val in enumerate(values):
+        keys_vals[obj._fields_[i][0]] = val
+    obj.init_from_dict(**keys_vals)
+
+
+def sample(cls):
+    values = {}
+    for field in cls._fields_:
+        if isinstance(field[1], BaseStructure):
+            values[field[0]] = sample(type(field[1]))
+        elif field[1].endswith('s'):
+            values[field[0]] = b'\x01'
+        else:
+            values[field[0]] = 1
+    return cls(**values)
+
+
+def structures():
+    return [cls for cls in vars(USBIP).values()
+            if isinstance(cls, type) and issubclass(cls, BaseStructure) and cls is not BaseStructure]
+
+
+def ops_per_sec(func, number):
+    return number / min(timeit.repeat(func, number=number, repeat=3))
+
+
+def main(number=20000):
+    print(f"{'structure':<28}{'op':<8}{'before':>14}{'after':>14}{'speedup':>10}")
+    for cls in structures():
+        obj = sample(cls)
+        if isinstance(obj, USBIP.USBIP_RET_Submit):
+            obj.data = b''
+        buf = BaseStructure.pack(obj)
+        scratch = cls()
+        target = memoryview(bytearray(len(buf) + 8))
+        cases = [
+            ('size', lambda: legacy_size(obj), obj.size),
+            ('pack', lambda: legacy_pack(obj), lambda: BaseStructure.pack(obj)),
+            ('unpack', lambda: legacy_unpack(scratch, buf), lambda: scratch.unpack(buf)),
+            ('into', lambda: target.__setitem__(slice(8, 8 + len(buf)), legacy_pack(obj)), lambda: obj.pack_into(target, 8)),
+            ('from', lambda: legacy_unpack(scratch, target[8:8 + len(buf)]), lambda: scratch.unpack_from(target, 8)),
+        ]
+        for name, before, after in cases:
+            old = ops_per_sec(before, number)
+            new = ops_per_sec(after, number)
+            print(f"{cls.__name__:<28}{name:<8}{old:>14,.0f}{new:>14,.0f}{new / old:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
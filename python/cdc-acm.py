@@ -0,0 +1,347 @@
+import os
+import tty
+import logging
+import argparse
+import threading
+import collections
+from USBIP import (BaseStructure, USBDevice, InterfaceDescriptor, DeviceDescriptor, DeviceConfiguration, EndpointDescriptor,
+                   DescriptorList, USBContainer, RingBuffer, after_send, USBIP_DIR_IN, USBIP_DIR_OUT, URB_STATUS_STALL)
+
+
+logger = logging.getLogger('USBIP.cdc-acm')
+
+# Emulating a USB serial port: Communications Device Class, Abstract Control
+# Model.  Bulk IN endpoint 1 and bulk OUT endpoint 2 carry the data, interrupt
+# IN endpoint 3 the (unused) serial state notifications.
+
+# CDC functional descriptors
+
+
+class HeaderFunctionalDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bFunctionLength', 'B', 5),
+        ('bDescriptorType', 'B', 0x24),  # CS_INTERFACE
+        ('bDescriptorSubtype', 'B', 0x00),  # Header
+        ('bcdCDC', 'H', 0x0110),
+    ]
+
+
+class CallManagementFunctionalDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bFunctionLength', 'B', 5),
+        ('bDescriptorType', 'B', 0x24),
+        ('bDescriptorSubtype', 'B', 0x01),  # Call Management
+        ('bmCapabilities', 'B', 0x00),  # no call management
+        ('bDataInterface', 'B', 1),
+    ]
+
+
+class ACMFunctionalDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bFunctionLength', 'B', 4),
+        ('bDescriptorType', 'B', 0x24),
+        ('bDescriptorSubtype', 'B', 0x02),  # Abstract Control Management
+        ('bmCapabilities', 'B', 0x06),  # line coding, control line state and break requests
+    ]
+
+
+class UnionFunctionalDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bFunctionLength', 'B', 5),
+        ('bDescriptorType', 'B', 0x24),
+        ('bDescriptorSubtype', 'B', 0x06),  # Union
+        ('bControlInterface', 'B', 0),
+        ('bSubordinateInterface0', 'B', 1),
+    ]
+
+
+class LineCoding(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('dwDTERate', 'I', 115200),
+        ('bCharFormat', 'B', 0),  # 1 stop bit
+        ('bParityType', 'B', 0),  # none
+        ('bDataBits', 'B', 8),
+    ]
+
+
+control_interface = InterfaceDescriptor(bInterfaceNumber=0,
+                                        bAlternateSetting=0,
+                                        bNumEndpoints=1,
+                                        bInterfaceClass=0x02,  # class Communications
+                                        bInterfaceSubClass=0x02,  # Abstract Control Model
+                                        bInterfaceProtocol=0x01,  # AT commands
+                                        iInterface=0)
+
+data_interface = InterfaceDescriptor(bInterfaceNumber=1,
+                                     bAlternateSetting=0,
+                                     bNumEndpoints=2,
+                                     bInterfaceClass=0x0a,  # class CDC Data
+                                     bInterfaceSubClass=0,
+                                     bInterfaceProtocol=0,
+                                     iInterface=0)
+
+notification = EndpointDescriptor(bEndpointAddress=0x83,
+                                  bmAttributes=0x3,  # interrupt
+                                  wMaxPacketSize=0x0010,
+                                  bInterval=0x08)  # 2^(8-1) microframes, 16 ms
+
+bulk_in = EndpointDescriptor(bEndpointAddress=0x81,
+                             bmAttributes=0x2,  # bulk
+                             wMaxPacketSize=0x0200,
+                             bInterval=0)
+
+bulk_out = EndpointDescriptor(bEndpointAddress=0x02,
+                              bmAttributes=0x2,  # bulk
+                              wMaxPacketSize=0x0200,
+                              bInterval=0)
+
+serial_device_descriptor = DeviceDescriptor(bcdUSB=0x0200,
+                                            bDeviceClass=0x02,  # Communications
+                                            bDeviceSubClass=0x0,
+                                            bDeviceProtocol=0x0,
+                                            bMaxPacketSize0=0x40,
+                                            idVendor=0x2706,
+                                            idProduct=0x0004,
+                                            bcdDevice=0x0100,
+                                            iManufacturer=1,
+                                            iProduct=2,
+                                            iSerialNumber=3,
+                                            bNumConfigurations=1)
+
+configuration = DeviceConfiguration(wTotalLength=0x0043,
+                                    bNumInterfaces=0x2,
+                                    bConfigurationValue=1,
+                                    iConfiguration=0x0,  # No string
+                                    bmAttributes=0x80,  # bus powered
+                                    bMaxPower=50)  # 100 mA current
+
+control_interface.class_descriptor = DescriptorList([HeaderFunctionalDescriptor(),
+                                                     CallManagementFunctionalDescriptor(),
+                                                     ACMFunctionalDescriptor(),
+                                                     UnionFunctionalDescriptor()])
+control_interface.endpoints = [notification]
+data_interface.endpoints = [bulk_in, bulk_out]
+configuration.interfaces = [[control_interface], [data_interface]]
+
+
+class USBSerial(USBDevice):
+    '''
+    CDC-ACM serial port whose data passes through two RingBuffers of
+    buffer_size bytes.
+
+    Bulk OUT data is copied into out_ring and the URB answered at once; when
+    the ring is full the URB is parked with the rest of its data until the
+    consumer makes room, which is how the host sees flow control.  Bulk IN
+    URBs take what is in in_ring, up to their transfer_buffer_length, and are
+    parked while it is empty; the data is sent as views of the ring, lent
+    until the connection has written it.  The other end is either open_pty(), a
+    pseudo-terminal local programs can open like a serial port, or the
+    blocking write() and read() methods.  The rings are allocated on the
+    first import, or when either end is first used.
+    '''
+
+    configurations = [configuration]  # Supports only one configuration
+    device_descriptor = serial_device_descriptor
+    speed = 3  # high speed
+    strings = {1: 'USBIP', 2: 'Serial', 3: '000000000001'}
+
+    pty = None
+
+    def __init__(self, buffer_size=1 << 20):
+        USBDevice.__init__(self)
+        self.buffer_size = buffer_size
+
+    def create_state(self):
+        self.lock = threading.RLock()  # service_in() may call release_in() through after_send()
+        self.changed = threading.Condition(self.lock)  # notified when either ring is read or written
+        self.in_ring = RingBuffer(self.buffer_size)  # device to host
+        self.out_ring = RingBuffer(self.buffer_size)  # host to device
+        self.in_urbs = collections.deque()  # parked bulk IN URBs
+        self.out_urbs = collections.deque()  # parked bulk OUT URBs with the data not yet in out_ring
+        self.notification_urbs = collections.deque()
+        self.line_coding = LineCoding()
+        self.control_line_state = 0  # bit 0 DTR, bit 1 RTS
+
+    def handle_data(self, usb_req):
+        if usb_req.ep == 1 and usb_req.direction == USBIP_DIR_IN:
+            with self.lock:
+                self.in_urbs.append(usb_req)
+                self.service_in()
+        elif usb_req.ep == 2 and usb_req.direction == USBIP_DIR_OUT:
+            data = usb_req.transfer_buffer if usb_req.transfer_buffer is not None else b''
+            with self.lock:
+                written = 0 if self.out_urbs else self.out_ring.write(data)
+                if written < len(data):
+                    # The request's view is only valid until the next read, keep a copy of the rest
+                    self.out_urbs.append((usb_req, memoryview(bytes(data[written:]))))
+                else:
+                    self.send_usb_ret(usb_req, b'', len(data))
+                if written:
+                    self.changed.notify_all()
+        elif usb_req.ep == 3 and usb_req.direction == USBIP_DIR_IN:
+            with self.lock:
+                self.notification_urbs.append(usb_req)  # line state never changes, nothing to notify
+        else:
+            self.send_usb_ret(usb_req, b'', 0, URB_STATUS_STALL)
+
+    def handle_unlink(self, seqnum):
+        with self.lock:
+            for urbs in (self.in_urbs, self.notification_urbs):
+                for usb_req in urbs:
+                    if usb_req.seqnum == seqnum:
+                        urbs.remove(usb_req)
+                        return True
+            for parked in self.out_urbs:
+                if parked[0].seqnum == seqnum:
+                    self.out_urbs.remove(parked)
+                    return True
+        return False
+
+    def detach(self):
+        # The session ended; its parked URBs go, bytes already in the rings stay for the next one
+        with self.lock:
+            self.in_urbs.clear()
+            self.out_urbs.clear()
+            self.notification_urbs.clear()
+            self.in_ring.release_all()  # callbacks of the ended session's writes will not come
+            self.changed.notify_all()
+
+    def pending_urbs(self):
+        return len(self.in_urbs) + len(self.out_urbs) + len(self.notification_urbs)
+
+    def service_in(self):
+        # Called with self.lock held; answers parked IN URBs while in_ring has data
+        if not (self.in_urbs and self.in_ring):
+            return
+        while self.in_urbs and self.in_ring:
+            usb_req = self.in_urbs.popleft()
+            regions, count = self.in_ring.lend(usb_req.transfer_buffer_length)
+            self.send_usb_ret(usb_req, regions, count)
+            after_send(self.connection, self.release_in)
+        self.changed.notify_all()
+
+    def release_in(self):
+        # The oldest bulk IN data lent from in_ring has been written, its room can be reused
+        with self.lock:
+            self.in_ring.release()
+            self.changed.notify_all()
+
+    def service_out(self):
+        # Called with self.lock held; moves parked OUT data into out_ring as room allows
+        while self.out_urbs:
+            usb_req, data = self.out_urbs[0]
+            written = self.out_ring.write(data)
+            if written < len(data):
+                self.out_urbs[0] = (usb_req, data[written:])
+                break
+            self.out_urbs.popleft()
+            self.send_usb_ret(usb_req, b'', usb_req.transfer_buffer_length)
+
+    def write(self, data):
+        # Thread-safe; blocks until all of data is in in_ring
+        self.materialize()
+        data = memoryview(data).cast('B')
+        with self.lock:
+            while data:
+                written = self.in_ring.write(data)
+                data = data[written:]
+                self.service_in()
+                if data:
+                    self.changed.wait()
+
+    def read(self, size):
+        # Thread-safe; blocks until the host sent something, returns at most size bytes
+        self.materialize()
+        with self.lock:
+            while not self.out_ring:
+                self.changed.wait()
+            data = self.out_ring.read(size)
+            self.service_out()
+            self.changed.notify_all()
+        return data
+
+    def open_pty(self):
+        '''
+        Bridges the port to a new pseudo-terminal in raw mode and returns the
+        path local programs open, e.g. /dev/pts/3.  Two threads move data
+        between the terminal and the rings with readv/writev on the ring
+        regions.
+        '''
+        self.materialize()
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self.pty = master
+        self.pty_slave = slave  # kept open so the master never sees EIO when a program closes the port
+        threading.Thread(target=self.pty_reader, daemon=True).start()
+        threading.Thread(target=self.pty_writer, daemon=True).start()
+        return os.ttyname(slave)
+
+    def pty_reader(self):
+        # Terminal output goes into in_ring; only this thread writes there, so the free regions stay free unlocked
+        while 1:
+            with self.lock:
+                while not self.in_ring.free():
+                    self.changed.wait()
+                regions = self.in_ring.writable()
+            count = os.readv(self.pty, regions)
+            with self.lock:
+                self.in_ring.commit(count)
+                self.service_in()
+
+    def pty_writer(self):
+        # out_ring goes to the terminal's input; a full terminal holds back the host's bulk OUT URBs
+        while 1:
+            with self.lock:
+                while not self.out_ring:
+                    self.changed.wait()
+                regions = self.out_ring.readable()
+            count = os.writev(self.pty, regions)
+            with self.lock:
+                self.out_ring.consume(count)
+                self.service_out()
+                self.changed.notify_all()
+
+    def handle_device_specific_control(self, control_req, usb_req):
+        if control_req.bmRequestType == 0x21 and control_req.bRequest == 0x20:  # SET_LINE_CODING
+            data = usb_req.transfer_buffer
+            if data is None or len(data) != self.line_coding.size():
+                self.send_usb_ret(usb_req, b'', 0, URB_STATUS_STALL)
+                return
+            self.line_coding.unpack(data)
+            logger.info('line coding %d baud, %d data bits, parity %d, stop bits %d',
+                        self.line_coding.dwDTERate, self.line_coding.bDataBits,
+                        self.line_coding.bParityType, self.line_coding.bCharFormat)
+            self.send_usb_ret(usb_req, b'', len(data))
+        elif control_req.bmRequestType == 0xa1 and control_req.bRequest == 0x21:  # GET_LINE_CODING
+            line_coding = self.line_coding.pack()
+            self.send_usb_ret(usb_req, line_coding, len(line_coding))
+        elif control_req.bmRequestType == 0x21 and control_req.bRequest == 0x22:  # SET_CONTROL_LINE_STATE
+            self.control_line_state = control_req.wValue
+            logger.info('DTR %d RTS %d', control_req.wValue & 1, control_req.wValue >> 1 & 1)
+            self.send_usb_ret(usb_req, b'', 0)
+        elif control_req.bmRequestType == 0x21 and control_req.bRequest == 0x23:  # SEND_BREAK
+            self.send_usb_ret(usb_req, b'', 0)
+        elif control_req.bmRequestType == 0x02 and control_req.bRequest == 0x01:  # CLEAR_FEATURE(ENDPOINT_HALT)
+            self.send_usb_ret(usb_req, b'', 0)
+        else:
+            logger.debug('unsupported control request, stalling')
+            self.send_usb_ret(usb_req, b'', 0, URB_STATUS_STALL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a USB serial port bridged to a local pseudo-terminal.')
+    parser.add_argument('--buffer', type=int, default=1024, metavar='KB', help='size of each direction\'s ring buffer')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')  # DEBUG logs every URB
+    usb_dev = USBSerial(args.buffer << 10)
+    logger.info('serial port bridged to %s', usb_dev.open_pty())
+    usb_container = USBContainer()
+    usb_container.add_usb_device(usb_dev)  # Exported as bus id 1-1
+    usb_container.run()
+
+# Open the pty with e.g.: picocom /dev/pts/3, or on the host side: usbip attach -r 127.0.0.1 -b 1-1
@@ -1,11 +1,12 @@
 import time
 import random
+import logging
 import datetime
-from USBIP import BaseStructure, USBDevice, InterfaceDescriptor, DeviceDescriptor, DeviceConfiguration, EndpointDescriptor, USBContainer
+import threading
+from USBIP import BaseStructure, USBDevice, InterfaceDescriptor, DeviceDescriptor, DeviceConfiguration, EndpointDescriptor, USBContainer, ReportQueue
 
 
-# data event counter
-count = 0
+logger = logging.getLogger('USBIP.hid-mouse')
 
 # Emulating USB mouse
 
@@ -42,7 +43,7 @@ interface_d = InterfaceDescriptor(bAlternateSetting=0,
 end_point = EndpointDescriptor(bEndpointAddress=0x81,
                      bmAttributes=0x3,
                      wMaxPacketSize=0x0008, 
-                     bInterval=0xFF)  # interval to report
+                     bInterval=0x0A)  # interval to report, 10 ms
 
 mouse_device_descriptor = DeviceDescriptor(bDeviceClass=0x0,
                                            bDeviceSubClass=0x0,
@@ -69,11 +70,25 @@ configuration.interfaces = [interface]   # Supports only one interface
 class USBHID(USBDevice):
     configurations = [configuration]  # Supports only one configuration
     device_descriptor = mouse_device_descriptor
+    reports = None  # ReportQueue, from the first import
+    report_backlog = 100  # about a second of reports at bInterval; older moves are dropped beyond it
 
     def __init__(self):
         USBDevice.__init__(self)
         self.start_time = datetime.datetime.now()
 
+    def create_state(self):
+        # Reports go out one per bInterval, so moves made faster than that, or
+        # while no client polls, wait here; the oldest are dropped past report_backlog
+        self.reports = ReportQueue(self, maxlen=self.report_backlog)
+
+    def move(self, dx, dy, buttons=0, wheel=0):
+        # Thread-safe; the report answers the next interrupt IN URB
+        reports = self.reports
+        if reports is None:
+            return  # never imported, no host to report to
+        reports.push(bytes([buttons, self.comp(dx), self.comp(dy), self.comp(wheel)]))
+
     def generate_mouse_report(self):
 
         arr = [0x05, 0x01,		# Usage Page (Generic Desktop)
@@ -112,38 +127,53 @@ class USBHID(USBDevice):
             return 256 + val
 
     def handle_data(self, usb_req):
+        # Interrupt IN URBs wait in the report queue until move() provides data
+        self.reports.submit(usb_req)
+
+    def handle_unlink(self, seqnum):
+        return self.reports.cancel(seqnum)
+
+    def detach(self):
+        self.reports.detach()
+
+    def pending_urbs(self):
+        return len(self.reports)
+
+    def schedule_endpoints(self, scheduler):
+        # Reports go out at most once per bInterval, like a real mouse
+        self.reports.schedule(scheduler, end_point)
+
+    def random_moves(self, count=100, period=0.05):
         # Sending random mouse data
-        # Send data only for 5 seconds
-        # if (datetime.datetime.now() - self.start_time).seconds < 10:
-        global count
-        if count < 100:
-            mouse_data = [0x0, self.comp(random.randint(-5, 5)), self.comp(random.randint(-5, 5)), 0]
-            ret = bytearray(mouse_data)
-            self.send_usb_ret(usb_req, ret, len(ret))
-            time.sleep(0.05)
-        count = count + 1
+        for _ in range(count):
+            self.move(random.randint(-5, 5), random.randint(-5, 5))
+            time.sleep(period)
 
     def handle_device_specific_control(self, control_req, usb_req):
         if control_req.bmRequestType == 0x81:
             if control_req.bRequest == 0x6:  # Get Descriptor
                 descriptor_type, descriptor_index = control_req.wValue.to_bytes(length=2, byteorder='big')
                 if descriptor_type == 0x22:  # send initial report
-                    print('send initial report')
-                    ret = self.generate_mouse_report()
+                    logger.debug('send initial report')
+                    ret = self.shared_descriptor(0x22, self.generate_mouse_report)
                     self.send_usb_ret(usb_req, ret, len(ret))
 
         if control_req.bmRequestType == 0x21:  # Host Request
             if control_req.bRequest == 0x0a:  # set idle
-                print('Idle')
+                logger.debug('Idle')
                 # Idle
                 # self.send_ok(usb_req)
                 self.send_usb_ret(usb_req, b'', 0, 0)
                 pass
 
 
-usb_dev = USBHID()
-usb_container = USBContainer()
-usb_container.add_usb_device(usb_dev)  # Supports only one device!
-usb_container.run()
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')  # DEBUG logs every URB
+    usb_dev = USBHID()
+    usb_container = USBContainer()
+    usb_container.add_usb_device(usb_dev)  # Exported as bus id 1-1
+    usb_dev.materialize()  # the latest moves made before a client imports the mouse are kept for it
+    threading.Thread(target=usb_dev.random_moves, daemon=True).start()
+    usb_container.run()
 
 # Run in cmd: usbip.exe -a 127.0.0.1 "1-1"
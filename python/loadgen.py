@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import random
+import time
+from USBIP import (USBIPHeader, USBIPDeviceInfo, USBInterface, OP_REP_Import, USBIP_CMD_Submit,
+                   USBIP_RET_Submit, StandardDeviceRequest, USBIP_RET_SUBMIT,
+                   USBIP_DIR_IN, USBIP_DIR_OUT)
+
+# USB/IP load generator: lists and imports devices like usbip.exe does, then
+# floods CMD_SUBMITs over N concurrent connections and reports URB/s and
+# latency percentiles.  Runs against localhost without a vhci driver.
+#
+#   python loadgen.py --connections 10 --duration 5 --mix interrupt=8,control=1,bulk-out=1
+
+
+OP_HEADER_SIZE = USBIPHeader().size()
+RET_SIZE = USBIP_RET_Submit().size()
+IMPORT_REPLY_SIZE = OP_REP_Import().size()
+KINDS = ('control', 'interrupt', 'bulk-out')
+
+
+async def list_devices(ip, port):
+    reader, writer = await asyncio.open_connection(ip, port)
+    try:
+        writer.write(USBIPHeader(command=0x8005, status=0).pack())
+        await reader.readexactly(OP_HEADER_SIZE)
+        count = int.from_bytes(await reader.readexactly(4), byteorder='big')
+        devices = []
+        for _ in range(count):
+            info = USBIPDeviceInfo()
+            info.unpack(await reader.readexactly(info.size()))
+            await reader.readexactly(USBInterface().size() * info.bNumInterfaces)
+            devices.append((info.busID.rstrip(b'\0').decode('ascii'), (info.busnum << 16) | info.devnum))
+        return devices
+    finally:
+        writer.close()
+
+
+class LoadConnection:
+    '''
+    One imported device, keeping window CMD_SUBMITs in flight and timing each
+    from send to its RET_SUBMIT.
+    '''
+
+    def __init__(self, busid, devid, mix, interrupt_ep=1, bulk_ep=2, bulk_size=512):
+        self.busid = busid
+        self.devid = devid
+        self.kinds, self.weights = zip(*mix.items())
+        self.interrupt_ep = interrupt_ep
+        self.bulk_ep = bulk_ep
+        self.bulk_payload = bytes(bulk_size)
+        self.seqnum = 0
+        self.sent = {}  # seqnum -> (send time, direction)
+        self.latencies = []
+        self.errors = 0
+        self.get_descriptor = StandardDeviceRequest(bmRequestType=0x80, bRequest=0x06,
+                                                    wValue=0x0100, wIndex=0, wLength=18).pack()
+
+    def urb(self, kind):
+        self.seqnum += 1
+        cmd = USBIP_CMD_Submit(command=0x1, seqnum=self.seqnum, devid=self.devid, transfer_flags=0,
+                               start_frame=0, number_of_packets=0, interval=0, setup=bytes(8))
+        payload = b''
+        if kind == 'control':
+            cmd.init_from_dict(direction=USBIP_DIR_IN, ep=0, transfer_buffer_length=18, setup=self.get_descriptor)
+        elif kind == 'interrupt':
+            cmd.init_from_dict(direction=USBIP_DIR_IN, ep=self.interrupt_ep, transfer_buffer_length=8, interval=1)
+        else:
+            payload = self.bulk_payload
+            cmd.init_from_dict(direction=USBIP_DIR_OUT, ep=self.bulk_ep, transfer_buffer_length=len(payload))
+        self.sent[self.seqnum] = (time.perf_counter(), cmd.direction)
+        return cmd.pack() + payload
+
+    def next_urb(self):
+        return self.urb(random.choices(self.kinds, self.weights)[0])
+
+    async def run(self, ip, port, window, deadline):
+        reader, writer = await asyncio.open_connection(ip, port)
+        try:
+            # Cancelled at the deadline even when the server stops answering
+            await asyncio.wait_for(self.exchange(reader, writer, window), max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            writer.close()
+
+    async def exchange(self, reader, writer, window):
+        writer.write(USBIPHeader(command=0x8003, status=0).pack() + self.busid.encode('ascii').ljust(32, b'\0'))
+        reply = await reader.readexactly(OP_HEADER_SIZE)
+        if int.from_bytes(reply[4:8], byteorder='big') != 0:
+            raise ConnectionError(f'import of {self.busid} refused')
+        await reader.readexactly(IMPORT_REPLY_SIZE - OP_HEADER_SIZE)
+        writer.writelines([self.next_urb() for _ in range(window)])
+        ret = USBIP_RET_Submit()
+        while 1:
+            header = await reader.readexactly(RET_SIZE)
+            ret.unpack(header)
+            sent, direction = self.sent.pop(ret.seqnum, (None, USBIP_DIR_IN))
+            # Only IN replies carry data; OUT ones report actual_length without it
+            if ret.command == USBIP_RET_SUBMIT and direction == USBIP_DIR_IN:
+                await reader.readexactly(ret.actual_length)
+            if sent is not None:
+                self.latencies.append(time.perf_counter() - sent)
+            if ret.status:
+                self.errors += 1
+            writer.write(self.next_urb())
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+async def run_load(ip='127.0.0.1', port=3240, connections=1, duration=5.0, window=8, mix=None, first=0, **options):
+    # Returns (URB/s, latency percentiles in seconds, errors); connections import devices from the first-th on
+    devices = await list_devices(ip, port)
+    if not devices:
+        raise ConnectionError('server exports no devices')
+    mix = mix or {'interrupt': 1}
+    loads = [LoadConnection(*devices[(first + index) % len(devices)], mix, **options) for index in range(connections)]
+    start = time.monotonic()
+    deadline = start + duration
+    await asyncio.gather(*(load.run(ip, port, window, deadline) for load in loads))
+    elapsed = time.monotonic() - start
+    latencies = sorted(latency for load in loads for latency in load.latencies)
+    percentiles = {name: percentile(latencies, fraction) for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))}
+    return len(latencies) / elapsed, percentiles, sum(load.errors for load in loads)
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f'unknown URB kind {kind!r}, expected one of {", ".join(KINDS)}')
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test a USB/IP server with concurrent CMD_SUBMIT floods.')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3240)
+    parser.add_argument('--connections', type=int, default=1, help='concurrent imports, spread over the listed devices')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds to run')
+    parser.add_argument('--window', type=int, default=8, help='URBs in flight per connection')
+    parser.add_argument('--mix', type=parse_mix, default={'interrupt': 1},
+                        help='weighted URB kinds, e.g. interrupt=8,control=1,bulk-out=1')
+    parser.add_argument('--interrupt-ep', type=int, default=1)
+    parser.add_argument('--bulk-ep', type=int, default=2)
+    parser.add_argument('--bulk-size', type=int, default=512)
+    args = parser.parse_args()
+
+    rate, percentiles, errors = asyncio.run(run_load(args.ip, args.port, args.connections, args.duration,
+                                                     args.window, args.mix, interrupt_ep=args.interrupt_ep,
+                                                     bulk_ep=args.bulk_ep, bulk_size=args.bulk_size))
+    print(f'{rate:,.0f} URB/s over {args.connections} connection(s), {errors} error status(es)')
+    print('latency ' + '  '.join(f'{name}={value * 1000:.3f}ms' for name, value in percentiles.items()))
+
+
+if __name__ == '__main__':
+    main()
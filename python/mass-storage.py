@@ -0,0 +1,378 @@
+import os
+import mmap
+import struct
+import logging
+import argparse
+import threading
+import collections
+from USBIP import BaseStructure, USBDevice, InterfaceDescriptor, DeviceDescriptor, DeviceConfiguration, EndpointDescriptor, USBContainer, BlockCache, USBIP_DIR_IN, URB_STATUS_STALL
+
+
+logger = logging.getLogger('USBIP.mass-storage')
+
+# Emulating a USB flash drive: Mass Storage Class, Bulk-Only Transport, SCSI transparent command set
+
+BLOCK_SIZE = 512
+
+
+class CommandBlockWrapper(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('dCBWSignature', 'I', 0x43425355),  # 'USBC'
+        ('dCBWTag', 'I'),
+        ('dCBWDataTransferLength', 'I'),
+        ('bmCBWFlags', 'B'),  # bit 7 set for data IN
+        ('bCBWLUN', 'B'),
+        ('bCBWCBLength', 'B'),
+        ('CBWCB', '16s'),
+    ]
+
+
+class CommandStatusWrapper(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('dCSWSignature', 'I', 0x53425355),  # 'USBS'
+        ('dCSWTag', 'I'),
+        ('dCSWDataResidue', 'I'),
+        ('bCSWStatus', 'B'),  # 0 passed, 1 failed, 2 phase error
+    ]
+
+
+CBW_SIZE = CommandBlockWrapper().size()
+
+# SCSI block commands use big-endian fields
+READ_WRITE_10 = struct.Struct('>xxIxH')  # logical block address, transfer length in blocks
+READ_CAPACITY_10 = struct.Struct('>II')  # last logical block address, block length
+
+# Sense key, additional sense code
+NO_SENSE = (0x00, 0x00)
+INVALID_COMMAND = (0x05, 0x20)
+INVALID_FIELD_IN_CDB = (0x05, 0x24)
+LBA_OUT_OF_RANGE = (0x05, 0x21)
+WRITE_PROTECTED = (0x07, 0x27)
+
+
+interface_d = InterfaceDescriptor(bAlternateSetting=0,
+                                  bNumEndpoints=2,
+                                  bInterfaceClass=0x08,  # class Mass Storage
+                                  bInterfaceSubClass=0x06,  # SCSI transparent command set
+                                  bInterfaceProtocol=0x50,  # Bulk-Only Transport
+                                  iInterface=0)
+
+bulk_in = EndpointDescriptor(bEndpointAddress=0x81,
+                             bmAttributes=0x2,  # bulk
+                             wMaxPacketSize=0x0200,
+                             bInterval=0)
+
+bulk_out = EndpointDescriptor(bEndpointAddress=0x02,
+                              bmAttributes=0x2,  # bulk
+                              wMaxPacketSize=0x0200,
+                              bInterval=0)
+
+storage_device_descriptor = DeviceDescriptor(bcdUSB=0x0200,
+                                             bDeviceClass=0x0,  # defined at interface level
+                                             bDeviceSubClass=0x0,
+                                             bDeviceProtocol=0x0,
+                                             bMaxPacketSize0=0x40,
+                                             idVendor=0x2706,
+                                             idProduct=0x0002,
+                                             bcdDevice=0x0100,
+                                             iManufacturer=1,
+                                             iProduct=2,
+                                             iSerialNumber=3,
+                                             bNumConfigurations=1)
+
+configuration = DeviceConfiguration(wTotalLength=0x0020,
+                                    bNumInterfaces=0x1,
+                                    bConfigurationValue=1,
+                                    iConfiguration=0x0,  # No string
+                                    bmAttributes=0x80,  # bus powered
+                                    bMaxPower=100)  # 200 mA current
+
+interface_d.endpoints = [bulk_in, bulk_out]
+configuration.interfaces = [[interface_d]]
+
+
+class DiskImage:
+    '''
+    Raw disk image file mapped into memory, addressed in blocks.
+
+    read() returns memoryview slices of the mapping, so they can be queued
+    for sending without a copy.  Writes go straight into the mapping and
+    reach the file when the kernel writes the pages back, or at flush().
+    '''
+
+    def __init__(self, path, read_only=False, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.read_only = read_only
+        with open(path, 'rb' if read_only else 'r+b') as image:
+            size = os.fstat(image.fileno()).st_size
+            self.block_count = size // block_size
+            if not self.block_count:
+                raise ValueError(f'{path} is smaller than one {block_size} byte block')
+            self.mapping = mmap.mmap(image.fileno(), self.block_count * block_size,
+                                     access=mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE)
+        self.view = memoryview(self.mapping)
+
+    def read(self, lba, count):
+        return self.view[lba * self.block_size:(lba + count) * self.block_size]
+
+    def write(self, offset, data):
+        # offset in bytes, so a WRITE(10) can arrive in several bulk OUT URBs
+        self.view[offset:offset + len(data)] = data
+
+    def flush(self):
+        if not self.read_only:
+            self.mapping.flush()
+
+    def close(self):
+        self.flush()
+        self.view.release()
+        self.mapping.close()  # BufferError while a read() slice is still queued
+
+
+class FileImage:
+    '''
+    Raw disk image file accessed with pread/pwrite, one system call per
+    read() or write().  The uncached counterpart of DiskImage, to put under
+    a BlockCache.
+    '''
+
+    def __init__(self, path, read_only=False, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.read_only = read_only
+        self.fd = os.open(path, os.O_RDONLY if read_only else os.O_RDWR)
+        self.block_count = os.fstat(self.fd).st_size // block_size
+        if not self.block_count:
+            os.close(self.fd)
+            raise ValueError(f'{path} is smaller than one {block_size} byte block')
+
+    def read(self, lba, count):
+        return os.pread(self.fd, count * self.block_size, lba * self.block_size)
+
+    def write(self, offset, data):
+        os.pwrite(self.fd, data, offset)
+
+    def flush(self):
+        if not self.read_only:
+            os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class USBMassStorage(USBDevice):
+    '''
+    Bulk-Only Transport device with one LUN serving a DiskImage, a FileImage
+    or a BlockCache over either.
+
+    A CBW on bulk OUT runs its SCSI command at once.  The data IN it produces
+    is handed out to the following bulk IN URBs in slices of their
+    transfer_buffer_length, then the CSW answers the next one; bulk IN URBs
+    arriving before there is anything to answer are parked.
+    '''
+
+    configurations = [configuration]  # Supports only one configuration
+    device_descriptor = storage_device_descriptor
+    speed = 3  # high speed
+    strings = {1: 'USBIP', 2: 'Mass Storage', 3: '000000000001'}
+
+    def __init__(self, image, vendor='USBIP', product='Disk image', revision='1.0'):
+        USBDevice.__init__(self)
+        self.image = image
+        self.inquiry_data = (bytes((0x00,  # direct access block device
+                                    0x80,  # removable
+                                    0x04,  # SPC-2
+                                    0x02,  # response data format
+                                    31, 0, 0, 0))
+                             + vendor.encode('ascii')[:8].ljust(8)
+                             + product.encode('ascii')[:16].ljust(16)
+                             + revision.encode('ascii')[:4].ljust(4))
+        self.lock = threading.Lock()
+        self.in_urbs = collections.deque()  # parked bulk IN URBs
+        self.data = None  # data IN still to send for the current command
+        self.csw = None  # CSW to send once data is exhausted
+        self.stall_in = False  # halt bulk IN before the CSW, for a short data phase
+        self.pending_csw = None  # CSW to send once the data OUT has arrived
+        self.write_offset = 0  # byte offset in the image of the next data OUT
+        self.write_accept = 0  # data OUT bytes a WRITE(10) stores, the rest is discarded
+        self.write_remaining = 0  # data OUT bytes the host still announced
+        self.cbw = CommandBlockWrapper()
+        self.sense = NO_SENSE
+
+    def handle_data(self, usb_req):
+        if usb_req.direction == USBIP_DIR_IN:
+            with self.lock:
+                self.in_urbs.append(usb_req)
+                self.service_in()
+        elif self.write_remaining:
+            self.handle_data_out(usb_req)
+        else:
+            self.handle_cbw(usb_req)
+
+    def handle_unlink(self, seqnum):
+        with self.lock:
+            for usb_req in self.in_urbs:
+                if usb_req.seqnum == seqnum:
+                    self.in_urbs.remove(usb_req)
+                    return True
+        return False
+
+    def detach(self):
+        # The next client starts with a new CBW; whatever command was in progress is dropped
+        with self.lock:
+            self.in_urbs.clear()
+            self.data = self.csw = self.pending_csw = None
+            self.stall_in = False
+            self.write_accept = self.write_remaining = 0
+
+    def pending_urbs(self):
+        return len(self.in_urbs)
+
+    def service_in(self):
+        # Called with self.lock held; answers parked IN URBs while there is data or a CSW
+        while self.in_urbs:
+            if self.data is not None:
+                usb_req = self.in_urbs.popleft()
+                chunk = self.data[:usb_req.transfer_buffer_length]
+                self.data = self.data[len(chunk):]
+                if not self.data:
+                    # A full-length last packet cannot tell the host the data ended early
+                    self.stall_in = len(chunk) == usb_req.transfer_buffer_length and self.csw.dCSWDataResidue > 0
+                    self.data = None
+                self.send_usb_ret(usb_req, chunk, len(chunk))
+            elif self.stall_in:
+                self.stall_in = False
+                self.send_usb_ret(self.in_urbs.popleft(), b'', 0, URB_STATUS_STALL)
+            elif self.csw is not None:
+                csw, self.csw = self.csw.pack(), None
+                self.send_usb_ret(self.in_urbs.popleft(), csw, len(csw))
+            else:
+                return
+
+    def handle_cbw(self, usb_req):
+        data = usb_req.transfer_buffer
+        if data is None or len(data) != CBW_SIZE or bytes(data[:4]) != b'USBC':
+            logger.warning('invalid CBW of %d bytes', 0 if data is None else len(data))
+            self.send_usb_ret(usb_req, b'', 0, URB_STATUS_STALL)
+            return
+        cbw = self.cbw
+        cbw.unpack(data)
+        self.send_usb_ret(usb_req, b'', len(data))
+        expected = cbw.dCBWDataTransferLength
+        self.write_accept = 0
+        response, status = self.handle_scsi(cbw.CBWCB[:cbw.bCBWCBLength], expected)
+        csw = CommandStatusWrapper(dCSWTag=cbw.dCBWTag, dCSWDataResidue=0, bCSWStatus=status)
+        with self.lock:
+            if cbw.bmCBWFlags & 0x80:
+                if expected:
+                    self.data = memoryview(response)[:expected]
+                csw.dCSWDataResidue = expected - len(response[:expected])
+            elif expected:
+                csw.dCSWDataResidue = expected - self.write_accept
+                self.write_remaining = expected
+                self.pending_csw = csw
+                return
+            self.csw = csw
+            self.service_in()
+
+    def handle_data_out(self, usb_req):
+        data = usb_req.transfer_buffer
+        stored = min(len(data), self.write_accept)
+        if stored:
+            self.image.write(self.write_offset, data[:stored])
+            self.write_offset += stored
+            self.write_accept -= stored
+        self.write_remaining -= min(len(data), self.write_remaining)
+        self.send_usb_ret(usb_req, b'', len(data))
+        if not self.write_remaining:
+            with self.lock:
+                self.csw, self.pending_csw = self.pending_csw, None
+                self.service_in()
+
+    def fail(self, sense):
+        self.sense = sense
+        return b'', 1
+
+    def handle_scsi(self, cb, expected):
+        # Returns the data IN and the CSW status of one SCSI command
+        opcode = cb[0] if cb else None
+        logger.debug('SCSI opcode=%r', opcode)
+        if opcode == 0x03:  # REQUEST SENSE reports the last failure, any other command clears it
+            sense_key, asc = self.sense
+            self.sense = NO_SENSE
+            return bytes((0x70, 0, sense_key, 0, 0, 0, 0, 10, 0, 0, 0, 0, asc, 0, 0, 0, 0, 0)), 0
+        self.sense = NO_SENSE
+        if opcode == 0x28:  # READ(10)
+            lba, count = READ_WRITE_10.unpack_from(cb)
+            if lba + count > self.image.block_count:
+                return self.fail(LBA_OUT_OF_RANGE)
+            return self.image.read(lba, count), 0
+        if opcode == 0x2a:  # WRITE(10)
+            lba, count = READ_WRITE_10.unpack_from(cb)
+            if self.image.read_only:
+                return self.fail(WRITE_PROTECTED)
+            if lba + count > self.image.block_count:
+                return self.fail(LBA_OUT_OF_RANGE)
+            self.write_offset = lba * self.image.block_size
+            self.write_accept = min(count * self.image.block_size, expected)
+            return b'', 0
+        if opcode == 0x00:  # TEST UNIT READY
+            return b'', 0
+        if opcode == 0x12:  # INQUIRY
+            if cb[1] & 0x01:  # no vital product data pages
+                return self.fail(INVALID_FIELD_IN_CDB)
+            return self.inquiry_data, 0
+        if opcode == 0x25:  # READ CAPACITY(10)
+            return READ_CAPACITY_10.pack(self.image.block_count - 1, self.image.block_size), 0
+        if opcode == 0x23:  # READ FORMAT CAPACITIES
+            return (bytes((0, 0, 0, 8)) + self.image.block_count.to_bytes(4, 'big')
+                    + bytes((0x02,)) + self.image.block_size.to_bytes(3, 'big')), 0
+        if opcode == 0x1a:  # MODE SENSE(6), header only
+            return bytes((3, 0, 0x80 if self.image.read_only else 0, 0)), 0
+        if opcode == 0x5a:  # MODE SENSE(10), header only
+            return bytes((0, 6, 0, 0x80 if self.image.read_only else 0, 0, 0, 0, 0)), 0
+        if opcode == 0x35:  # SYNCHRONIZE CACHE(10)
+            self.image.flush()
+            return b'', 0
+        if opcode in (0x1b, 0x1e, 0x2f):  # START STOP UNIT, PREVENT ALLOW MEDIUM REMOVAL, VERIFY(10)
+            return b'', 0
+        logger.debug('unsupported SCSI opcode=%r', opcode)
+        return self.fail(INVALID_COMMAND)
+
+    def reset(self):
+        with self.lock:
+            self.data = self.csw = self.pending_csw = None
+            self.stall_in = False
+            self.write_accept = self.write_remaining = 0
+
+    def handle_device_specific_control(self, control_req, usb_req):
+        if control_req.bmRequestType == 0xa1 and control_req.bRequest == 0xfe:  # Get Max LUN
+            self.send_usb_ret(usb_req, b'\0', 1)
+        elif control_req.bmRequestType == 0x21 and control_req.bRequest == 0xff:  # Bulk-Only Mass Storage Reset
+            self.reset()
+            self.send_usb_ret(usb_req, b'', 0)
+        elif control_req.bmRequestType == 0x02 and control_req.bRequest == 0x01:  # CLEAR_FEATURE(ENDPOINT_HALT)
+            self.send_usb_ret(usb_req, b'', 0)
+        else:
+            logger.debug('unsupported control request, stalling')
+            self.send_usb_ret(usb_req, b'', 0, URB_STATUS_STALL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a raw disk image as a USB flash drive.')
+    parser.add_argument('image', help='raw disk image, e.g. made with: truncate -s 64M disk.img')
+    parser.add_argument('--read-only', action='store_true', help='report the medium as write protected')
+    parser.add_argument('--cache', type=int, metavar='MB',
+                        help='serve the image with pread/pwrite through a block cache of this size instead of mmap')
+    parser.add_argument('--flush-interval', type=float, default=1.0, help='seconds between write-backs of the block cache')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')  # DEBUG logs every URB
+    if args.cache:
+        image = BlockCache(FileImage(args.image, args.read_only), capacity=args.cache << 20,
+                           flush_interval=args.flush_interval)
+    else:
+        image = DiskImage(args.image, args.read_only)
+    usb_container = USBContainer()
+    usb_container.add_usb_device(USBMassStorage(image))  # Exported as bus id 1-1
+    usb_container.run()
@@ -0,0 +1,134 @@
+import argparse
+import importlib.util
+import os
+import sys
+import threading
+import time
+from USBIP import USBRequest, USBIP_RET_Submit, URB_PREFIX, USBIP_RET_SUBMIT, read_capture, bytes_to_string
+
+# Offline replay of a session recorded with USBContainer.enable_capture():
+# every CMD_SUBMIT is fed straight into a device's handle_usb_request(), no
+# sockets involved, and the responses are diffed against the recorded RET_SUBMITs.
+#
+#   python replay.py usbip.pcap hid-mouse.py USBHID [--realtime]
+
+
+class ReplayConnection:
+    '''
+    Stands in for the socket as USBDevice.connection and collects the
+    RET_SUBMIT responses by seqnum.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.ret = USBIP_RET_Submit()
+
+    def sendall(self, data):
+        self.sendmsg([data])
+
+    def sendmsg(self, buffers):
+        data = b''.join(bytes(buffer) for buffer in buffers)
+        command, seqnum = URB_PREFIX.unpack_from(data)
+        if command == USBIP_RET_SUBMIT:
+            with self.lock:
+                self.ret.unpack(data[:self.ret.size()])
+                self.responses[seqnum] = (self.ret.status, self.ret.actual_length,
+                                          data[self.ret.size():self.ret.size() + self.ret.actual_length])
+        return len(data)
+
+
+class ReplaySession:
+    '''
+    Replays the CMD_SUBMITs of one device from a capture into usb_dev, either
+    as fast as possible or at the recorded pace, and compares the responses
+    with the recorded RET_SUBMITs.
+    '''
+
+    def __init__(self, usb_dev, path, devid=None):
+        records = list(read_capture(path))
+        if devid is None and records:
+            devid = records[0].devid
+        self.usb_dev = usb_dev
+        self.submits = [record for record in records if record.kind == b'S' and record.devid == devid]
+        self.completions = {record.seqnum: record for record in records if record.kind == b'C' and record.devid == devid}
+        self.mismatches = []
+        self.missing = []
+        self.elapsed = 0.0
+
+    def requests(self):
+        for record in self.submits:
+            yield record.timestamp, USBRequest(seqnum=record.seqnum,
+                                               devid=record.devid,
+                                               direction=record.direction,
+                                               ep=record.ep,
+                                               flags=0,
+                                               numberOfPackets=0,
+                                               interval=record.interval,
+                                               setup=record.setup or bytes(8),
+                                               transfer_buffer_length=record.length,
+                                               transfer_buffer=record.data or None)
+
+    def run(self, realtime=False, settle=0.0):
+        connection = ReplayConnection()
+        self.usb_dev.materialize()  # as on import, the device never went through one
+        self.usb_dev.connection = connection
+        requests = list(self.requests())
+        start = time.monotonic()
+        first = requests[0][0] if requests else 0.0
+        for timestamp, usb_req in requests:
+            if realtime:
+                delay = (timestamp - first) - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.usb_dev.handle_usb_request(usb_req)
+        self.elapsed = time.monotonic() - start
+        if settle:
+            time.sleep(settle)  # let parked URBs complete
+        self.compare(connection.responses)
+        return self
+
+    def compare(self, responses):
+        for seqnum, expected in self.completions.items():
+            actual = responses.get(seqnum)
+            if actual is None:
+                self.missing.append(seqnum)
+            elif actual != (expected.status, expected.length, expected.data):
+                self.mismatches.append((seqnum, (expected.status, expected.length, expected.data), actual))
+
+    def report(self, limit=10):
+        rate = len(self.submits) / self.elapsed if self.elapsed else 0.0
+        print(f'replayed {len(self.submits)} URBs in {self.elapsed:.3f}s ({rate:,.0f} URB/s)')
+        print(f'{len(self.completions) - len(self.missing) - len(self.mismatches)} matched, '
+              f'{len(self.mismatches)} differ, {len(self.missing)} unanswered')
+        for seqnum, expected, actual in self.mismatches[:limit]:
+            print(f'  seqnum {seqnum:x}')
+            print(f'    recorded status={expected[0]:x} length={expected[1]} data={bytes_to_string(expected[2])}')
+            print(f'    replayed status={actual[0]:x} length={actual[1]} data={bytes_to_string(actual[2])}')
+        return not (self.mismatches or self.missing)
+
+
+def load_device_class(path, name):
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0].replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a USB/IP capture into a device, without sockets.')
+    parser.add_argument('capture', help='pcap written by USBContainer.enable_capture()')
+    parser.add_argument('module', help='file defining the device, e.g. hid-mouse.py')
+    parser.add_argument('device', help='USBDevice subclass in that file, e.g. USBHID')
+    parser.add_argument('--devid', type=lambda value: int(value, 0), help='device to replay (default: first in capture)')
+    parser.add_argument('--realtime', action='store_true', help='keep the recorded timing instead of running flat out')
+    parser.add_argument('--settle', type=float, default=0.0, help='seconds to wait for parked URBs after the last submit')
+    args = parser.parse_args()
+
+    usb_dev = load_device_class(args.module, args.device)()
+    session = ReplaySession(usb_dev, args.capture, args.devid).run(args.realtime, args.settle)
+    sys.exit(0 if session.report() else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+import mmap
+import time
+import errno
+import wave
+import array
+import functools
+import struct
+import logging
+import argparse
+import queue
+import threading
+import collections
+from abc import ABC, abstractmethod
+from USBIP import (BaseStructure, USBDevice, InterfaceDescriptor, DeviceDescriptor, DeviceConfiguration, DescriptorList,
+                   USBContainer, endpoint_interval, USBIP_DIR_IN, USBIP_DIR_OUT, URB_STATUS_STALL, ISO_PACKET_WORDS)
+
+
+logger = logging.getLogger('USBIP.usb-audio')
+
+# Emulating a USB Audio Class 1.0 headset: a speaker on iso OUT endpoint 1 and
+# a microphone on iso IN endpoint 2, both 16-bit PCM at full speed, one packet
+# per 1 ms frame.
+
+# Audio class-specific descriptors
+
+
+class ACHeaderDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 10),
+        ('bDescriptorType', 'B', 0x24),  # CS_INTERFACE
+        ('bDescriptorSubtype', 'B', 0x01),  # HEADER
+        ('bcdADC', 'H', 0x0100),
+        ('wTotalLength', 'H'),
+        ('bInCollection', 'B', 2),
+        ('baInterfaceNr1', 'B', 1),
+        ('baInterfaceNr2', 'B', 2),
+    ]
+
+
+class InputTerminalDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 12),
+        ('bDescriptorType', 'B', 0x24),
+        ('bDescriptorSubtype', 'B', 0x02),  # INPUT_TERMINAL
+        ('bTerminalID', 'B'),
+        ('wTerminalType', 'H'),
+        ('bAssocTerminal', 'B', 0),
+        ('bNrChannels', 'B'),
+        ('wChannelConfig', 'H'),
+        ('iChannelNames', 'B', 0),
+        ('iTerminal', 'B', 0),
+    ]
+
+
+class OutputTerminalDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 9),
+        ('bDescriptorType', 'B', 0x24),
+        ('bDescriptorSubtype', 'B', 0x03),  # OUTPUT_TERMINAL
+        ('bTerminalID', 'B'),
+        ('wTerminalType', 'H'),
+        ('bAssocTerminal', 'B', 0),
+        ('bSourceID', 'B'),
+        ('iTerminal', 'B', 0),
+    ]
+
+
+class ASGeneralDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 7),
+        ('bDescriptorType', 'B', 0x24),
+        ('bDescriptorSubtype', 'B', 0x01),  # AS_GENERAL
+        ('bTerminalLink', 'B'),
+        ('bDelay', 'B', 1),
+        ('wFormatTag', 'H', 0x0001),  # PCM
+    ]
+
+
+class FormatTypeIDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 11),
+        ('bDescriptorType', 'B', 0x24),
+        ('bDescriptorSubtype', 'B', 0x02),  # FORMAT_TYPE
+        ('bFormatType', 'B', 0x01),  # FORMAT_TYPE_I
+        ('bNrChannels', 'B'),
+        ('bSubframeSize', 'B', 2),
+        ('bBitResolution', 'B', 16),
+        ('bSamFreqType', 'B', 1),  # one discrete sampling frequency
+        ('tSamFreq', '3s'),
+    ]
+
+
+class AudioEndpointDescriptor(BaseStructure):
+    # Standard endpoint descriptor with the two audio class fields
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 9),
+        ('bDescriptorType', 'B', 0x05),
+        ('bEndpointAddress', 'B'),
+        ('bmAttributes', 'B'),
+        ('wMaxPacketSize', 'H'),
+        ('bInterval', 'B', 1),
+        ('bRefresh', 'B', 0),
+        ('bSynchAddress', 'B', 0),
+    ]
+
+
+class ASEndpointDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 7),
+        ('bDescriptorType', 'B', 0x25),  # CS_ENDPOINT
+        ('bDescriptorSubtype', 'B', 0x01),  # EP_GENERAL
+        ('bmAttributes', 'B', 0x01),  # sampling frequency control
+        ('bLockDelayUnits', 'B', 0),
+        ('wLockDelay', 'H', 0),
+    ]
+
+
+def channel_config(channels):
+    return 0x0003 if channels == 2 else 0x0000  # left and right front, or mono
+
+
+def max_packet_size(rate, channels):
+    return -(-rate // 1000) * channels * 2
+
+
+def streaming_interface(number, terminal_link, endpoint_address, endpoint_attributes, rate, channels):
+    zero_bandwidth = InterfaceDescriptor(bInterfaceNumber=number,
+                                         bAlternateSetting=0,
+                                         bNumEndpoints=0,
+                                         bInterfaceClass=0x01,  # class Audio
+                                         bInterfaceSubClass=0x02,  # AUDIOSTREAMING
+                                         bInterfaceProtocol=0)
+    zero_bandwidth.endpoints = []
+    streaming = InterfaceDescriptor(bInterfaceNumber=number,
+                                    bAlternateSetting=1,
+                                    bNumEndpoints=1,
+                                    bInterfaceClass=0x01,
+                                    bInterfaceSubClass=0x02,
+                                    bInterfaceProtocol=0)
+    streaming.class_descriptor = DescriptorList([
+        ASGeneralDescriptor(bTerminalLink=terminal_link),
+        FormatTypeIDescriptor(bNrChannels=channels, tSamFreq=rate.to_bytes(3, byteorder='little'))])
+    endpoint = AudioEndpointDescriptor(bEndpointAddress=endpoint_address,
+                                       bmAttributes=endpoint_attributes,
+                                       wMaxPacketSize=max_packet_size(rate, channels))
+    endpoint.class_descriptor = ASEndpointDescriptor()
+    streaming.endpoints = [endpoint]
+    return [zero_bandwidth, streaming]
+
+
+@functools.lru_cache
+def audio_configuration(speaker_rate, speaker_channels, microphone_rate, microphone_channels):
+    control = InterfaceDescriptor(bInterfaceNumber=0,
+                                  bAlternateSetting=0,
+                                  bNumEndpoints=0,
+                                  bInterfaceClass=0x01,  # class Audio
+                                  bInterfaceSubClass=0x01,  # AUDIOCONTROL
+                                  bInterfaceProtocol=0)
+    control.endpoints = []
+    control.class_descriptor = DescriptorList([
+        ACHeaderDescriptor(),
+        # Speaker: USB streaming (1) -> speaker (2)
+        InputTerminalDescriptor(bTerminalID=1, wTerminalType=0x0101, bNrChannels=speaker_channels,
+                                wChannelConfig=channel_config(speaker_channels)),
+        OutputTerminalDescriptor(bTerminalID=2, wTerminalType=0x0301, bSourceID=1),
+        # Microphone: microphone (3) -> USB streaming (4)
+        InputTerminalDescriptor(bTerminalID=3, wTerminalType=0x0201, bNrChannels=microphone_channels,
+                                wChannelConfig=channel_config(microphone_channels)),
+        OutputTerminalDescriptor(bTerminalID=4, wTerminalType=0x0101, bSourceID=3)])
+    control.class_descriptor[0].wTotalLength = len(control.class_descriptor.pack())
+    interfaces = [[control],
+                  streaming_interface(1, 1, 0x01, 0x09, speaker_rate, speaker_channels),  # iso, adaptive
+                  streaming_interface(2, 4, 0x82, 0x05, microphone_rate, microphone_channels)]  # iso, asynchronous
+    configuration = DeviceConfiguration(wTotalLength=0,
+                                        bNumInterfaces=len(interfaces),
+                                        bConfigurationValue=1,
+                                        iConfiguration=0x0,  # No string
+                                        bmAttributes=0x80,  # bus powered
+                                        bMaxPower=50)  # 100 mA current
+    configuration.interfaces = interfaces
+    total_length = len(configuration.pack())
+    for interface in interfaces:
+        for alternative in interface:
+            total_length += len(alternative.pack()) + len(alternative.class_descriptor.pack()
+                                                          if hasattr(alternative, 'class_descriptor') else b'')
+            for endpoint in alternative.endpoints:
+                total_length += len(endpoint.pack()) + len(endpoint.class_descriptor.pack())
+    configuration.wTotalLength = total_length
+    return configuration
+
+
+audio_device_descriptor = DeviceDescriptor(bDeviceClass=0x0,  # defined at interface level
+                                           bDeviceSubClass=0x0,
+                                           bDeviceProtocol=0x0,
+                                           bMaxPacketSize0=0x40,
+                                           idVendor=0x2706,
+                                           idProduct=0x0003,
+                                           bcdDevice=0x0100,
+                                           iManufacturer=1,
+                                           iProduct=2,
+                                           bNumConfigurations=1)
+
+
+class WavSource:
+    '''
+    16-bit PCM WAV file mapped into memory, read in a loop.
+
+    read() returns memoryview slices of the mapping; only a read crossing the
+    end of the data, once per loop, builds a new buffer.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as wav:
+            self.mapping = mmap.mmap(wav.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+        if self.view[:4] != b'RIFF' or self.view[8:12] != b'WAVE':
+            raise ValueError(f'{path} is not a WAV file')
+        offset = 12
+        self.data = None
+        while offset + 8 <= len(self.view):
+            chunk_id, size = struct.unpack_from('<4sI', self.view, offset)
+            if chunk_id == b'fmt ':
+                audio_format, self.channels, self.rate, _, self.frame_size, bits = struct.unpack_from('<HHIIHH', self.view, offset + 8)
+                if audio_format != 1 or bits != 16:
+                    raise ValueError(f'{path} is not 16-bit PCM')
+            elif chunk_id == b'data':
+                self.data = self.view[offset + 8:offset + 8 + size]
+            offset += 8 + size + (size & 1)
+        if self.data is None or len(self.data) < self.frame_size:
+            raise ValueError(f'{path} has no audio data')
+        self.data = self.data[:len(self.data) - len(self.data) % self.frame_size]
+        self.position = 0
+
+    def read(self, size):
+        end = self.position + size
+        if end <= len(self.data):
+            self.position = end % len(self.data)
+            return self.data[end - size:end]
+        chunk = bytearray()
+        while len(chunk) < size:
+            part = self.data[self.position:self.position + size - len(chunk)]
+            chunk += part
+            self.position = (self.position + len(part)) % len(self.data)
+        return chunk
+
+
+class AudioStream(ABC):
+    '''
+    Completes the iso URBs of one endpoint at the sample rate.
+
+    URBs are parked on submit() and completed by service(), which the
+    container's InterruptScheduler calls every frame.  Completion times are
+    derived from one start time and the count of packets completed, never
+    from the previous completion, so a late tick delays one URB but not the
+    stream: the clock does not drift.  A URB arriving more than resync_after
+    seconds after the queue ran dry restarts the clock, counted in underruns.
+    '''
+
+    resync_after = 0.02
+
+    def __init__(self, usb_dev, rate, channels):
+        self.usb_dev = usb_dev
+        self.rate = rate
+        self.frame_size = channels * 2
+        self.lock = threading.Lock()
+        self.urbs = collections.deque()
+        self.start = None
+        self.packets = 0  # completed since start, one per millisecond
+        self.completed = self.underruns = 0
+        self.max_lateness = 0.0
+
+    def packet_lengths(self, first, count):
+        # Bytes of each packet, spreading rates like 44100 Hz as 44 and 45 samples per frame
+        rate = self.rate
+        return array.array('I', [((packet + 1) * rate // 1000 - packet * rate // 1000) * self.frame_size
+                                 for packet in range(first, first + count)])
+
+    def submit(self, usb_req):
+        now = time.monotonic()
+        with self.lock:
+            if not self.urbs and (self.start is None or now > self.start + self.packets / 1000 + self.resync_after):
+                if self.start is not None:
+                    self.underruns += 1
+                self.start = now - self.packets / 1000
+            self.urbs.append(usb_req)
+
+    def cancel(self, seqnum):
+        with self.lock:
+            for usb_req in self.urbs:
+                if usb_req.seqnum == seqnum:
+                    self.urbs.remove(usb_req)
+                    return True
+        return False
+
+    def detach(self):
+        # The session ended: its URBs are dropped unanswered and the clock restarts with the next
+        with self.lock:
+            self.urbs.clear()
+            self.start = None
+            self.packets = 0
+
+    def stop(self):
+        # Alternate setting 0: URBs still queued are given back with every packet -ESHUTDOWN
+        with self.lock:
+            while self.urbs:
+                usb_req = self.urbs.popleft()
+                count = len(usb_req.iso_packets) // ISO_PACKET_WORDS
+                self.usb_dev.send_iso_ret(usb_req, b'', [0] * count, [-errno.ESHUTDOWN] * count)
+            self.start = None
+            self.packets = 0
+
+    def service(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.urbs:
+                usb_req = self.urbs[0]
+                count = len(usb_req.iso_packets) // ISO_PACKET_WORDS
+                due = self.start + (self.packets + count) / 1000
+                if due > now:
+                    return
+                self.urbs.popleft()
+                self.complete(usb_req, self.packets, count)
+                self.packets += count
+                self.completed += 1
+                self.max_lateness = max(self.max_lateness, now - due)
+
+    @abstractmethod
+    def complete(self, usb_req, first, count): pass
+
+    def stats(self):
+        return dict(completed=self.completed, underruns=self.underruns, max_lateness=self.max_lateness)
+
+
+class MicrophoneStream(AudioStream):
+    # Iso IN: each packet carries the samples of its frame from the WavSource
+
+    def __init__(self, usb_dev, source):
+        AudioStream.__init__(self, usb_dev, source.rate, source.channels)
+        self.source = source
+
+    def complete(self, usb_req, first, count):
+        lengths = self.packet_lengths(first, count)
+        requested = usb_req.iso_packets[1::ISO_PACKET_WORDS]
+        if any(length > limit for length, limit in zip(lengths, requested)):
+            lengths = array.array('I', map(min, lengths, requested))
+        self.usb_dev.send_iso_ret(usb_req, self.source.read(sum(lengths)), lengths)
+
+
+class SpeakerStream(AudioStream):
+    # Iso OUT: the packets of each URB are written to a WAV file, or dropped.
+    # complete() runs on the shared scheduler thread, so a writer thread does
+    # the file writes; URBs arriving with sink_backlog already waiting are
+    # not written, counted in overruns.
+
+    sink_backlog = 64  # URBs, 0.5 s at 8 packets each
+
+    def __init__(self, usb_dev, rate, channels, path=None):
+        AudioStream.__init__(self, usb_dev, rate, channels)
+        self.sink = None
+        self.overruns = 0
+        if path is not None:
+            self.sink = wave.open(path, 'wb')
+            self.sink.setnchannels(channels)
+            self.sink.setsampwidth(2)
+            self.sink.setframerate(rate)
+            self.writes = queue.Queue(self.sink_backlog)
+            self.writer = threading.Thread(target=self.write_sink, daemon=True)
+            self.writer.start()
+
+    def write_sink(self):
+        while 1:
+            frames = self.writes.get()
+            if frames is None:
+                break
+            for data in frames:
+                self.sink.writeframesraw(data)
+
+    def submit(self, usb_req):
+        if usb_req.transfer_buffer is not None:
+            usb_req.transfer_buffer = bytes(usb_req.transfer_buffer)  # the reader's view ends at its next read
+        AudioStream.submit(self, usb_req)
+
+    def complete(self, usb_req, first, count):
+        packets = usb_req.iso_packets
+        lengths = packets[1::ISO_PACKET_WORDS]
+        if self.sink is not None:
+            data = memoryview(usb_req.transfer_buffer)  # a copy made by submit(), kept alive by the views
+            total = sum(lengths)
+            if packets[0] == 0 and packets[-4] + packets[-3] == total:  # packed back to back
+                frames = [data[:total]]
+            else:
+                frames = [data[offset:offset + length] for offset, length in zip(packets[0::ISO_PACKET_WORDS], lengths)]
+            try:
+                self.writes.put_nowait(frames)
+            except queue.Full:
+                self.overruns += 1
+        self.usb_dev.send_iso_ret(usb_req, b'', lengths)
+
+    def close(self):
+        # Writes what is queued, then closes the file
+        if self.sink is not None:
+            self.writes.put(None)
+            self.writer.join()
+            self.sink.close()
+
+
+class USBAudio(USBDevice):
+    '''
+    USB Audio Class 1.0 speaker and microphone.
+
+    The microphone streams a WavSource, looping; its format sets the
+    microphone's descriptors.  The speaker takes speaker_rate and
+    speaker_channels and sinks to a WAV file at speaker_path, if given.
+    Devices with the same formats share one configuration; the streams are
+    created on the first import.
+    '''
+
+    configurations = None  # per device from the stream formats
+    device_descriptor = audio_device_descriptor
+    strings = {1: 'USBIP', 2: 'Audio'}
+    speaker = microphone = None
+
+    def __init__(self, microphone, speaker_path=None, speaker_rate=48000, speaker_channels=2):
+        self.configurations = [audio_configuration(speaker_rate, speaker_channels,
+                                                   microphone.rate, microphone.channels)]
+        USBDevice.__init__(self)
+        self.source = microphone
+        self.speaker_path = speaker_path
+        self.speaker_rate = speaker_rate
+        self.speaker_channels = speaker_channels
+
+    def create_state(self):
+        self.speaker = SpeakerStream(self, self.speaker_rate, self.speaker_channels, self.speaker_path)
+        self.microphone = MicrophoneStream(self, self.source)
+        self.streams = {(1, USBIP_DIR_OUT): self.speaker, (2, USBIP_DIR_IN): self.microphone}
+        self.alternate_settings = {1: 0, 2: 0}
+
+    def handle_data(self, usb_req):
+        stream = self.streams.get((usb_req.ep, usb_req.direction))
+        if stream is None or usb_req.iso_packets is None:
+            self.send_usb_ret(usb_req, b'', 0, URB_STATUS_STALL)
+            return
+        stream.submit(usb_req)
+
+    def handle_unlink(self, seqnum):
+        return self.speaker.cancel(seqnum) or self.microphone.cancel(seqnum)
+
+    def detach(self):
+        self.speaker.detach()
+        self.microphone.detach()
+
+    def pending_urbs(self):
+        return len(self.speaker.urbs) + len(self.microphone.urbs)
+
+    def schedule_endpoints(self, scheduler):
+        # Both streams are serviced every 1 ms frame
+        for interface in self.configurations[0].interfaces[1:]:
+            endpoint = interface[1].endpoints[0]
+            stream = self.streams[(endpoint.bEndpointAddress & 0x0f,
+                                   USBIP_DIR_IN if endpoint.bEndpointAddress & 0x80 else USBIP_DIR_OUT)]
+            scheduler.register(endpoint_interval(endpoint, self.speed), stream.service)
+
+    def handle_device_specific_control(self, control_req, usb_req):
+        if control_req.bmRequestType == 0x01 and control_req.bRequest == 0x0b:  # SET_INTERFACE
+            interface, alternate = control_req.wIndex & 0xff, control_req.wValue
+            logger.info('interface %d alternate setting %d', interface, alternate)
+            self.alternate_settings[interface] = alternate
+            if alternate == 0:
+                (self.speaker if interface == 1 else self.microphone).stop()
+            self.send_usb_ret(usb_req, b'', 0)
+        elif control_req.bmRequestType == 0x81 and control_req.bRequest == 0x0a:  # GET_INTERFACE
+            self.send_usb_ret(usb_req, bytes((self.alternate_settings.get(control_req.wIndex & 0xff, 0),)), 1)
+        elif control_req.bmRequestType == 0x22 and control_req.bRequest == 0x01:  # SET_CUR sampling frequency
+            self.send_usb_ret(usb_req, b'', control_req.wLength)  # only one rate, accepted as is
+        elif control_req.bmRequestType == 0xa2 and control_req.bRequest == 0x81:  # GET_CUR sampling frequency
+            stream = self.microphone if control_req.wIndex & 0x80 else self.speaker
+            self.send_usb_ret(usb_req, stream.rate.to_bytes(3, byteorder='little'), 3)
+        else:
+            logger.debug('unsupported control request, stalling')
+            self.send_usb_ret(usb_req, b'', 0, URB_STATUS_STALL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a USB audio headset streaming a WAV file.')
+    parser.add_argument('microphone', help='16-bit PCM WAV file the microphone plays in a loop')
+    parser.add_argument('--speaker', help='WAV file to record the speaker to')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')  # DEBUG logs every URB
+    usb_dev = USBAudio(WavSource(args.microphone), args.speaker)
+    usb_container = USBContainer()
+    usb_container.add_usb_device(usb_dev)  # Exported as bus id 1-1
+    try:
+        usb_container.run()
+    finally:
+        if usb_dev.speaker is not None:
+            usb_dev.speaker.close()